@@ -0,0 +1,165 @@
+# analytics.py - Columnar purchase analytics with NumPy
+#
+# Purchases are pulled out of SQLite into typed NumPy columns once and kept in
+# memory; every refresh appends only the rows with an id above the last one
+# seen. Reports are computed over whole columns (bincount, unique, cumsum,
+# percentile) instead of turning millions of rows into dicts one at a time.
+import threading
+from datetime import date
+
+import numpy as np
+
+EPOCH = date(1970, 1, 1)
+
+# Days are whole days since 1970-01-01 (UTC), computed by SQLite while reading
+PURCHASE_DTYPE = np.dtype([
+    ("id", "i8"),
+    ("sweet_id", "i8"),
+    ("user_id", "i8"),
+    ("quantity", "i8"),
+    ("total_price", "f8"),
+    ("day", "i4"),
+])
+
+PURCHASE_COLUMNS_QUERY = """
+    SELECT id, sweet_id, user_id, quantity, total_price,
+           CAST(julianday(purchase_date) - 2440587.5 AS INTEGER) AS day
+    FROM purchases
+    WHERE id > ?
+    ORDER BY id
+"""
+
+def to_day(value: date):
+    return (value - EPOCH).days
+
+def day_labels(days):
+    """ISO dates for an array of day numbers"""
+    return np.datetime_as_string(np.asarray(days).astype("datetime64[D]")).tolist()
+
+class PurchaseColumns:
+    """The purchases table as growable NumPy columns, refreshed incrementally.
+
+    Purchases are append-only, so rows above the last cached id are all that
+    can change. If the last cached row no longer matches the table (the
+    database was replaced or restored), everything is reloaded.
+    """
+
+    def __init__(self, chunk_size=100_000):
+        self.chunk_size = chunk_size
+        self.refreshes = 0
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._size = 0
+        self._columns = {name: np.empty(0, dtype=PURCHASE_DTYPE[name]) for name in PURCHASE_DTYPE.names}
+
+    @property
+    def last_id(self):
+        return int(self._columns["id"][self._size - 1]) if self._size else 0
+
+    def _matches(self, execute):
+        if not self._size:
+            return True
+        last = self._size - 1
+        row = execute("SELECT sweet_id, quantity FROM purchases WHERE id = ?", (self.last_id,)).fetchone()
+        return row is not None and tuple(row) == (
+            int(self._columns["sweet_id"][last]), int(self._columns["quantity"][last])
+        )
+
+    def _append(self, chunk):
+        needed = self._size + len(chunk)
+        capacity = len(self._columns["id"])
+        if needed > capacity:
+            # Grow geometrically so appending a few rows per refresh never copies everything
+            capacity = max(needed, capacity * 2, 1024)
+            for name, column in self._columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self._size] = column[:self._size]
+                self._columns[name] = grown
+        for name in PURCHASE_DTYPE.names:
+            self._columns[name][self._size:needed] = chunk[name]
+        self._size = needed
+
+    def refresh(self, conn, execute=None):
+        """Load purchases added since the last refresh and return a snapshot of every column.
+
+        ``execute(sql, params)`` runs each query and returns its cursor; it
+        defaults to ``conn.execute``. Rows are read as plain tuples in chunks.
+        """
+        execute = execute or conn.execute
+        with self._lock:
+            if not self._matches(execute):
+                self._reset()
+                self.reloads += 1
+            cursor = execute(PURCHASE_COLUMNS_QUERY, (self.last_id,))
+            cursor.row_factory = None
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                self._append(np.array(rows, dtype=PURCHASE_DTYPE))
+            self.refreshes += 1
+            return self.snapshot()
+
+    def snapshot(self):
+        # Views stop at the current size; later appends write past them or into new arrays
+        return {name: column[:self._size] for name, column in self._columns.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rows": self._size,
+                "last_id": self.last_id,
+                "refreshes": self.refreshes,
+                "reloads": self.reloads,
+                "bytes": sum(column.nbytes for column in self._columns.values()),
+            }
+
+def select_days(columns, start_day=None, end_day=None):
+    """Columns restricted to purchases between two day numbers, inclusive"""
+    if start_day is None and end_day is None:
+        return columns
+    mask = np.ones(len(columns["day"]), dtype=bool)
+    if start_day is not None:
+        mask &= columns["day"] >= start_day
+    if end_day is not None:
+        mask &= columns["day"] <= end_day
+    return {name: column[mask] for name, column in columns.items()}
+
+def daily_series(columns, start_day, end_day):
+    """Units, revenue and purchase counts for every day in the range, zero-filled"""
+    columns = select_days(columns, start_day, end_day)
+    offsets = columns["day"] - start_day
+    length = end_day - start_day + 1
+    return {
+        "day": np.arange(start_day, end_day + 1),
+        "units": np.bincount(offsets, weights=columns["quantity"], minlength=length),
+        "revenue": np.bincount(offsets, weights=columns["total_price"], minlength=length),
+        "purchases": np.bincount(offsets, minlength=length),
+    }
+
+def moving_average(values, window):
+    """Trailing mean over ``window`` values; NaN until the first full window"""
+    values = np.asarray(values, dtype=float)
+    averages = np.full(len(values), np.nan)
+    if window <= len(values):
+        sums = np.cumsum(np.concatenate(([0.0], values)))
+        averages[window - 1:] = (sums[window:] - sums[:-window]) / window
+    return averages
+
+def group_totals(columns, key):
+    """Units, revenue and purchase counts per distinct value of ``key``, highest revenue first"""
+    keys, inverse = np.unique(columns[key], return_inverse=True)
+    revenue = np.bincount(inverse, weights=columns["total_price"], minlength=len(keys))
+    units = np.bincount(inverse, weights=columns["quantity"], minlength=len(keys))
+    purchases = np.bincount(inverse, minlength=len(keys))
+    order = np.lexsort((keys, -revenue))
+    return {"key": keys[order], "units": units[order], "revenue": revenue[order], "purchases": purchases[order]}
+
+def percentiles(values, points=(50, 90, 95, 99)):
+    """Selected percentiles of ``values`` as a dict, e.g. {"p50": ..., "p99": ...}"""
+    if len(values) == 0:
+        return {f"p{point}": None for point in points}
+    return {f"p{point}": value for point, value in zip(points, np.percentile(values, points).tolist())}
@@ -0,0 +1,68 @@
+# bench_async_mode.py - Compare the threadpool and async request paths under load
+#
+# Starts the server once per mode (SWEETSHOP_ASYNC_DB=0 and =1) on a throwaway
+# database and drives the hot endpoints with 1000 concurrent connections.
+#
+#   cd sweetshop-backend
+#   python benchmarks/bench_async_mode.py --concurrency 1000 --requests 20000
+import argparse
+import asyncio
+import os
+import tempfile
+
+from loadgen import client_for, drive, report, report_header, start_server, stop_server
+
+async def get_token(client):
+    user = {
+        "username": "benchuser",
+        "email": "bench@example.com",
+        "password": "password123",
+        "mobile": "1234567890",
+        "address": "1 Bench Street"
+    }
+    await client.post("/api/auth/register", json=user)
+    response = await client.post("/api/auth/login", json={"email": user["email"], "password": user["password"]})
+    return response.json()["access_token"]
+
+async def run_load(base_url: str, concurrency: int, total: int):
+    async with client_for(base_url, concurrency) as client:
+        headers = {"Authorization": f"Bearer {await get_token(client)}"}
+        sweets = (await client.get("/api/sweets")).json()
+        sweet_id = max(sweets, key=lambda sweet: sweet["quantity"])["id"]
+        admin = await client.post("/api/auth/login", json={"email": "admin@sweetshop.com", "password": "admin123"})
+        await client.post(
+            f"/api/sweets/{sweet_id}/restock",
+            json={"quantity": total},
+            headers={"Authorization": f"Bearer {admin.json()['access_token']}"}
+        )
+
+        # Mostly reads, as in real traffic: catalog, search, detail, purchase
+        requests = [
+            ("GET", "/api/sweets", {}),
+            ("GET", "/api/sweets/search?name=Laddu", {}),
+            ("GET", f"/api/sweets/{sweet_id}", {}),
+            ("GET", "/api/sweets", {}),
+            ("GET", f"/api/sweets/{sweet_id}", {}),
+            ("POST", f"/api/sweets/{sweet_id}/purchase", {"json": {"quantity": 1}, "headers": headers}),
+        ]
+        return await drive(client, lambda i: requests[i % len(requests)], total, concurrency)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SWEETSHOP_ASYNC_DB=0 and =1 under load")
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    report_header()
+    for async_db in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            process = start_server(args.port, os.path.join(tmp, "bench.db"), SWEETSHOP_ASYNC_DB="1" if async_db else "0")
+            try:
+                result = asyncio.run(run_load(f"http://127.0.0.1:{args.port}", args.concurrency, args.requests))
+            finally:
+                stop_server(process)
+        report("async" if async_db else "sync", result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# bench_handlers.py - In-process micro-benchmarks of the API hot paths
+#
+# Runs the handlers through TestClient against a copy of the generated dataset.
+# The file is named bench_* so the regular test run does not collect it:
+#
+#   cd sweetshop-backend
+#   python -m pytest benchmarks/bench_handlers.py
+#   python -m pytest benchmarks/bench_handlers.py --benchmark-json=bench.json
+#   python -m pytest benchmarks/bench_handlers.py --benchmark-compare   # against the last saved run
+#
+# BENCH_SWEETS / BENCH_USERS / BENCH_PURCHASES change the dataset size.
+import os
+import random
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from dataset import BENCH_PASSWORD, build_dataset, copy_dataset, user_email
+
+SWEETS = int(os.environ.get("BENCH_SWEETS", "10000"))
+USERS = int(os.environ.get("BENCH_USERS", "1000"))
+PURCHASES = int(os.environ.get("BENCH_PURCHASES", "1000000"))
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    dataset = build_dataset(SWEETS, USERS, PURCHASES)
+    main.DATABASE = copy_dataset(dataset, str(tmp_path_factory.mktemp("bench") / "bench.db"))
+    main.init_db()
+    yield TestClient(main.app)
+    main.reset_state()
+    main.close_pool()
+
+@pytest.fixture(scope="module")
+def user_headers(client):
+    response = client.post("/api/auth/login", json={"email": user_email(0), "password": BENCH_PASSWORD})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+@pytest.fixture(scope="module")
+def admin_headers(client):
+    response = client.post("/api/auth/login", json={"email": "admin@sweetshop.com", "password": "admin123"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+@pytest.fixture(scope="module")
+def sweet_ids(client):
+    # Sweets with plenty of stock, so purchases never run out mid-benchmark
+    return [sweet["id"] for sweet in client.get("/api/sweets?limit=500").json() if sweet["quantity"] >= 10_000]
+
+def record_percentiles(benchmark):
+    """Add p50/p95/p99 (ms) and throughput to the benchmark's extra info"""
+    if benchmark.stats is None:  # --benchmark-disable
+        return
+    data = sorted(benchmark.stats.stats.data)
+    for pct in (50, 95, 99):
+        index = min(len(data) - 1, int(round(pct / 100 * (len(data) - 1))))
+        benchmark.extra_info[f"p{pct}_ms"] = round(data[index] * 1000, 3)
+    benchmark.extra_info["ops"] = round(len(data) / sum(data), 1)
+
+def check(response, status_code=200):
+    assert response.status_code == status_code, response.text
+    return response
+
+# ==================== CATALOG ====================
+
+def test_catalog_cached(benchmark, client):
+    check(client.get("/api/sweets"))
+    benchmark(lambda: check(client.get("/api/sweets")))
+    record_percentiles(benchmark)
+
+def test_catalog_uncached(benchmark, client):
+    benchmark.pedantic(
+        lambda: check(client.get("/api/sweets")),
+        setup=main.catalog_cache.invalidate,
+        rounds=20
+    )
+    record_percentiles(benchmark)
+
+def test_catalog_not_modified(benchmark, client):
+    etag = check(client.get("/api/sweets")).headers["etag"]
+    benchmark(lambda: check(client.get("/api/sweets", headers={"If-None-Match": etag}), 304))
+    record_percentiles(benchmark)
+
+def test_catalog_page(benchmark, client):
+    cursor = check(client.get("/api/sweets?limit=50")).headers["x-next-cursor"]
+    benchmark(lambda: check(client.get(f"/api/sweets?limit=50&cursor={cursor}")))
+    record_percentiles(benchmark)
+
+def test_get_sweet(benchmark, client, sweet_ids):
+    rng = random.Random(1)
+    benchmark(lambda: check(client.get(f"/api/sweets/{rng.choice(sweet_ids)}")))
+    record_percentiles(benchmark)
+
+# ==================== SEARCH ====================
+
+def test_search_by_name(benchmark, client):
+    benchmark(lambda: check(client.get("/api/sweets/search?name=kesar&limit=50")))
+    record_percentiles(benchmark)
+
+def test_search_by_name_unpaginated(benchmark, client):
+    benchmark(lambda: check(client.get("/api/sweets/search?name=kesar laddu")))
+    record_percentiles(benchmark)
+
+def test_search_by_category_and_price(benchmark, client):
+    benchmark(lambda: check(client.get("/api/sweets/search?category=Barfi&min_price=100&max_price=200&limit=50")))
+    record_percentiles(benchmark)
+
+# ==================== AUTH ====================
+
+def test_login(benchmark, client):
+    rng = random.Random(2)
+    benchmark.pedantic(
+        lambda: check(client.post("/api/auth/login", json={
+            "email": user_email(rng.randrange(USERS)),
+            "password": BENCH_PASSWORD
+        })),
+        rounds=20
+    )
+    record_percentiles(benchmark)
+
+def test_authenticated_request(benchmark, client, user_headers):
+    benchmark(lambda: check(client.get("/api/purchases/history?limit=20", headers=user_headers)))
+    record_percentiles(benchmark)
+
+# ==================== WRITES ====================
+
+def test_purchase(benchmark, client, user_headers, sweet_ids):
+    rng = random.Random(3)
+    benchmark(lambda: check(client.post(
+        f"/api/sweets/{rng.choice(sweet_ids)}/purchase",
+        json={"quantity": 1},
+        headers=user_headers
+    )))
+    record_percentiles(benchmark)
+
+def test_order(benchmark, client, user_headers, sweet_ids):
+    rng = random.Random(4)
+    benchmark(lambda: check(client.post(
+        "/api/orders",
+        json={"items": [{"sweet_id": sweet_id, "quantity": 1} for sweet_id in rng.sample(sweet_ids, 5)]},
+        headers=user_headers
+    )))
+    record_percentiles(benchmark)
+
+# ==================== REPORTING ====================
+
+def test_admin_purchases_page(benchmark, client, admin_headers):
+    benchmark(lambda: check(client.get("/api/admin/purchases?limit=100", headers=admin_headers)))
+    record_percentiles(benchmark)
+
+def test_analytics_top_sellers(benchmark, client, admin_headers):
+    benchmark(lambda: check(client.get("/api/admin/analytics/top-sellers?limit=20", headers=admin_headers)))
+    record_percentiles(benchmark)
+
+def test_analytics_customers(benchmark, client, admin_headers):
+    # The first call loads every purchase into the columnar cache; later calls only append
+    check(client.get("/api/admin/analytics/customers", headers=admin_headers))
+    benchmark(lambda: check(client.get("/api/admin/analytics/customers", headers=admin_headers)))
+    record_percentiles(benchmark)
+
+# ==================== MIXED ====================
+
+def test_mixed_traffic(benchmark, client, user_headers, sweet_ids):
+    """One round = a browsing session: catalog page, searches, detail views and a purchase"""
+    rng = random.Random(5)
+
+    def session():
+        check(client.get("/api/sweets?limit=50"))
+        check(client.get("/api/sweets/search?name=laddu&limit=50"))
+        for sweet_id in rng.sample(sweet_ids, 3):
+            check(client.get(f"/api/sweets/{sweet_id}"))
+        check(client.post(f"/api/sweets/{rng.choice(sweet_ids)}/purchase", json={"quantity": 1}, headers=user_headers))
+
+    benchmark(session)
+    record_percentiles(benchmark)
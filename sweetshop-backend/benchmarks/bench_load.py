@@ -0,0 +1,100 @@
+# bench_load.py - HTTP load scenarios against a generated production-sized catalog
+#
+# Starts the server on a copy of the benchmark dataset (10k sweets, 1M purchases
+# by default) and runs each scenario with many concurrent connections, printing
+# throughput and p50/p95/p99 latency.
+#
+#   cd sweetshop-backend
+#   python benchmarks/bench_load.py --concurrency 200 --requests 5000
+#   python benchmarks/bench_load.py --scenario mixed --async-db
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+
+from dataset import BENCH_PASSWORD, build_dataset, copy_dataset, user_email
+from loadgen import client_for, drive, report, report_header, start_server, stop_server
+
+SCENARIOS = ["catalog", "catalog-page", "search", "login", "purchase", "mixed"]
+
+async def login(client, email, password):
+    response = await client.post("/api/auth/login", json={"email": email, "password": password})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def run_scenarios(base_url, scenarios, args):
+    rng = random.Random(7)
+    async with client_for(base_url, args.concurrency) as client:
+        user_headers = await login(client, user_email(0), BENCH_PASSWORD)
+        sweets = (await client.get("/api/sweets?limit=500")).json()
+        sweet_ids = [sweet["id"] for sweet in sweets if sweet["quantity"] >= 10_000]
+
+        def user_login(i):
+            email = user_email(rng.randrange(args.users))
+            return "POST", "/api/auth/login", {"json": {"email": email, "password": BENCH_PASSWORD}}
+
+        def purchase(i):
+            return "POST", f"/api/sweets/{rng.choice(sweet_ids)}/purchase", {"json": {"quantity": 1}, "headers": user_headers}
+
+        def search(i):
+            return "GET", rng.choice([
+                "/api/sweets/search?name=kesar&limit=50",
+                "/api/sweets/search?name=laddu&limit=50",
+                "/api/sweets/search?category=Barfi&min_price=100&max_price=200&limit=50",
+            ]), {}
+
+        def mixed(i):
+            # Roughly a shop's traffic: browsing dominates, a few buy, fewer log in
+            roll = i % 100
+            if roll < 40:
+                return "GET", "/api/sweets?limit=50", {}
+            if roll < 70:
+                return "GET", f"/api/sweets/{rng.choice(sweet_ids)}", {}
+            if roll < 90:
+                return search(i)
+            if roll < 98:
+                return purchase(i)
+            return "GET", "/api/purchases/history?limit=20", {"headers": user_headers}
+
+        builders = {
+            "catalog": lambda i: ("GET", "/api/sweets", {}),
+            "catalog-page": lambda i: ("GET", "/api/sweets?limit=50", {}),
+            "search": search,
+            "login": user_login,
+            "purchase": purchase,
+            "mixed": mixed,
+        }
+        results = {}
+        for name in scenarios:
+            # Full-catalog and login requests are expensive; scale them down
+            total = args.requests // 10 if name in ("catalog", "login") else args.requests
+            results[name] = await drive(client, builders[name], total, args.concurrency)
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the API against a generated catalog")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="run only these scenarios")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--sweets", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--purchases", type=int, default=1_000_000)
+    parser.add_argument("--async-db", action="store_true", help="serve with SWEETSHOP_ASYNC_DB=1")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    dataset = build_dataset(args.sweets, args.users, args.purchases)
+    with tempfile.TemporaryDirectory() as tmp:
+        database = copy_dataset(dataset, os.path.join(tmp, "bench.db"))
+        process = start_server(args.port, database, SWEETSHOP_ASYNC_DB="1" if args.async_db else "0")
+        try:
+            results = asyncio.run(run_scenarios(f"http://127.0.0.1:{args.port}", args.scenario or SCENARIOS, args))
+        finally:
+            stop_server(process)
+
+    report_header()
+    for name, result in results.items():
+        report(name, result)
+
+if __name__ == "__main__":
+    main()
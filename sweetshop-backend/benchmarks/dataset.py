@@ -0,0 +1,52 @@
+# dataset.py - Generated catalog used by the benchmarks
+#
+# Seeds a database with seed.py and caches it under benchmarks/.data keyed by
+# its size, so only the first run pays for generating it.
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import seed  # noqa: E402
+
+DATA_DIR = os.path.join(BENCH_DIR, ".data")
+
+BENCH_PASSWORD = seed.DEFAULT_PASSWORD
+user_email = seed.user_email
+
+def dataset_path(sweets, users, purchases):
+    return os.path.join(DATA_DIR, f"seed-{sweets}s-{users}u-{purchases}p.db")
+
+def build_dataset(sweets=10_000, users=1_000, purchases=1_000_000, random_seed=42):
+    """Return the path of a cached benchmark database, generating it if needed"""
+    path = dataset_path(sweets, users, purchases)
+    if os.path.exists(path):
+        return path
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    started = time.perf_counter()
+    building = path + ".building"
+    for leftover in (building, building + "-wal", building + "-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+    seed.seed_database(building, sweets=sweets, users=users, purchases=purchases, seed=random_seed)
+
+    # Write a compact single-file copy; init_db() switches it back to WAL when it is opened
+    conn = sqlite3.connect(building)
+    conn.execute("VACUUM INTO ?", (path,))
+    conn.close()
+    for leftover in (building, building + "-wal", building + "-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    print(f"Generated {path} in {time.perf_counter() - started:.1f}s")
+    return path
+
+def copy_dataset(path, target):
+    """Copy a cached dataset so a benchmark run can write to it freely"""
+    shutil.copyfile(path, target)
+    return target
@@ -0,0 +1,76 @@
+# loadgen.py - Shared helpers for the HTTP load benchmarks
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def start_server(port: int, database: str, **env):
+    """Run uvicorn on ``database`` with extra SWEETSHOP_* settings and wait until it answers"""
+    env = dict(os.environ, SWEETSHOP_DATABASE=database, **env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning",
+         "--limit-concurrency", "10000", "--backlog", "4096"],
+        cwd=BACKEND_DIR,
+        env=env
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/api/sweets?limit=1").status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("server did not start")
+
+def stop_server(process):
+    process.terminate()
+    process.wait()
+
+async def drive(client, next_request, total: int, concurrency: int):
+    """Send ``total`` requests from ``concurrency`` workers; ``next_request(i)`` gives (method, path, kwargs)"""
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in remaining:
+            method, path, kwargs = next_request(i)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"latencies": latencies, "errors": errors, "elapsed": time.perf_counter() - started}
+
+def client_for(base_url: str, concurrency: int):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120)
+
+def report_header():
+    print(f"{'scenario':<16} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+
+def report(name, result):
+    latencies = result["latencies"]
+    print(
+        f"{name:<16} {len(latencies) / result['elapsed']:>9.0f} "
+        f"{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 95) * 1000:>8.1f} "
+        f"{percentile(latencies, 99) * 1000:>8.1f} {result['errors']:>7}"
+    )
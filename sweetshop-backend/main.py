@@ -1,21 +1,141 @@
 # main.py - Complete Sweet Shop Backend with FastAPI
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from fastapi.dependencies.utils import is_coroutine_callable
+from starlette.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter
 from typing import Optional, List
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 import sqlite3
-from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+import asyncio
+import atexit
+import base64
+import bisect
+import contextvars
+import cProfile
+import hashlib
+import heapq
+import io
+import itertools
+import hmac
+import json
 import logging
+import logging.handlers
+import math
+import multiprocessing
+import os
+import pstats
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+
+import analytics
 
 # Configuration
 SECRET_KEY = "your-secret-key-change-this-in-production-use-env-variable"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
 
+# bcrypt runs in its own process pool; beyond the queue limit logins and registrations get a 503
+PASSWORD_WORKERS = int(os.environ.get("SWEETSHOP_PASSWORD_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("SWEETSHOP_PASSWORD_QUEUE_LIMIT", "64"))
+
+# Verified tokens are remembered so repeat requests skip the JWT check and the user lookup
+AUTH_CACHE_SIZE = int(os.environ.get("SWEETSHOP_AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.environ.get("SWEETSHOP_AUTH_CACHE_TTL", "60"))  # seconds
+
+# Connection pool tuning (overridable through the environment)
+DB_POOL_SIZE = int(os.environ.get("SWEETSHOP_DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("SWEETSHOP_DB_POOL_TIMEOUT", "10"))  # seconds
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("SWEETSHOP_DB_STATEMENT_CACHE_SIZE", "256"))
+
+# SQLite storage profiles; the active one is applied to every connection
+STORAGE_PROFILES = {
+    # WAL lets catalog readers keep going while a purchase commits
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # negative = KiB, i.e. 64 MiB
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+    # SQLite's stock rollback journal, for filesystems without shared memory support
+    "rollback": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+}
+DB_STORAGE_PROFILE = os.environ.get("SWEETSHOP_DB_PROFILE", "wal")
+DB_CHECKPOINT_INTERVAL = float(os.environ.get("SWEETSHOP_DB_CHECKPOINT_INTERVAL", "60"))  # seconds
+
+# Stock mutations are group-committed by a single writer: jobs arriving within the window share one commit
+WRITE_BATCH_WINDOW = float(os.environ.get("SWEETSHOP_WRITE_BATCH_WINDOW_MS", "2")) / 1000  # seconds
+WRITE_BATCH_MAX = int(os.environ.get("SWEETSHOP_WRITE_BATCH_MAX", "256"))
+
+# Queries slower than the threshold are logged with their parameter types and EXPLAIN QUERY PLAN
+SLOW_QUERY_MS = float(os.environ.get("SWEETSHOP_SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG = os.environ.get("SWEETSHOP_SLOW_QUERY_LOG", "slow_queries.log")  # empty = no file
+SLOW_QUERY_LOG_BYTES = int(os.environ.get("SWEETSHOP_SLOW_QUERY_LOG_BYTES", str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.environ.get("SWEETSHOP_SLOW_QUERY_LOG_BACKUPS", "5"))
+SLOW_QUERY_KEEP = 200  # most recent entries served by the admin endpoint
+
+# Stock forecast: sell-through over recent days, refreshed in the background into stock_forecast
+FORECAST_INTERVAL = float(os.environ.get("SWEETSHOP_FORECAST_INTERVAL", "300"))  # seconds
+FORECAST_WINDOW_DAYS = int(os.environ.get("SWEETSHOP_FORECAST_WINDOW_DAYS", "28"))
+FORECAST_RECENT_DAYS = 7  # a sweet selling faster this week than over the window is forecast at the faster rate
+LOW_STOCK_DAYS = float(os.environ.get("SWEETSHOP_LOW_STOCK_DAYS", "7"))
+RESTOCK_COVER_DAYS = int(os.environ.get("SWEETSHOP_RESTOCK_COVER_DAYS", "14"))
+
+# Reservations hold stock for a cart until checkout; unclaimed holds return to stock when they expire
+RESERVATION_TTL = int(os.environ.get("SWEETSHOP_RESERVATION_TTL", "600"))  # seconds
+RESERVATION_MAX_TTL = int(os.environ.get("SWEETSHOP_RESERVATION_MAX_TTL", "3600"))
+RESERVATION_RETRY = 5  # seconds before retrying an expiry the writer failed
+
+# Idempotency-Key: a retried write with the same key gets the first response back instead of running again
+IDEMPOTENCY_TTL = int(os.environ.get("SWEETSHOP_IDEMPOTENCY_TTL", "86400"))  # seconds a key is remembered
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("SWEETSHOP_IDEMPOTENCY_MAX_KEYS", "100000"))  # rows kept in SQLite
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("SWEETSHOP_IDEMPOTENCY_CACHE_SIZE", "2048"))  # responses kept in memory
+IDEMPOTENCY_PURGE_INTERVAL = 600  # seconds between sweeps of expired keys
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENT_REPLAY_HEADER = "Idempotent-Replayed"
+
+# Cursor pagination for list endpoints
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Request profiling: admins send the header to profile one request; a sample rate profiles a share of all traffic
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_SAMPLE_RATE = float(os.environ.get("SWEETSHOP_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_STORE_SIZE = int(os.environ.get("SWEETSHOP_PROFILE_STORE_SIZE", "50"))
+
+# Logs are queued and written by a background thread; catalog reads are only sampled in the access log
+LOG_LEVEL = os.environ.get("SWEETSHOP_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("SWEETSHOP_LOG_FORMAT", "json")  # json | text
+LOG_QUEUE_SIZE = int(os.environ.get("SWEETSHOP_LOG_QUEUE_SIZE", "10000"))
+LOG_CATALOG_SAMPLE_RATE = float(os.environ.get("SWEETSHOP_LOG_CATALOG_SAMPLE_RATE", "0.01"))
+
+# Rows fetched from SQLite per batch when streaming an export
+STREAM_BATCH_SIZE = 500
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
 # Initialize FastAPI
 app = FastAPI(
     title="Sweet Shop Management System",
@@ -24,9 +144,101 @@ app = FastAPI(
 )
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+# Request threads only put records on a queue; formatting and writing happen
+# on the listener thread, so a slow stderr never delays a response.
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with ``extra`` fields as top-level keys"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves %-formatting to the listener and never blocks.
+
+    The stock handler formats every message before queueing it. Here only
+    tracebacks are rendered up front, since they reference live frames.
+    Records that do not fit in a full queue are counted and dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class SamplingFilter(logging.Filter):
+    """Keep a share of the successful access records for the sampled (method, route) pairs"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get((getattr(record, "method", None), getattr(record, "route", None)))
+        if rate is None or getattr(record, "status", 200) >= 400 or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+def build_log_handler():
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    return handler
+
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+log_handler = LazyQueueHandler(log_queue)
+log_listener = logging.handlers.QueueListener(log_queue, build_log_handler(), respect_handler_level=True)
+# force: uvicorn or pytest may already have configured the root logger, which would make this a no-op
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler], force=True)
+log_listener.start()
+
+_log_listener_stopped = False
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _log_listener_stopped
+    if not _log_listener_stopped:
+        _log_listener_stopped = True
+        log_listener.stop()
+
+# Runs after uvicorn's shutdown so the shutdown steps' own records are written too
+atexit.register(stop_logging)
+
 logger = logging.getLogger(__name__)
 
+# One record per request; successful catalog reads are too frequent to keep them all
+access_logger = logging.getLogger(f"{__name__}.access")
+CATALOG_READ_ROUTES = ("/api/sweets", "/api/sweets/search", "/api/sweets/{sweet_id}")
+access_sampler = SamplingFilter({("GET", route): LOG_CATALOG_SAMPLE_RATE for route in CATALOG_READ_ROUTES})
+access_logger.addFilter(access_sampler)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -34,28 +246,964 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", NEXT_CURSOR_HEADER, PROFILE_ID_HEADER, IDEMPOTENT_REPLAY_HEADER],
+)
+
+# Metrics, rendered in the Prometheus text format by GET /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Monotonic counter, one series per label-value tuple"""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            series = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in series]
+
+class Histogram:
+    """Cumulative-bucket histogram, one series per label-value tuple"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # per-bucket counts (last one is +Inf), then sum
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series else 0
+
+    def render(self):
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """Gauge or counter whose series are read from ``func`` at scrape time.
+
+    ``func`` returns either a number or a dict of label-value tuple -> number.
+    """
+
+    def __init__(self, name, documentation, func, labelnames=(), type="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        self.type = type
+
+    def render(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in values.items()]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, func, labelnames=(), type="gauge"):
+        return self.register(CallbackMetric(name, documentation, func, labelnames, type))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.exception("Collecting metric %s failed", metric.name)
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.counter(
+    "sweetshop_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+HTTP_LATENCY = metrics.histogram(
+    "sweetshop_http_request_duration_seconds", "Time to serve an HTTP request", ("method", "route")
+)
+DB_QUERY_LATENCY = metrics.histogram(
+    "sweetshop_db_query_duration_seconds", "SQLite time per named query", ("query",), QUERY_BUCKETS
+)
+DB_CONNECT_LATENCY = metrics.histogram(
+    "sweetshop_db_connect_duration_seconds", "Time to open and configure a SQLite connection", buckets=QUERY_BUCKETS
 )
+DB_POOL_WAIT = metrics.histogram(
+    "sweetshop_db_pool_wait_seconds", "Time spent waiting for a pooled connection", buckets=QUERY_BUCKETS
+)
+DB_COMMIT_LATENCY = metrics.histogram(
+    "sweetshop_db_commit_duration_seconds", "Time to commit a transaction", buckets=QUERY_BUCKETS
+)
+WRITE_BATCH_SIZE = metrics.histogram(
+    "sweetshop_write_batch_size", "Write jobs group-committed per transaction", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+PASSWORD_LATENCY = metrics.histogram(
+    "sweetshop_password_duration_seconds", "bcrypt time per hash or verify, measured in the worker", ("operation",)
+)
+SLOW_QUERIES = metrics.counter(
+    "sweetshop_slow_queries_total", "Queries slower than the slow-query threshold", ("query",)
+)
+PASSWORD_WAIT = metrics.histogram(
+    "sweetshop_password_wait_seconds", "Time a bcrypt job waited for a worker process", ("operation",)
+)
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and timing them per route template"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = {}
+
+    def route_template(self, scope):
+        # The router records the matched endpoint in the scope; map it back to its path
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        template = self._routes.get(endpoint)
+        if template is None:
+            template = next(
+                (route.path for route in scope["app"].routes if getattr(route, "endpoint", None) is endpoint),
+                "unmatched"
+            )
+            self._routes[endpoint] = template
+        return template
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = self.route_template(scope)
+            HTTP_LATENCY.observe(elapsed, scope["method"], route)
+            HTTP_REQUESTS.inc(scope["method"], route, str(status_code))
+            if access_logger.isEnabledFor(logging.INFO):
+                access_logger.info(
+                    "%s %s %s %.1fms", scope["method"], scope["path"], status_code, elapsed * 1000,
+                    extra={
+                        "method": scope["method"],
+                        "route": route,
+                        "status": status_code,
+                        "duration_ms": round(elapsed * 1000, 3),
+                    }
+                )
+
+app.add_middleware(MetricsMiddleware)
 
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
 # Database setup
-DATABASE = "sweetshop.db"
+DATABASE = os.environ.get("SWEETSHOP_DATABASE", "sweetshop.db")
+
+# Serve the hot read/purchase endpoints as native async routes backed by dedicated database threads
+ASYNC_DB = os.environ.get("SWEETSHOP_ASYNC_DB", "0") == "1"
+
+def storage_profile():
+    try:
+        return STORAGE_PROFILES[DB_STORAGE_PROFILE]
+    except KeyError:
+        raise RuntimeError(f"Unknown storage profile: {DB_STORAGE_PROFILE}")
+
+def configure_connection(conn):
+    """Apply the per-connection settings every pooled connection starts with"""
+    conn.row_factory = sqlite3.Row
+    for pragma, value in storage_profile().items():
+        # journal_mode is persistent in the database file and is set once by init_db()
+        if pragma != "journal_mode":
+            conn.execute(f"PRAGMA {pragma} = {value}")
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections.
+
+    Connections are opened lazily up to ``size`` and handed back out in LIFO
+    order so the hottest connection (and its statement cache) is reused first.
+    When every connection is checked out, callers wait up to ``timeout``
+    seconds before getting a 503.
+    """
+
+    def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        with DB_CONNECT_LATENCY.time():
+            conn = sqlite3.connect(
+                self.database,
+                timeout=storage_profile()["busy_timeout"] / 1000,
+                check_same_thread=False,
+                cached_statements=DB_STATEMENT_CACHE_SIZE,
+            )
+            configure_connection(conn)
+        return conn
+
+    def acquire(self):
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise HTTPException(status_code=503, detail="Database is busy, please retry")
+
+        waited = time.perf_counter() - start
+        DB_POOL_WAIT.observe(waited)
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def release(self, conn):
+        healthy = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            healthy = False
+
+        with self._lock:
+            self._in_use -= 1
+            if self._closed or not healthy:
+                self._created -= 1
+                discard = True
+            else:
+                discard = False
+
+        if discard:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "database": self.database,
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._created - self._in_use,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the pool for the current DATABASE, replacing it if the path changed"""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.database == DATABASE:
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.database != DATABASE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DATABASE)
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
 
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    pool = get_pool()
+    conn = pool.acquire()
     try:
         yield conn
     finally:
-        conn.close()
+        pool.release(conn)
+
+def get_connection():
+    """Request dependency: one pooled connection shared by the whole dependency chain"""
+    with get_db() as conn:
+        yield conn
+
+def param_shape(params):
+    """Parameter types without their values, e.g. ["int", "str"]"""
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params]
+
+def explain(conn, sql, params):
+    """EXPLAIN QUERY PLAN detail lines for ``sql``"""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+def full_scans(plan):
+    """Plan lines that read a whole table instead of seeking through an index"""
+    return [
+        detail for detail in plan
+        if detail.startswith("SCAN") and "USING" not in detail and "VIRTUAL TABLE" not in detail
+    ]
+
+class SlowQueryLog:
+    """Recent queries slower than the threshold, also appended as JSON lines to a rotating file"""
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, path=SLOW_QUERY_LOG, keep=SLOW_QUERY_KEEP):
+        self.threshold_ms = threshold_ms
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=keep)
+        self._recorded = 0
+        self._handler = None
+        self._file_logger = logging.getLogger(f"{__name__}.slow_queries")
+        self._file_logger.propagate = False
+
+    def is_slow(self, elapsed):
+        return elapsed * 1000 >= self.threshold_ms
+
+    def record(self, conn, name, sql, params, elapsed, rows=None):
+        entry = {
+            "query": name,
+            "duration_ms": round(elapsed * 1000, 3),
+            "at": datetime.utcnow().isoformat(),
+            "sql": " ".join(sql.split()),
+            "params": param_shape(params),
+        }
+        if rows is not None:
+            entry["rows"] = rows
+        try:
+            entry["plan"] = explain(conn, sql, params)
+            entry["full_scans"] = full_scans(entry["plan"])
+        except sqlite3.Error as e:
+            entry["plan"] = None
+            entry["explain_error"] = str(e)
+
+        SLOW_QUERIES.inc(name)
+        with self._lock:
+            self._entries.append(entry)
+            self._recorded += 1
+            file_logger = self._open_file()
+        if file_logger is not None:
+            file_logger.warning(json.dumps(entry))
+        logger.warning("Slow query %s took %sms", name, entry["duration_ms"])
+        return entry
+
+    def _open_file(self):
+        """The file logger for the current path, (re)opened on first use or after the path changes"""
+        if not self.path:
+            return None
+        path = os.path.abspath(self.path)
+        if self._handler is None or self._handler.baseFilename != path:
+            self._close_handler()
+            self._handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=SLOW_QUERY_LOG_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS, delay=True
+            )
+            self._handler.setFormatter(logging.Formatter("%(message)s"))
+            self._file_logger.addHandler(self._handler)
+        return self._file_logger
+
+    def _close_handler(self):
+        if self._handler is not None:
+            self._file_logger.removeHandler(self._handler)
+            self._handler.close()
+            self._handler = None
+
+    def entries(self, limit=None):
+        with self._lock:
+            entries = list(reversed(self._entries))
+        return entries[:limit] if limit else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        with self._lock:
+            self._close_handler()
+
+    def stats(self):
+        with self._lock:
+            return {"threshold_ms": self.threshold_ms, "recorded": self._recorded, "stored": len(self._entries)}
+
+slow_query_log = SlowQueryLog()
+
+# Endpoints run their SQL through these wrappers so every statement is timed
+# under a stable name (e.g. "purchase.decrement_stock") on /metrics, and
+# anything over the slow-query threshold is logged with its query plan.
+
+def run_query(conn, name, sql, params, call, rows=None):
+    start = time.perf_counter()
+    try:
+        return call()
+    finally:
+        elapsed = time.perf_counter() - start
+        DB_QUERY_LATENCY.observe(elapsed, name)
+        if slow_query_log.is_slow(elapsed):
+            slow_query_log.record(conn, name, sql, params, elapsed, rows)
+
+def execute(conn, name, sql, params=()):
+    """Run a named statement and return its cursor"""
+    return run_query(conn, name, sql, params, lambda: conn.execute(sql, params))
+
+def execute_many(conn, name, sql, rows):
+    rows = list(rows)
+    # A slow batch is explained with its first row's parameters
+    first = rows[0] if rows else ()
+    return run_query(conn, name, sql, first, lambda: conn.executemany(sql, rows), rows=len(rows))
+
+def fetch_one(conn, name, sql, params=()):
+    """Run a named query and return its first row, timing the fetch as well"""
+    return run_query(conn, name, sql, params, lambda: conn.execute(sql, params).fetchone())
+
+def fetch_all(conn, name, sql, params=()):
+    """Run a named query and return every row, timing the fetch as well"""
+    return run_query(conn, name, sql, params, lambda: conn.execute(sql, params).fetchall())
+
+def commit(conn):
+    with DB_COMMIT_LATENCY.time():
+        conn.commit()
+
+class DatabaseExecutor:
+    """Threads reserved for database calls made from async routes, one per pooled connection.
+
+    The thread pool is created on first use and dropped on shutdown, so a later
+    startup in the same process (a second TestClient, say) gets a fresh one.
+    """
+
+    def __init__(self, workers=DB_POOL_SIZE):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sweetshop-db")
+            return self._executor
+
+    async def run(self, call):
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), call)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+db_executor = DatabaseExecutor()
+
+async def run_db(func, *args):
+    """Await ``func(conn, *args)`` on a pooled connection without blocking the event loop"""
+    def call():
+        with get_db() as conn:
+            return func(conn, *args)
+    return await db_executor.run(call)
+
+def select_variant(sync_endpoint, async_endpoint):
+    """Pick the endpoint implementation for the configured request path (SWEETSHOP_ASYNC_DB)"""
+    return async_endpoint if ASYNC_DB else sync_endpoint
+
+@contextmanager
+def write_transaction(conn):
+    """Run a block inside BEGIN IMMEDIATE, committing on success and rolling back on error.
+
+    Taking the write lock up front means a transaction never has to upgrade
+    from a read lock halfway through, which is where SQLite deadlocks writers.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    commit(conn)
+
+class PeriodicTask:
+    """Run ``func`` every ``interval`` seconds on a daemon thread until stopped"""
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                logger.exception("Periodic task %s failed", self.name)
+
+class WriteQueue:
+    """Single writer thread that group-commits queued write jobs.
+
+    A job is ``func(conn, *args)``; jobs that leave the sweets table alone are
+    queued with ``catalog=False`` so they do not invalidate the catalog cache.
+    The writer takes the first waiting job, keeps
+    collecting for ``window`` seconds (or until ``max_batch`` jobs), and runs the
+    batch in one BEGIN IMMEDIATE transaction. Each job gets its own savepoint, so
+    a job that raises (say, insufficient stock) is undone alone and only its
+    caller sees the error. Everyone else shares a single commit.
+
+    The writer owns its connection instead of borrowing from the request pool, so
+    requests holding pooled connections while they wait can never starve it.
+    """
+
+    def __init__(self, window=WRITE_BATCH_WINDOW, max_batch=WRITE_BATCH_MAX):
+        self.window = window
+        self.max_batch = max_batch
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pool = None
+        self._batches = 0
+        self._committed = 0
+        self._failed = 0
+        self._largest_batch = 0
+        self._commit_total = 0.0
+
+    def submit(self, func, *args, catalog=True):
+        """Queue ``func(conn, *args)`` and return a Future for its result"""
+        future = Future()
+        self.start()
+        self._jobs.put((func, args, future, catalog))
+        return future
+
+    def run(self, func, *args, catalog=True):
+        return self.submit(func, *args, catalog=catalog).result()
+
+    async def run_async(self, func, *args, catalog=True):
+        return await asyncio.wrap_future(self.submit(func, *args, catalog=catalog))
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sweetshop-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Finish the queued jobs, then stop the writer and close its connection"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._jobs.put(None)
+            thread.join(timeout=10)
+
+    def _connection_pool(self):
+        if self._pool is None or self._pool.database != DATABASE:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = ConnectionPool(DATABASE, size=1)
+        return self._pool
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    return
+                self._commit(batch)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+    def _collect(self):
+        job = self._jobs.get()
+        if job is None:
+            return None
+        batch = [job]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            # Past the deadline keep draining whatever is already queued, but stop waiting
+            remaining = deadline - time.perf_counter()
+            try:
+                job = self._jobs.get(timeout=remaining) if remaining > 0 else self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                self._jobs.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _commit(self, batch):
+        outcomes = []
+        start = time.perf_counter()
+        try:
+            pool = self._connection_pool()
+            conn = pool.acquire()
+            try:
+                with write_transaction(conn):
+                    for func, args, future, catalog in batch:
+                        if not future.set_running_or_notify_cancel():
+                            continue
+                        conn.execute("SAVEPOINT write_job")
+                        try:
+                            result = func(conn, *args)
+                        except Exception as exc:
+                            conn.execute("ROLLBACK TO write_job")
+                            conn.execute("RELEASE write_job")
+                            outcomes.append((future, None, exc, catalog))
+                        else:
+                            conn.execute("RELEASE write_job")
+                            outcomes.append((future, result, None, catalog))
+            finally:
+                pool.release(conn)
+        except Exception as exc:
+            # BEGIN or COMMIT failed, so nothing in the batch was written
+            logger.exception("Write batch failed")
+            for _, _, future, _ in batch:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(exc)
+            return
+
+        WRITE_BATCH_SIZE.observe(len(batch))
+        committed = sum(1 for _, _, exc, _ in outcomes if exc is None)
+        if any(exc is None and catalog for _, _, exc, catalog in outcomes):
+            # One invalidation covers every committed job in the batch that changed sweets
+            catalog_cache.invalidate()
+        with self._lock:
+            self._batches += 1
+            self._committed += committed
+            self._failed += len(outcomes) - committed
+            self._largest_batch = max(self._largest_batch, len(batch))
+            self._commit_total += time.perf_counter() - start
+
+        for future, result, exc, _ in outcomes:
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+    def stats(self):
+        with self._lock:
+            jobs = self._committed + self._failed
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "pending": self._jobs.qsize(),
+                "batches": self._batches,
+                "committed": self._committed,
+                "failed": self._failed,
+                "avg_batch": round(jobs / self._batches, 2) if self._batches else 0.0,
+                "largest_batch": self._largest_batch,
+                "batch_avg_ms": round(self._commit_total / self._batches * 1000, 3) if self._batches else 0.0,
+            }
+
+write_queue = WriteQueue()
+
+last_checkpoint = {}
+
+def checkpoint_wal():
+    """Copy committed WAL frames back into the database without blocking readers or writers"""
+    if storage_profile()["journal_mode"].upper() != "WAL":
+        return None
+    with get_db() as conn:
+        busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    last_checkpoint.update({
+        "at": datetime.utcnow().isoformat(),
+        "busy": bool(busy),
+        "wal_pages": wal_pages,
+        "checkpointed_pages": checkpointed,
+    })
+    return last_checkpoint
+
+checkpoint_task = PeriodicTask("wal-checkpoint", DB_CHECKPOINT_INTERVAL, checkpoint_wal)
+
+# Schema migrations, applied in order by init_db(). PRAGMA user_version records
+# how many have run, so append new entries and never edit released ones.
+# Recompute the sales aggregates from purchases; used as the migration backfill and after bulk loads
+SALES_AGGREGATE_REBUILD = [
+    "DELETE FROM sales_daily",
+    """INSERT INTO sales_daily (day, sweet_id, units, revenue, purchases)
+       SELECT date(purchase_date), sweet_id, SUM(quantity), SUM(total_price), COUNT(*)
+       FROM purchases
+       GROUP BY date(purchase_date), sweet_id""",
+    "DELETE FROM sales_by_category",
+    """INSERT INTO sales_by_category (day, category, units, revenue, purchases)
+       SELECT date(p.purchase_date), COALESCE(s.category, ''), SUM(p.quantity), SUM(p.total_price), COUNT(*)
+       FROM purchases p
+       LEFT JOIN sweets s ON s.id = p.sweet_id
+       GROUP BY date(p.purchase_date), COALESCE(s.category, '')""",
+]
+
+MIGRATIONS = [
+    # 1: secondary indexes for the catalog, search and history listings
+    [
+        "CREATE INDEX IF NOT EXISTS idx_sweets_created_at ON sweets (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_sweets_category_price ON sweets (category, price)",
+        "CREATE INDEX IF NOT EXISTS idx_sweets_price ON sweets (price)",
+        "CREATE INDEX IF NOT EXISTS idx_purchases_user_date ON purchases (user_id, purchase_date)",
+        "CREATE INDEX IF NOT EXISTS idx_restock_history_date ON restock_history (restock_date)",
+    ],
+    # 2: full-text index over the catalog, kept in sync with sweets by triggers
+    [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS sweets_fts USING fts5(
+            name, description, category,
+            content='sweets', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS sweets_fts_insert AFTER INSERT ON sweets BEGIN
+            INSERT INTO sweets_fts (rowid, name, description, category)
+            VALUES (new.id, new.name, new.description, new.category);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS sweets_fts_delete AFTER DELETE ON sweets BEGIN
+            INSERT INTO sweets_fts (sweets_fts, rowid, name, description, category)
+            VALUES ('delete', old.id, old.name, old.description, old.category);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS sweets_fts_update AFTER UPDATE OF name, description, category ON sweets BEGIN
+            INSERT INTO sweets_fts (sweets_fts, rowid, name, description, category)
+            VALUES ('delete', old.id, old.name, old.description, old.category);
+            INSERT INTO sweets_fts (rowid, name, description, category)
+            VALUES (new.id, new.name, new.description, new.category);
+        END""",
+        "INSERT INTO sweets_fts (sweets_fts) VALUES ('rebuild')",
+    ],
+    # 3: date order over all purchases for admin reporting
+    [
+        "CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases (purchase_date)",
+    ],
+    # 4: daily sales per sweet and per category, kept up to date by a trigger on purchases.
+    # Purchases are append-only, so inserts are the only change to follow. A category
+    # row keeps the category the sweet had when it was sold.
+    [
+        """CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            sweet_id INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            revenue REAL NOT NULL,
+            purchases INTEGER NOT NULL,
+            PRIMARY KEY (day, sweet_id)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS sales_by_category (
+            day TEXT NOT NULL,
+            category TEXT NOT NULL,
+            units INTEGER NOT NULL,
+            revenue REAL NOT NULL,
+            purchases INTEGER NOT NULL,
+            PRIMARY KEY (day, category)
+        ) WITHOUT ROWID""",
+        """CREATE TRIGGER IF NOT EXISTS sales_aggregate_insert AFTER INSERT ON purchases BEGIN
+            INSERT INTO sales_daily (day, sweet_id, units, revenue, purchases)
+            VALUES (date(new.purchase_date), new.sweet_id, new.quantity, new.total_price, 1)
+            ON CONFLICT (day, sweet_id) DO UPDATE SET
+                units = units + excluded.units,
+                revenue = revenue + excluded.revenue,
+                purchases = purchases + 1;
+            INSERT INTO sales_by_category (day, category, units, revenue, purchases)
+            VALUES (
+                date(new.purchase_date),
+                COALESCE((SELECT category FROM sweets WHERE id = new.sweet_id), ''),
+                new.quantity, new.total_price, 1
+            )
+            ON CONFLICT (day, category) DO UPDATE SET
+                units = units + excluded.units,
+                revenue = revenue + excluded.revenue,
+                purchases = purchases + 1;
+        END""",
+        *SALES_AGGREGATE_REBUILD,
+    ],
+    # 5: per-sweet sell-through forecast, rewritten by the stock forecast task
+    [
+        """CREATE TABLE IF NOT EXISTS stock_forecast (
+            sweet_id INTEGER PRIMARY KEY,
+            quantity INTEGER NOT NULL,
+            daily_rate REAL NOT NULL,
+            days_to_stockout REAL,
+            stockout_date TEXT,
+            suggested_restock INTEGER NOT NULL,
+            refreshed_at TIMESTAMP NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_stock_forecast_days ON stock_forecast (days_to_stockout)",
+    ],
+    # 6: stock held for carts; the quantity has already been taken out of sweets.quantity
+    [
+        """CREATE TABLE IF NOT EXISTS reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            sweet_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (sweet_id) REFERENCES sweets (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations (user_id, expires_at)",
+    ],
+    # 7: responses of writes sent with an Idempotency-Key, per user
+    [
+        """CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            method TEXT NOT NULL,
+            path TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            body TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)",
+    ],
+]
+
+def migrate(conn):
+    """Bring the schema up to date by running every migration not yet applied"""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, statements in enumerate(MIGRATIONS[current:], start=current + 1):
+        with write_transaction(conn):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+        logger.info("Applied schema migration %s", version)
+
+def rebuild_sales_aggregates(conn):
+    """Recompute sales_daily and sales_by_category from every purchase"""
+    with write_transaction(conn):
+        for statement in SALES_AGGREGATE_REBUILD:
+            conn.execute(statement)
 
 def init_db():
     """Initialize database with all required tables"""
     with get_db() as conn:
         cursor = conn.cursor()
+        cursor.execute(f"PRAGMA journal_mode = {storage_profile()['journal_mode']}")
         
         # Users table
         cursor.execute("""
@@ -114,6 +1262,7 @@ def init_db():
         """)
         
         conn.commit()
+        migrate(conn)
         
         # Insert default admin user if not exists
         cursor.execute("SELECT * FROM users WHERE email = ?", ("admin@sweetshop.com",))
@@ -148,6 +1297,9 @@ def init_db():
             conn.commit()
             logger.info("Default sweets data populated")
 
+    catalog_cache.invalidate()
+    auth_cache.clear()
+
 # ==================== PYDANTIC MODELS ====================
 
 class UserRegister(BaseModel):
@@ -207,6 +1359,24 @@ class PurchaseRequest(BaseModel):
 class RestockRequest(BaseModel):
     quantity: int = Field(..., gt=0)
 
+class OrderItem(BaseModel):
+    sweet_id: int
+    quantity: int = Field(..., gt=0)
+
+class OrderRequest(BaseModel):
+    items: List[OrderItem] = Field(..., min_length=1, max_length=100)
+
+class ReservationRequest(BaseModel):
+    sweet_id: int
+    quantity: int = Field(..., gt=0)
+    ttl_seconds: Optional[int] = Field(None, gt=0, le=RESERVATION_MAX_TTL)
+
+class ReservationExtend(BaseModel):
+    ttl_seconds: Optional[int] = Field(None, gt=0, le=RESERVATION_MAX_TTL)
+
+class ReservationCommit(BaseModel):
+    reservation_ids: List[int] = Field(..., min_length=1, max_length=100)
+
 class SearchParams(BaseModel):
     name: Optional[str] = None
     category: Optional[str] = None
@@ -221,6 +1391,117 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordHasher:
+    """Bounded process pool for bcrypt work.
+
+    bcrypt holds a core for hundreds of milliseconds per call. Running it in
+    separate processes uses every core and keeps the request threadpool free
+    for catalog reads. At most ``queue_limit`` jobs may be pending; beyond
+    that callers are turned away with a 503 instead of queueing unboundedly.
+    """
+
+    def __init__(self, workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.respawns = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn rather than fork: forking a multi-threaded server can copy held locks
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self._pending >= self.queue_limit:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server is busy, please retry",
+                    headers={"Retry-After": "1"}
+                )
+            self._pending += 1
+        try:
+            try:
+                result = await self._run_in_pool(func, *args)
+            except BrokenProcessPool:
+                # A worker died (killed, out of memory), which breaks the whole pool; retry once on a fresh one
+                logger.warning("Password worker pool broke; starting a new one")
+                result = await self._run_in_pool(func, *args)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        else:
+            with self._lock:
+                self.completed += 1
+            return result
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    async def _run_in_pool(self, func, *args):
+        executor = self._get_executor()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            with self._lock:
+                # Another caller may already have replaced it
+                if self._executor is executor:
+                    self._executor = None
+                    self.respawns += 1
+            executor.shutdown(wait=False)
+            raise
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "pending": self._pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "respawns": self.respawns,
+            }
+
+password_hasher = PasswordHasher()
+
+def timed_call(func, *args):
+    """Run ``func`` in a worker process and report how long it took there"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+async def run_password_job(operation, func, *args):
+    start = time.perf_counter()
+    result, elapsed = await password_hasher.run(timed_call, func, *args)
+    PASSWORD_LATENCY.observe(elapsed, operation)
+    PASSWORD_WAIT.observe(max(time.perf_counter() - start - elapsed, 0.0), operation)
+    return result
+
+async def verify_password_async(plain_password, hashed_password):
+    return await run_password_job("verify", verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await run_password_job("hash", get_password_hash, password)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -235,324 +1516,2065 @@ def decode_token(token: str):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token or token has expired")
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+class AuthCache:
+    """Bounded LRU of verified tokens and the user record each one resolved to.
+
+    Entries are keyed by the token signature and expire after ``ttl`` seconds
+    or when the token itself expires, whichever comes first. The full token is
+    compared on lookup, so a forged payload reusing a cached signature misses.
+    """
+
+    def __init__(self, size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str):
+        key = token.rpartition(".")[2]
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not hmac.compare_digest(entry[0], token):
+                self.misses += 1
+                return None
+            _, user, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(user)
+
+    def put(self, token: str, user: dict, token_expires_at=None):
+        key = token.rpartition(".")[2]
+        expires_at = time.time() + self.ttl
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        with self._lock:
+            self._entries[key] = (token, dict(user), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        """Forget every token of a user, e.g. after their role or profile changes"""
+        with self._lock:
+            stale = [key for key, (_, user, _) in self._entries.items() if user["id"] == user_id]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+auth_cache = AuthCache()
+
+def load_user(conn, token: str):
+    """Verify a token, look its user up and remember the result in the auth cache"""
     payload = decode_token(token)
     user_id = payload.get("sub")
     
     if user_id is None:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
+    user = fetch_one(conn, "users.by_id", "SELECT * FROM users WHERE id = ?", (user_id,))
+
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+
+    user = dict(user)
+    auth_cache.put(token, user, payload.get("exp"))
+    return user
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Resolve the bearer token; only a cache miss checks out a connection, and only while loading"""
+    token = credentials.credentials
+    cached_user = auth_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+    # Not the request connection: write routes would hold it while they wait on the writer
     with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return dict(user)
+        return load_user(conn, token)
+
+async def get_current_user_async(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """get_current_user for async routes: a cache hit never leaves the event loop"""
+    token = credentials.credentials
+    cached_user = auth_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+    return await run_db(load_user, token)
 
 def get_admin_user(current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
-# ==================== API ROUTES ====================
+# ==================== CATALOG CACHE ====================
 
-@app.get("/")
-def read_root():
-    return {
-        "message": "Welcome to Sweet Shop Management System API",
-        "version": "1.0.0",
-        "documentation": "/docs"
-    }
+sweet_list_adapter = TypeAdapter(List[SweetResponse])
 
-# ==================== AUTH ENDPOINTS ====================
+# Distinguishes this process's catalog versions from those of earlier runs or other workers
+CATALOG_EPOCH = secrets.token_hex(4)
 
-@app.post("/api/auth/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def register(user: UserRegister):
-    """Register a new user"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # Check if user exists
-        cursor.execute("SELECT * FROM users WHERE email = ?", (user.email,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Email already registered")
-        
-        cursor.execute("SELECT * FROM users WHERE username = ?", (user.username,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Username already taken")
-        
-        # Create user
-        hashed_password = get_password_hash(user.password)
-        cursor.execute(
-            "INSERT INTO users (username, email, password, mobile, address) VALUES (?, ?, ?, ?, ?)",
-            (user.username, user.email, hashed_password, user.mobile, user.address)
-        )
-        conn.commit()
-        user_id = cursor.lastrowid
-        
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        new_user = cursor.fetchone()
-        
-        logger.info(f"New user registered: {user.email}")
-        return UserResponse(**dict(new_user))
+class CatalogCache:
+    """In-process cache of the serialized GET /api/sweets body.
 
-@app.post("/api/auth/login", response_model=Token)
-def login(user: UserLogin):
-    """Login user and return JWT token"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE email = ?", (user.email,))
-        db_user = cursor.fetchone()
-        
-        if not db_user or not verify_password(user.password, db_user["password"]):
-            raise HTTPException(status_code=401, detail="Invalid email or password")
-        
-        access_token = create_access_token(data={"sub": str(db_user["id"])})
-        logger.info(f"User logged in: {user.email}")
-        return Token(access_token=access_token, token_type="bearer", role=db_user["role"])
+    Every catalog write bumps ``version``, records the write time and drops
+    the body. A reader only stores the body it built if no write happened
+    while it was querying, so a slow reader can never put a stale catalog
+    back into the cache. Each worker process keeps its own copy.
+    """
 
-@app.get("/api/auth/me", response_model=UserResponse)
-def get_me(current_user: dict = Depends(get_current_user)):
-    """Get current user information"""
-    return UserResponse(**current_user)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self.last_modified = time.time()
+        self._body = None
+        self.hits = 0
+        self.misses = 0
 
-# ==================== SWEETS ENDPOINTS ====================
+    def lookup(self):
+        """Return ``(body, version, last_modified)``; ``body`` is None on a miss"""
+        with self._lock:
+            if self._body is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return self._body, self.version, self.last_modified
 
-@app.get("/api/sweets", response_model=List[SweetResponse])
-def get_sweets():
-    """Get all sweets"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM sweets ORDER BY created_at DESC")
-        sweets = cursor.fetchall()
-        return [SweetResponse(**dict(sweet)) for sweet in sweets]
+    def validators(self):
+        """Return ``(version, last_modified)`` without touching the hit/miss counters"""
+        with self._lock:
+            return self.version, self.last_modified
 
-@app.get("/api/sweets/search", response_model=List[SweetResponse])
-def search_sweets(
-    name: Optional[str] = None,
-    category: Optional[str] = None,
-    min_price: Optional[float] = None,
-    max_price: Optional[float] = None
+    def store(self, body, version):
+        with self._lock:
+            if version == self.version:
+                self._body = body
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self.last_modified = time.time()
+            self._body = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self.version,
+                "cached": self._body is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+catalog_cache = CatalogCache()
+
+def catalog_headers(version, last_modified):
+    """Validators for a response built from the given catalog version"""
+    headers = {"ETag": f'"{CATALOG_EPOCH}-{version}"', "Cache-Control": "no-cache"}
+    # HTTP dates only have one-second resolution, so a Last-Modified from the
+    # current second could hide a later write in that same second
+    if time.time() - last_modified >= 1:
+        headers["Last-Modified"] = formatdate(int(last_modified), usegmt=True)
+    return headers
+
+def is_not_modified(request: Request, headers: dict):
+    """Evaluate If-None-Match (preferred) or If-Modified-Since against our validators"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = headers["ETag"]
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "Last-Modified" in headers:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # The Last-Modified being sent, not the cache's current one, which may have moved on since
+        return parsedate_to_datetime(headers["Last-Modified"]).timestamp() <= since
+    return False
+
+# ==================== PAGINATION ====================
+
+def encode_cursor(*values):
+    """Opaque cursor holding the sort key of the last row on a page"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, width: int):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        values = None
+    if not isinstance(values, list) or len(values) != width:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def page_params(limit: Optional[int], cursor: Optional[str], width: int):
+    """Resolve the query parameters of a list endpoint into ``(limit, after)``.
+
+    Without ``limit`` or ``cursor`` the endpoint returns every row, as it
+    always has; a cursor on its own pages with the default size.
+    """
+    if cursor is None:
+        return limit, None
+    return limit or DEFAULT_PAGE_SIZE, decode_cursor(cursor, width)
+
+def keyset_query(query, params, order, after=None, limit=None):
+    """Append keyset pagination to a query that already ends in a WHERE clause.
+
+    ``order`` lists the sort columns (all descending, unique together) and
+    ``after`` holds their values on the last row already returned. Rows
+    inserted meanwhile sort before the cursor, so pages never repeat or skip
+    a row. One extra row is fetched to tell whether another page exists.
+    """
+    params = list(params)
+    if after is not None:
+        query += f" AND ({', '.join(order)}) < ({', '.join('?' * len(order))})"
+        params.extend(after)
+    query += " ORDER BY " + ", ".join(f"{column} DESC" for column in order)
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+    return query, params
+
+def paginate(rows, limit, key, headers):
+    """Trim the look-ahead row and put the cursor for the next page into ``headers``"""
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(*key(rows[-1]))
+    return rows
+
+# ==================== STREAMING ====================
+
+def wants_stream(request: Request, stream: bool):
+    """True if the client asked for NDJSON via ?stream=1 or the Accept header"""
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def stream_rows(conn, name, query, params):
+    """Yield query results as NDJSON, pulling STREAM_BATCH_SIZE rows at a time.
+
+    ``conn`` is the request's connection. The generator keeps reading after the
+    route has returned, which is safe because yield dependencies are only torn
+    down once the response has been sent. Memory stays flat however many rows match.
+    """
+    cursor = execute(conn, name, query, params)
+    while True:
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        yield "".join(json.dumps(dict(row)) + "\n" for row in rows)
+
+def ndjson_response(conn, name, query, params):
+    return StreamingResponse(stream_rows(conn, name, query, params), media_type=NDJSON_MEDIA_TYPE)
+
+# ==================== PROFILING ====================
+
+class RequestProfile:
+    """cProfile data for one request, merged from every thread that worked on it"""
+
+    def __init__(self, profile_id, method, path, trigger):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.route = None
+        self.status = None
+        self.duration_ms = None
+        self.at = datetime.utcnow().isoformat()
+        self._lock = threading.Lock()
+        self._stats = None
+
+    def add(self, profiler):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def report(self, sort="cumulative", limit=50):
+        with self._lock:
+            if self._stats is None:
+                return "No profile data was captured for this request\n"
+            out = io.StringIO()
+            self._stats.stream = out
+            self._stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "duration_ms": self.duration_ms,
+            "trigger": self.trigger,
+            "at": self.at,
+        }
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+_profiling = threading.local()
+
+def profile_call(profile, func, *args, **kwargs):
+    """Run ``func`` under a cProfile for this thread, unless the thread is already profiled"""
+    if getattr(_profiling, "active", False):
+        return func(*args, **kwargs)
+    profiler = cProfile.Profile()
+    _profiling.active = True
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        _profiling.active = False
+        profile.add(profiler)
+
+async def profile_await(profile, func, *args):
+    """Profile the event loop thread while ``func`` runs.
+
+    Other requests interleaving on the loop show up too, so read async
+    profiles as "what the loop was doing" rather than this request alone.
+    """
+    if getattr(_profiling, "active", False):
+        return await func(*args)
+    profiler = cProfile.Profile()
+    _profiling.active = True
+    profiler.enable()
+    try:
+        return await func(*args)
+    finally:
+        profiler.disable()
+        _profiling.active = False
+        profile.add(profiler)
+
+class ProfiledRoute(APIRoute):
+    """APIRoute that profiles its handler when the request carries an active profile.
+
+    The handler runs on the event loop; a sync endpoint runs in a threadpool
+    worker, which gets its own profiler. Both are merged into one report.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        endpoint = self.dependant.call
+        if not is_coroutine_callable(endpoint):
+            def profiled_endpoint(**values):
+                profile = current_profile.get()
+                if profile is None:
+                    return endpoint(**values)
+                return profile_call(profile, endpoint, **values)
+            self.dependant.call = profiled_endpoint
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request):
+            profile = current_profile.get()
+            if profile is None:
+                return await handler(request)
+            profile.route = self.path
+            return await profile_await(profile, handler, request)
+
+        return profiled_handler
+
+app.router.route_class = ProfiledRoute
+
+class ProfileStore:
+    """The most recent request profiles, oldest dropped first"""
+
+    def __init__(self, size=PROFILE_STORE_SIZE, sample_rate=PROFILE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._profiles = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._captured = 0
+
+    def start(self, method, path, trigger):
+        return RequestProfile(next(self._ids), method, path, trigger)
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles.append(profile)
+            self._captured += 1
+
+    def get(self, profile_id):
+        with self._lock:
+            return next((profile for profile in self._profiles if profile.id == profile_id), None)
+
+    def list(self):
+        with self._lock:
+            return [profile.summary() for profile in reversed(self._profiles)]
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"sample_rate": self.sample_rate, "stored": len(self._profiles), "captured": self._captured}
+
+profile_store = ProfileStore()
+
+def is_admin_token(token: str):
+    user = auth_cache.get(token)
+    if user is None:
+        try:
+            with get_db() as conn:
+                user = load_user(conn, token)
+        except HTTPException:
+            return False
+    return user["role"] == "admin"
+
+class ProfilingMiddleware:
+    """ASGI middleware that starts a profile for admin-requested or sampled requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def trigger(self, scope):
+        headers = dict(scope["headers"])
+        if PROFILE_HEADER.lower().encode() in headers:
+            scheme, _, token = headers.get(b"authorization", b"").decode().partition(" ")
+            if scheme.lower() == "bearer" and token and await run_in_threadpool(is_admin_token, token):
+                return "header"
+        if profile_store.sample_rate and random.random() < profile_store.sample_rate:
+            return "sampled"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trigger = await self.trigger(scope)
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = profile_store.start(scope["method"], scope["path"], trigger)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (PROFILE_ID_HEADER.lower().encode(), str(profile.id).encode())
+                ]
+            await send(message)
+
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            profile.duration_ms = round((time.perf_counter() - start) * 1000, 3)
+            profile_store.add(profile)
+            logger.info("Profiled %s %s as profile %s (%s)", profile.method, profile.path, profile.id, trigger)
+
+app.add_middleware(ProfilingMiddleware)
+
+# ==================== IDEMPOTENCY ====================
+# A client that retries a write sends the same Idempotency-Key header each
+# time. The first request to finish stores its response under (user, key);
+# later ones get that response back with Idempotent-Replayed: true and never
+# reach stock. Keys are checked and stored inside the writer job, so two
+# copies racing each other are serialized and only one runs. Failed requests
+# are not stored and can be retried.
+
+class IdempotencyStore:
+    """Bounded LRU in front of the idempotency_keys table.
+
+    Holds ``(request_hash, body, expires_at)`` for recently stored keys so a
+    retry can be answered without queueing a write. Entries are only added
+    after the write that stored them has committed.
+    """
+
+    def __init__(self, size=IDEMPOTENCY_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.replays = 0
+        self.conflicts = 0
+        self.purged = 0
+
+    def get(self, user_id: int, key: str):
+        with self._lock:
+            entry = self._entries.get((user_id, key))
+            if entry is None or entry[2] <= time.time():
+                self.misses += 1
+                return None
+            self._entries.move_to_end((user_id, key))
+            self.hits += 1
+            return entry
+
+    def put(self, user_id: int, key: str, entry):
+        with self._lock:
+            self._entries[(user_id, key)] = entry
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.size,
+                "ttl": IDEMPOTENCY_TTL,
+                "hits": self.hits,
+                "misses": self.misses,
+                "replays": self.replays,
+                "conflicts": self.conflicts,
+                "purged": self.purged,
+            }
+
+idempotency_store = IdempotencyStore()
+
+class IdempotentRequest:
+    """A write request sent with an Idempotency-Key, fingerprinted by method, path and body"""
+
+    def __init__(self, key: str, user: dict, request: Request, payload: BaseModel, response: Response):
+        if not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH or not key.isprintable():
+            raise HTTPException(
+                status_code=400,
+                detail=f"Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX_LENGTH} printable characters"
+            )
+        self.key = key
+        self.user_id = user["id"]
+        self.method = request.method
+        self.path = request.url.path
+        self.response = response
+        fingerprint = f"{self.method} {self.path}\n{payload.model_dump_json()}"
+        self.request_hash = hashlib.sha256(fingerprint.encode()).hexdigest()
+
+    def run(self, conn, func, *args):
+        """Write job: ``func(conn, *args)`` unless this key already has a stored response.
+
+        Returns ``(request_hash, body, expires_at, result)``; ``result`` is None
+        when the stored response is being replayed.
+        """
+        now = time.time()
+        stored = fetch_one(
+            conn,
+            "idempotency.lookup",
+            "SELECT request_hash, body, expires_at FROM idempotency_keys WHERE user_id = ? AND key = ? AND expires_at > ?",
+            (self.user_id, self.key, now)
+        )
+        if stored:
+            return stored["request_hash"], stored["body"], stored["expires_at"], None
+
+        result = func(conn, *args)
+        body = json.dumps(jsonable_encoder(result))
+        expires_at = now + IDEMPOTENCY_TTL
+        execute(
+            conn,
+            "idempotency.store",
+            """INSERT OR REPLACE INTO idempotency_keys
+                   (user_id, key, method, path, request_hash, body, created_at, expires_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (self.user_id, self.key, self.method, self.path, self.request_hash, body, now, expires_at)
+        )
+        return self.request_hash, body, expires_at, result
+
+    def finish(self, outcome):
+        """Remember the stored response and turn it into ``(result, replayed)``"""
+        request_hash, body, expires_at, result = outcome
+        if request_hash != self.request_hash:
+            idempotency_store.conflicts += 1
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        idempotency_store.put(self.user_id, self.key, (request_hash, body, expires_at, None))
+        if result is not None:
+            return result, False
+        idempotency_store.replays += 1
+        self.response.headers[IDEMPOTENT_REPLAY_HEADER] = "true"
+        return json.loads(body), True
+
+def idempotent_request(key: Optional[str], user: dict, request: Request, payload: BaseModel, response: Response):
+    return None if key is None else IdempotentRequest(key, user, request, payload, response)
+
+def run_write(idempotent: Optional[IdempotentRequest], func, *args):
+    """Run a write job through the queue, at most once per Idempotency-Key; returns ``(result, replayed)``"""
+    if idempotent is None:
+        return write_queue.run(func, *args), False
+    outcome = idempotency_store.get(idempotent.user_id, idempotent.key)
+    if outcome is None:
+        outcome = write_queue.run(idempotent.run, func, *args)
+    return idempotent.finish(outcome)
+
+async def run_write_async(idempotent: Optional[IdempotentRequest], func, *args):
+    """Async variant of run_write"""
+    if idempotent is None:
+        return await write_queue.run_async(func, *args), False
+    outcome = idempotency_store.get(idempotent.user_id, idempotent.key)
+    if outcome is None:
+        outcome = await write_queue.run_async(idempotent.run, func, *args)
+    return idempotent.finish(outcome)
+
+def purge_idempotency_keys(conn):
+    """Write job: drop expired keys, then the oldest beyond IDEMPOTENCY_MAX_KEYS"""
+    expired = execute(
+        conn, "idempotency.purge_expired", "DELETE FROM idempotency_keys WHERE expires_at <= ?", (time.time(),)
+    ).rowcount
+    overflow = execute(
+        conn,
+        "idempotency.purge_overflow",
+        """DELETE FROM idempotency_keys WHERE expires_at < (
+               SELECT expires_at FROM idempotency_keys ORDER BY expires_at DESC LIMIT 1 OFFSET ?
+           )""",
+        (IDEMPOTENCY_MAX_KEYS - 1,)
+    ).rowcount
+    return expired + overflow
+
+def purge_idempotency():
+    purged = write_queue.run(purge_idempotency_keys, catalog=False)
+    idempotency_store.purged += purged
+    if purged:
+        logger.info("Purged %s idempotency keys", purged)
+    return purged
+
+idempotency_purge_task = PeriodicTask("idempotency-purge", IDEMPOTENCY_PURGE_INTERVAL, purge_idempotency)
+
+# ==================== API ROUTES ====================
+
+@app.get("/")
+def read_root():
+    return {
+        "message": "Welcome to Sweet Shop Management System API",
+        "version": "1.0.0",
+        "documentation": "/docs"
+    }
+
+# ==================== AUTH ENDPOINTS ====================
+
+# Login and registration are async so that waiting on bcrypt occupies neither a
+# threadpool worker nor a pooled connection; only the short queries go to threads.
+
+def ensure_user_available(conn, user: UserRegister):
+    # Check if user exists
+    if fetch_one(conn, "users.by_email", "SELECT * FROM users WHERE email = ?", (user.email,)):
+        raise HTTPException(status_code=400, detail="Email already registered")
+
+    if fetch_one(conn, "users.by_username", "SELECT * FROM users WHERE username = ?", (user.username,)):
+        raise HTTPException(status_code=400, detail="Username already taken")
+
+def check_user_available(user: UserRegister):
+    with get_db() as conn:
+        ensure_user_available(conn, user)
+
+def insert_user(user: UserRegister, hashed_password: str):
+    with get_db() as conn:
+        try:
+            cursor = execute(
+                conn,
+                "users.insert",
+                "INSERT INTO users (username, email, password, mobile, address) VALUES (?, ?, ?, ?, ?)",
+                (user.username, user.email, hashed_password, user.mobile, user.address)
+            )
+        except sqlite3.IntegrityError:
+            # Someone registered the same email or username while we were hashing.
+            # Check on this connection: taking a second one while holding it can exhaust the pool
+            conn.rollback()
+            ensure_user_available(conn, user)
+            raise
+        commit(conn)
+        user_id = cursor.lastrowid
+
+        return dict(fetch_one(conn, "users.by_id", "SELECT * FROM users WHERE id = ?", (user_id,)))
+
+def find_user_by_email(email: str):
+    with get_db() as conn:
+        db_user = fetch_one(conn, "users.by_email", "SELECT * FROM users WHERE email = ?", (email,))
+        return dict(db_user) if db_user else None
+
+@app.post("/api/auth/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
+async def register(user: UserRegister):
+    """Register a new user"""
+    await run_in_threadpool(check_user_available, user)
+
+    # Create user
+    hashed_password = await get_password_hash_async(user.password)
+    new_user = await run_in_threadpool(insert_user, user, hashed_password)
+
+    logger.info("New user registered: %s", user.email)
+    return UserResponse(**new_user)
+
+@app.post("/api/auth/login", response_model=Token)
+async def login(user: UserLogin):
+    """Login user and return JWT token"""
+    db_user = await run_in_threadpool(find_user_by_email, user.email)
+
+    if not db_user or not await verify_password_async(user.password, db_user["password"]):
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+
+    access_token = create_access_token(data={"sub": str(db_user["id"])})
+    logger.info("User logged in: %s", user.email)
+    return Token(access_token=access_token, token_type="bearer", role=db_user["role"])
+
+@app.get("/api/auth/me", response_model=UserResponse)
+def get_me(current_user: dict = Depends(get_current_user)):
+    """Get current user information"""
+    return UserResponse(**current_user)
+
+# ==================== SWEETS ENDPOINTS ====================
+
+SWEETS_ORDER = ("s.created_at", "s.id")
+
+def sweet_sort_key(sweet):
+    return sweet["created_at"], sweet["id"]
+
+def build_sweets_query(after=None, limit=None):
+    """Build the catalog listing query, newest first"""
+    return keyset_query("SELECT s.* FROM sweets s WHERE 1=1", [], SWEETS_ORDER, after, limit)
+
+# bm25 column weights for sweets_fts (name, description, category): a hit in the name counts most
+SEARCH_RANKING = "bm25(sweets_fts, 10.0, 1.0, 4.0)"
+
+def fts_match_expression(text):
+    """Turn free text into an FTS5 query in which every word must match as a prefix"""
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+def build_search_query(name=None, category=None, min_price=None, max_price=None, after=None, limit=None):
+    """Build the search_sweets query and its parameters from the supplied filters.
+
+    A full result is ranked by relevance; pages are ordered newest first,
+    because relevance scores shift as the catalog changes and would make
+    cursors unstable.
+    """
+    match = fts_match_expression(name) if name else ""
+    params = []
+
+    if match:
+        # Name search goes through the full-text index and covers name, description and category
+        query = """SELECT s.* FROM sweets_fts
+                   JOIN sweets s ON s.id = sweets_fts.rowid
+                   WHERE sweets_fts MATCH ?"""
+        params.append(match)
+    elif name:
+        # A name with no words in it (say "!!!") can match nothing; it must not drop the filter
+        query = "SELECT s.* FROM sweets s WHERE 0"
+    else:
+        query = "SELECT s.* FROM sweets s WHERE 1=1"
+
+    if category:
+        query += " AND s.category = ?"
+        params.append(category)
+
+    if min_price is not None:
+        query += " AND s.price >= ?"
+        params.append(min_price)
+
+    if max_price is not None:
+        query += " AND s.price <= ?"
+        params.append(max_price)
+
+    if match and limit is None:
+        query += f" ORDER BY {SEARCH_RANKING}, s.created_at DESC, s.id DESC"
+        return query, params
+    return keyset_query(query, params, SWEETS_ORDER, after, limit)
+
+# The catalog, search, sweet and purchase endpoints come in two flavours with the
+# same behaviour: plain functions run by FastAPI's threadpool, and async functions
+# that stay on the event loop (cache hits, 304s) and send queries to db_executor.
+
+def dump_sweets(sweets):
+    return sweet_list_adapter.dump_json(sweet_list_adapter.validate_python([dict(sweet) for sweet in sweets]))
+
+def load_catalog_body(conn):
+    return dump_sweets(fetch_all(conn, "sweets.catalog", *build_sweets_query()))
+
+def fetch_sweet(conn, sweet_id: int):
+    sweet = fetch_one(conn, "sweets.by_id", "SELECT * FROM sweets WHERE id = ?", (sweet_id,))
+
+    if not sweet:
+        raise HTTPException(status_code=404, detail="Sweet not found")
+
+    return dict(sweet)
+
+def get_sweets(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Get all sweets, or one page of them when limit/cursor is given"""
+    version, last_modified = catalog_cache.validators()
+    headers = catalog_headers(version, last_modified)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    limit, after = page_params(limit, cursor, len(SWEETS_ORDER))
+    if limit is not None:
+        sweets = paginate(fetch_all(conn, "sweets.page", *build_sweets_query(after, limit)), limit, sweet_sort_key, headers)
+        return Response(content=dump_sweets(sweets), media_type="application/json", headers=headers)
+
+    body, version, last_modified = catalog_cache.lookup()
+    if body is None:
+        body = load_catalog_body(conn)
+        catalog_cache.store(body, version)
+    return Response(content=body, media_type="application/json", headers=catalog_headers(version, last_modified))
+
+async def get_sweets_async(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Get all sweets, or one page of them when limit/cursor is given"""
+    version, last_modified = catalog_cache.validators()
+    headers = catalog_headers(version, last_modified)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    limit, after = page_params(limit, cursor, len(SWEETS_ORDER))
+    if limit is not None:
+        rows = await run_db(fetch_all, "sweets.page", *build_sweets_query(after, limit))
+        sweets = paginate(rows, limit, sweet_sort_key, headers)
+        return Response(content=dump_sweets(sweets), media_type="application/json", headers=headers)
+
+    body, version, last_modified = catalog_cache.lookup()
+    if body is None:
+        body = await run_db(load_catalog_body)
+        catalog_cache.store(body, version)
+    return Response(content=body, media_type="application/json", headers=catalog_headers(version, last_modified))
+
+app.get("/api/sweets", response_model=List[SweetResponse])(select_variant(get_sweets, get_sweets_async))
+
+def search_sweets(
+    request: Request,
+    response: Response,
+    name: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    conn: sqlite3.Connection = Depends(get_connection)
 ):
     """Search sweets by name, category, or price range"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        query = "SELECT * FROM sweets WHERE 1=1"
-        params = []
-        
-        if name:
-            query += " AND name LIKE ?"
-            params.append(f"%{name}%")
-        
-        if category:
-            query += " AND category = ?"
-            params.append(category)
-        
-        if min_price is not None:
-            query += " AND price >= ?"
-            params.append(min_price)
-        
-        if max_price is not None:
-            query += " AND price <= ?"
-            params.append(max_price)
-        
-        query += " ORDER BY created_at DESC"
-        
-        cursor.execute(query, params)
-        sweets = cursor.fetchall()
-        return [SweetResponse(**dict(sweet)) for sweet in sweets]
+    headers = catalog_headers(*catalog_cache.validators())
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-@app.get("/api/sweets/{sweet_id}", response_model=SweetResponse)
-def get_sweet(sweet_id: int):
+    limit, after = page_params(limit, cursor, len(SWEETS_ORDER))
+    query, params = build_search_query(name, category, min_price, max_price, after, limit)
+    sweets = paginate(fetch_all(conn, "sweets.search", query, params), limit, sweet_sort_key, headers)
+    response.headers.update(headers)
+    return [SweetResponse(**dict(sweet)) for sweet in sweets]
+
+async def search_sweets_async(
+    request: Request,
+    response: Response,
+    name: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Search sweets by name, category, or price range"""
+    headers = catalog_headers(*catalog_cache.validators())
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    limit, after = page_params(limit, cursor, len(SWEETS_ORDER))
+    query, params = build_search_query(name, category, min_price, max_price, after, limit)
+    sweets = paginate(await run_db(fetch_all, "sweets.search", query, params), limit, sweet_sort_key, headers)
+    response.headers.update(headers)
+    return [SweetResponse(**dict(sweet)) for sweet in sweets]
+
+app.get("/api/sweets/search", response_model=List[SweetResponse])(select_variant(search_sweets, search_sweets_async))
+
+def get_sweet(
+    sweet_id: int,
+    request: Request,
+    response: Response,
+    conn: sqlite3.Connection = Depends(get_connection)
+):
     """Get a specific sweet by ID"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM sweets WHERE id = ?", (sweet_id,))
-        sweet = cursor.fetchone()
-        
-        if not sweet:
-            raise HTTPException(status_code=404, detail="Sweet not found")
-        
-        return SweetResponse(**dict(sweet))
+    # Validators first, so a concurrent write can only make them older than the row, never newer
+    headers = catalog_headers(*catalog_cache.validators())
+    # A missing sweet is a 404 whatever validators the client sends
+    sweet = fetch_sweet(conn, sweet_id)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return SweetResponse(**sweet)
+
+async def get_sweet_async(sweet_id: int, request: Request, response: Response):
+    """Get a specific sweet by ID"""
+    # Validators first, so a concurrent write can only make them older than the row, never newer
+    headers = catalog_headers(*catalog_cache.validators())
+    # A missing sweet is a 404 whatever validators the client sends
+    sweet = await run_db(fetch_sweet, sweet_id)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return SweetResponse(**sweet)
+
+app.get("/api/sweets/{sweet_id}", response_model=SweetResponse)(select_variant(get_sweet, get_sweet_async))
+
+def apply_create_sweet(conn, sweet: SweetCreate):
+    """Write job: insert a sweet and return its row"""
+    new_sweet = fetch_one(
+        conn,
+        "sweets.insert",
+        """INSERT INTO sweets (name, category, price, quantity, description, img) 
+           VALUES (?, ?, ?, ?, ?, ?)
+           RETURNING *""",
+        (sweet.name, sweet.category, sweet.price, sweet.quantity, sweet.description, sweet.img)
+    )
+    return dict(new_sweet)
 
 @app.post("/api/sweets", response_model=SweetResponse, status_code=status.HTTP_201_CREATED)
-def create_sweet(sweet: SweetCreate, admin: dict = Depends(get_admin_user)):
+def create_sweet(
+    sweet: SweetCreate,
+    request: Request,
+    response: Response,
+    admin: dict = Depends(get_admin_user),
+    idempotency_key: Optional[str] = Header(None)
+):
     """Create a new sweet (Admin only)"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            """INSERT INTO sweets (name, category, price, quantity, description, img) 
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (sweet.name, sweet.category, sweet.price, sweet.quantity, sweet.description, sweet.img)
-        )
-        conn.commit()
-        sweet_id = cursor.lastrowid
-        
-        cursor.execute("SELECT * FROM sweets WHERE id = ?", (sweet_id,))
-        new_sweet = cursor.fetchone()
-        
-        logger.info(f"New sweet created: {sweet.name} by admin {admin['username']}")
-        return SweetResponse(**dict(new_sweet))
+    idempotent = idempotent_request(idempotency_key, admin, request, sweet, response)
+    new_sweet, replayed = run_write(idempotent, apply_create_sweet, sweet)
+    if not replayed:
+        logger.info("New sweet created: %s by admin %s", sweet.name, admin["username"])
+    return SweetResponse(**new_sweet)
+
+def apply_update_sweet(conn, sweet_id: int, update_data: dict):
+    """Write job: change the given fields of a sweet and return its row"""
+    if update_data:
+        update_data = {**update_data, "updated_at": datetime.utcnow().isoformat()}
+        set_clause = ", ".join([f"{key} = ?" for key in update_data.keys()])
+        values = list(update_data.values()) + [sweet_id]
+        execute(conn, "sweets.update", f"UPDATE sweets SET {set_clause} WHERE id = ?", values)
+
+    updated_sweet = fetch_one(conn, "sweets.by_id", "SELECT * FROM sweets WHERE id = ?", (sweet_id,))
+    if not updated_sweet:
+        raise HTTPException(status_code=404, detail="Sweet not found")
+    return dict(updated_sweet)
 
 @app.put("/api/sweets/{sweet_id}", response_model=SweetResponse)
 def update_sweet(sweet_id: int, sweet: SweetUpdate, admin: dict = Depends(get_admin_user)):
     """Update sweet details (Admin only)"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM sweets WHERE id = ?", (sweet_id,))
-        existing_sweet = cursor.fetchone()
-        
-        if not existing_sweet:
-            raise HTTPException(status_code=404, detail="Sweet not found")
-        
-        update_data = sweet.dict(exclude_unset=True)
-        if update_data:
-            update_data["updated_at"] = datetime.utcnow().isoformat()
-            set_clause = ", ".join([f"{key} = ?" for key in update_data.keys()])
-            values = list(update_data.values()) + [sweet_id]
-            cursor.execute(f"UPDATE sweets SET {set_clause} WHERE id = ?", values)
-            conn.commit()
-        
-        cursor.execute("SELECT * FROM sweets WHERE id = ?", (sweet_id,))
-        updated_sweet = cursor.fetchone()
-        
-        logger.info(f"Sweet updated: {sweet_id} by admin {admin['username']}")
-        return SweetResponse(**dict(updated_sweet))
+    update_data = sweet.dict(exclude_unset=True)
+    updated_sweet = write_queue.run(apply_update_sweet, sweet_id, update_data, catalog=bool(update_data))
+
+    logger.info("Sweet updated: %s by admin %s", sweet_id, admin["username"])
+    return SweetResponse(**updated_sweet)
+
+def apply_delete_sweet(conn, sweet_id: int):
+    """Write job: delete a sweet along with the reservations holding it; returns their ids"""
+    rows = fetch_all(
+        conn,
+        "sweets.delete_reservations",
+        "DELETE FROM reservations WHERE sweet_id = ? RETURNING id",
+        (sweet_id,)
+    )
+    deleted = fetch_all(conn, "sweets.delete", "DELETE FROM sweets WHERE id = ? RETURNING id", (sweet_id,))
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Sweet not found")
+    return [row["id"] for row in rows]
 
 @app.delete("/api/sweets/{sweet_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_sweet(sweet_id: int, admin: dict = Depends(get_admin_user)):
     """Delete a sweet (Admin only)"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM sweets WHERE id = ?", (sweet_id,))
-        sweet = cursor.fetchone()
-        
-        if not sweet:
-            raise HTTPException(status_code=404, detail="Sweet not found")
-        
-        cursor.execute("DELETE FROM sweets WHERE id = ?", (sweet_id,))
-        conn.commit()
-        
-        logger.info(f"Sweet deleted: {sweet_id} by admin {admin['username']}")
+    reservation_book.ensure_loaded()
+    released = write_queue.run(apply_delete_sweet, sweet_id)
+    reservation_book.remove(released, "released")
+
+    logger.info("Sweet deleted: %s by admin %s", sweet_id, admin["username"])
 
 # ==================== INVENTORY ENDPOINTS ====================
 
-@app.post("/api/sweets/{sweet_id}/purchase")
-def purchase_sweet(sweet_id: int, purchase: PurchaseRequest, current_user: dict = Depends(get_current_user)):
+def raise_stock_error(conn, sweet_id: int):
+    """Explain why a conditional stock decrement matched no row"""
+    sweet = fetch_one(conn, "purchase.check_stock", "SELECT quantity FROM sweets WHERE id = ?", (sweet_id,))
+    if not sweet:
+        raise HTTPException(status_code=404, detail="Sweet not found")
+    raise HTTPException(status_code=400, detail=f"Insufficient stock. Only {sweet['quantity']} available")
+
+def apply_purchase(conn, current_user: dict, sweet_id: int, purchase: PurchaseRequest):
+    """Write job: decrement stock and record the purchase"""
+    # Check and decrement stock in one statement so concurrent buyers cannot oversell
+    rows = fetch_all(
+        conn,
+        "purchase.decrement_stock",
+        """UPDATE sweets SET quantity = quantity - ?, updated_at = ?
+           WHERE id = ? AND quantity >= ?
+           RETURNING name, price, quantity""",
+        (purchase.quantity, datetime.utcnow().isoformat(), sweet_id, purchase.quantity)
+    )
+
+    if not rows:
+        raise_stock_error(conn, sweet_id)
+
+    sweet = rows[0]
+
+    # Record purchase
+    total_price = sweet["price"] * purchase.quantity
+    execute(
+        conn,
+        "purchase.insert",
+        """INSERT INTO purchases (user_id, sweet_id, quantity, total_price) 
+           VALUES (?, ?, ?, ?)""",
+        (current_user["id"], sweet_id, purchase.quantity, total_price)
+    )
+
+    return {
+        "message": "Purchase successful",
+        "sweet_name": sweet["name"],
+        "quantity_purchased": purchase.quantity,
+        "total_price": total_price,
+        "remaining_stock": sweet["quantity"]
+    }
+
+def purchase_sweet(
+    sweet_id: int,
+    purchase: PurchaseRequest,
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
     """Purchase a sweet, decreasing its quantity"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM sweets WHERE id = ?", (sweet_id,))
-        sweet = cursor.fetchone()
-        
+    idempotent = idempotent_request(idempotency_key, current_user, request, purchase, response)
+    result, replayed = run_write(idempotent, apply_purchase, current_user, sweet_id, purchase)
+    if not replayed:
+        logger.info("Purchase made: %sx %s by %s", purchase.quantity, result["sweet_name"], current_user["username"])
+    return result
+
+async def purchase_sweet_async(
+    sweet_id: int,
+    purchase: PurchaseRequest,
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(get_current_user_async),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Purchase a sweet, decreasing its quantity"""
+    idempotent = idempotent_request(idempotency_key, current_user, request, purchase, response)
+    result, replayed = await run_write_async(idempotent, apply_purchase, current_user, sweet_id, purchase)
+    if not replayed:
+        logger.info("Purchase made: %sx %s by %s", purchase.quantity, result["sweet_name"], current_user["username"])
+    return result
+
+app.post("/api/sweets/{sweet_id}/purchase")(select_variant(purchase_sweet, purchase_sweet_async))
+
+def apply_order(conn, current_user: dict, order: OrderRequest):
+    """Write job: purchase a whole cart; either every line succeeds or none does"""
+    # A cart may list the same sweet more than once, so check stock against the combined amount
+    requested = {}
+    for item in order.items:
+        requested[item.sweet_id] = requested.get(item.sweet_id, 0) + item.quantity
+
+    placeholders = ", ".join("?" * len(requested))
+    rows = fetch_all(
+        conn,
+        "order.load_sweets",
+        f"SELECT id, name, price, quantity FROM sweets WHERE id IN ({placeholders})",
+        list(requested)
+    )
+    sweets = {row["id"]: row for row in rows}
+
+    errors = []
+    for sweet_id, quantity in requested.items():
+        sweet = sweets.get(sweet_id)
         if not sweet:
-            raise HTTPException(status_code=404, detail="Sweet not found")
-        
-        if sweet["quantity"] < purchase.quantity:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock. Only {sweet['quantity']} available")
-        
-        # Update stock
-        new_quantity = sweet["quantity"] - purchase.quantity
-        cursor.execute("UPDATE sweets SET quantity = ?, updated_at = ? WHERE id = ?", 
-                      (new_quantity, datetime.utcnow().isoformat(), sweet_id))
-        
-        # Record purchase
-        total_price = sweet["price"] * purchase.quantity
-        cursor.execute(
-            """INSERT INTO purchases (user_id, sweet_id, quantity, total_price) 
-               VALUES (?, ?, ?, ?)""",
-            (current_user["id"], sweet_id, purchase.quantity, total_price)
-        )
-        conn.commit()
-        
-        logger.info(f"Purchase made: {purchase.quantity}x {sweet['name']} by {current_user['username']}")
-        
-        return {
-            "message": "Purchase successful",
+            errors.append({"sweet_id": sweet_id, "detail": "Sweet not found"})
+        elif sweet["quantity"] < quantity:
+            errors.append({
+                "sweet_id": sweet_id,
+                "detail": f"Insufficient stock. Only {sweet['quantity']} available"
+            })
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "Order could not be placed", "items": errors})
+
+    # The writer holds the write lock, so the stock read above cannot change before these run
+    now = datetime.utcnow().isoformat()
+    execute_many(
+        conn,
+        "order.decrement_stock",
+        "UPDATE sweets SET quantity = quantity - ?, updated_at = ? WHERE id = ?",
+        [(quantity, now, sweet_id) for sweet_id, quantity in requested.items()]
+    )
+
+    lines = []
+    for item in order.items:
+        sweet = sweets[item.sweet_id]
+        lines.append({
+            "sweet_id": item.sweet_id,
             "sweet_name": sweet["name"],
-            "quantity_purchased": purchase.quantity,
-            "total_price": total_price,
-            "remaining_stock": new_quantity
-        }
+            "quantity_purchased": item.quantity,
+            "total_price": sweet["price"] * item.quantity,
+            "remaining_stock": sweet["quantity"] - requested[item.sweet_id]
+        })
+    execute_many(
+        conn,
+        "order.insert_purchases",
+        """INSERT INTO purchases (user_id, sweet_id, quantity, total_price) 
+           VALUES (?, ?, ?, ?)""",
+        [(current_user["id"], line["sweet_id"], line["quantity_purchased"], line["total_price"]) for line in lines]
+    )
+
+    return {
+        "message": "Order successful",
+        "total_price": sum(line["total_price"] for line in lines),
+        "items": lines
+    }
+
+@app.post("/api/orders")
+def place_order(
+    order: OrderRequest,
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Purchase a whole cart in one transaction; either every line succeeds or none does"""
+    idempotent = idempotent_request(idempotency_key, current_user, request, order, response)
+    result, replayed = run_write(idempotent, apply_order, current_user, order)
+    if not replayed:
+        logger.info("Order placed: %s items for %s by %s", len(result["items"]), result["total_price"], current_user["username"])
+    return result
+
+def apply_restock(conn, admin: dict, sweet_id: int, restock: RestockRequest):
+    """Write job: add stock and record the restock"""
+    # Update stock
+    rows = fetch_all(
+        conn,
+        "restock.increment_stock",
+        """UPDATE sweets SET quantity = quantity + ?, updated_at = ?
+           WHERE id = ?
+           RETURNING name, quantity""",
+        (restock.quantity, datetime.utcnow().isoformat(), sweet_id)
+    )
+
+    if not rows:
+        raise HTTPException(status_code=404, detail="Sweet not found")
+
+    sweet = rows[0]
+
+    # Record restock
+    execute(
+        conn,
+        "restock.insert",
+        """INSERT INTO restock_history (sweet_id, admin_id, quantity_added) 
+           VALUES (?, ?, ?)""",
+        (sweet_id, admin["id"], restock.quantity)
+    )
+
+    return {
+        "message": "Restock successful",
+        "sweet_name": sweet["name"],
+        "quantity_added": restock.quantity,
+        "new_stock": sweet["quantity"]
+    }
 
 @app.post("/api/sweets/{sweet_id}/restock")
-def restock_sweet(sweet_id: int, restock: RestockRequest, admin: dict = Depends(get_admin_user)):
+def restock_sweet(
+    sweet_id: int,
+    restock: RestockRequest,
+    request: Request,
+    response: Response,
+    admin: dict = Depends(get_admin_user),
+    idempotency_key: Optional[str] = Header(None)
+):
     """Restock a sweet, increasing its quantity (Admin only)"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM sweets WHERE id = ?", (sweet_id,))
-        sweet = cursor.fetchone()
-        
-        if not sweet:
-            raise HTTPException(status_code=404, detail="Sweet not found")
-        
-        # Update stock
-        new_quantity = sweet["quantity"] + restock.quantity
-        cursor.execute("UPDATE sweets SET quantity = ?, updated_at = ? WHERE id = ?", 
-                      (new_quantity, datetime.utcnow().isoformat(), sweet_id))
-        
-        # Record restock
-        cursor.execute(
-            """INSERT INTO restock_history (sweet_id, admin_id, quantity_added) 
-               VALUES (?, ?, ?)""",
-            (sweet_id, admin["id"], restock.quantity)
+    idempotent = idempotent_request(idempotency_key, admin, request, restock, response)
+    result, replayed = run_write(idempotent, apply_restock, admin, sweet_id, restock)
+    if not replayed:
+        logger.info("Restock: %sx %s by admin %s", restock.quantity, result["sweet_name"], admin["username"])
+    return result
+
+# ==================== RESERVATIONS ====================
+# A reservation takes its quantity out of sweets.quantity when it is made, so
+# every existing stock check keeps working and the catalog shows what is still
+# available. Releasing or expiring a reservation puts the stock back;
+# committing it records the purchases without touching stock again.
+
+class ReservationBook:
+    """Active reservations in memory: units held per sweet and a heap of expiry times.
+
+    The reservations table is the source of truth; the book is rebuilt from it
+    whenever the database changes and only updated after the writer commits.
+    Its thread sleeps until the earliest expiry and hands due reservations to
+    the writer, which deletes them and returns their stock.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._load_lock = threading.Lock()
+        self._active = {}  # id -> (sweet_id, quantity, expires_at)
+        self._held = {}  # sweet_id -> units held
+        self._heap = []  # (expires_at, id); entries for extended or finished reservations are skipped
+        self._database = None
+        self._thread = None
+        self._stopping = False
+        self._outcomes = {"committed": 0, "released": 0, "expired": 0}
+
+    def ensure_loaded(self, conn=None):
+        """Rebuild the book from the reservations table if it belongs to another database.
+
+        A caller that already holds a pooled connection passes it as ``conn``
+        rather than having a second one checked out.
+        """
+        with self._load_lock:
+            if self._database == DATABASE:
+                return
+            with nullcontext(conn) if conn is not None else get_db() as conn:
+                rows = fetch_all(conn, "reservations.load", "SELECT id, sweet_id, quantity, expires_at FROM reservations")
+            with self._cond:
+                self._active.clear()
+                self._held.clear()
+                self._heap.clear()
+                for row in rows:
+                    self._add(row["id"], row["sweet_id"], row["quantity"], row["expires_at"])
+                self._database = DATABASE
+                self._start()
+                self._cond.notify()
+
+    def _add(self, reservation_id, sweet_id, quantity, expires_at):
+        self._active[reservation_id] = (sweet_id, quantity, expires_at)
+        self._held[sweet_id] = self._held.get(sweet_id, 0) + quantity
+        heapq.heappush(self._heap, (expires_at, reservation_id))
+
+    def add(self, reservation_id, sweet_id, quantity, expires_at):
+        with self._cond:
+            self._add(reservation_id, sweet_id, quantity, expires_at)
+            self._start()
+            self._cond.notify()
+
+    def extend(self, reservation_id, expires_at):
+        with self._cond:
+            entry = self._active.get(reservation_id)
+            if entry is not None:
+                self._active[reservation_id] = (entry[0], entry[1], expires_at)
+                heapq.heappush(self._heap, (expires_at, reservation_id))
+
+    def remove(self, reservation_ids, outcome):
+        with self._cond:
+            for reservation_id in reservation_ids:
+                entry = self._active.pop(reservation_id, None)
+                if entry is None:
+                    continue
+                sweet_id, quantity, _ = entry
+                held = self._held[sweet_id] - quantity
+                if held:
+                    self._held[sweet_id] = held
+                else:
+                    del self._held[sweet_id]
+                self._outcomes[outcome] += 1
+
+    def held(self, sweet_id):
+        """Units of a sweet currently held by reservations"""
+        with self._cond:
+            return self._held.get(sweet_id, 0)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="sweetshop-reservations", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        with self._load_lock:
+            self._database = None
+
+    def _due(self):
+        # A heap entry is live while it is not earlier than the reservation's current expiry
+        now = time.time()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, reservation_id = heapq.heappop(self._heap)
+            entry = self._active.get(reservation_id)
+            if entry is not None and entry[2] <= expires_at:
+                due[reservation_id] = None
+        return list(due)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = []
+                while not self._stopping and not due:
+                    due = self._due()
+                    if not due:
+                        self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if self._stopping:
+                    return
+            try:
+                expired = write_queue.run(expire_reservations, due)
+            except Exception:
+                logger.exception("Expiring %s reservations failed", len(due))
+                with self._cond:
+                    for reservation_id in due:
+                        heapq.heappush(self._heap, (time.time() + RESERVATION_RETRY, reservation_id))
+                continue
+            self.remove(expired, "expired")
+            if expired:
+                logger.info("Expired %s reservations", len(expired))
+
+    def stats(self):
+        with self._cond:
+            live = [entry[2] for entry in self._active.values()]
+            return {
+                "active": len(self._active),
+                "units_held": sum(self._held.values()),
+                "sweets_held": len(self._held),
+                "next_expiry_in": round(min(live) - time.time(), 3) if live else None,
+                **self._outcomes,
+            }
+
+reservation_book = ReservationBook()
+
+def reservation_view(row):
+    return {
+        "id": row["id"],
+        "sweet_id": row["sweet_id"],
+        "quantity": row["quantity"],
+        "expires_at": datetime.utcfromtimestamp(row["expires_at"]).isoformat(timespec="seconds"),
+        "expires_in": max(0, round(row["expires_at"] - time.time())),
+    }
+
+def restore_stock(conn, rows):
+    """Put the quantity of deleted reservations back into stock"""
+    execute_many(
+        conn,
+        "reservations.restore_stock",
+        "UPDATE sweets SET quantity = quantity + ?, updated_at = ? WHERE id = ?",
+        [(row["quantity"], datetime.utcnow().isoformat(), row["sweet_id"]) for row in rows]
+    )
+
+def apply_reservation(conn, current_user: dict, request: ReservationRequest):
+    """Write job: take stock out of the catalog and hold it for the user"""
+    rows = fetch_all(
+        conn,
+        "reservations.decrement_stock",
+        """UPDATE sweets SET quantity = quantity - ?, updated_at = ?
+           WHERE id = ? AND quantity >= ?
+           RETURNING quantity""",
+        (request.quantity, datetime.utcnow().isoformat(), request.sweet_id, request.quantity)
+    )
+    if not rows:
+        raise_stock_error(conn, request.sweet_id)
+
+    expires_at = time.time() + (request.ttl_seconds or RESERVATION_TTL)
+    reservation = fetch_one(
+        conn,
+        "reservations.insert",
+        """INSERT INTO reservations (user_id, sweet_id, quantity, expires_at)
+           VALUES (?, ?, ?, ?)
+           RETURNING id, sweet_id, quantity, expires_at""",
+        (current_user["id"], request.sweet_id, request.quantity, expires_at)
+    )
+    return {**dict(reservation), "remaining_stock": rows[0]["quantity"]}
+
+def apply_extension(conn, current_user: dict, reservation_id: int, ttl_seconds: int):
+    """Write job: move a live reservation's expiry ``ttl_seconds`` from now"""
+    now = time.time()
+    reservation = fetch_one(
+        conn,
+        "reservations.extend",
+        """UPDATE reservations SET expires_at = ?
+           WHERE id = ? AND user_id = ? AND expires_at > ?
+           RETURNING id, sweet_id, quantity, expires_at""",
+        (now + ttl_seconds, reservation_id, current_user["id"], now)
+    )
+    if not reservation:
+        raise HTTPException(status_code=404, detail="Reservation not found or expired")
+    return dict(reservation)
+
+def apply_release(conn, current_user: dict, reservation_id: int):
+    """Write job: drop a reservation and return its stock"""
+    rows = fetch_all(
+        conn,
+        "reservations.release",
+        "DELETE FROM reservations WHERE id = ? AND user_id = ? RETURNING id, sweet_id, quantity",
+        (reservation_id, current_user["id"])
+    )
+    if not rows:
+        raise HTTPException(status_code=404, detail="Reservation not found or expired")
+    restore_stock(conn, rows)
+
+def expire_reservations(conn, reservation_ids):
+    """Write job: drop the given reservations that are past their expiry; returns their ids"""
+    placeholders = ", ".join("?" * len(reservation_ids))
+    rows = fetch_all(
+        conn,
+        "reservations.expire",
+        f"DELETE FROM reservations WHERE id IN ({placeholders}) AND expires_at <= ? RETURNING id, sweet_id, quantity",
+        [*reservation_ids, time.time()]
+    )
+    restore_stock(conn, rows)
+    return [row["id"] for row in rows]
+
+def apply_reservation_commit(conn, current_user: dict, commit: ReservationCommit):
+    """Write job: turn held reservations into purchases; either all of them or none"""
+    reservation_ids = list(dict.fromkeys(commit.reservation_ids))
+    placeholders = ", ".join("?" * len(reservation_ids))
+    rows = fetch_all(
+        conn,
+        "reservations.take",
+        f"""DELETE FROM reservations
+            WHERE id IN ({placeholders}) AND user_id = ? AND expires_at > ?
+            RETURNING id, sweet_id, quantity""",
+        [*reservation_ids, current_user["id"], time.time()]
+    )
+    taken = {row["id"]: row for row in rows}
+    missing = [reservation_id for reservation_id in reservation_ids if reservation_id not in taken]
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail={"message": "Reservations not found or expired", "reservation_ids": missing}
         )
-        conn.commit()
-        
-        logger.info(f"Restock: {restock.quantity}x {sweet['name']} by admin {admin['username']}")
-        
-        return {
-            "message": "Restock successful",
+
+    sweet_ids = list({row["sweet_id"] for row in rows})
+    placeholders = ", ".join("?" * len(sweet_ids))
+    sweets = {
+        row["id"]: row
+        for row in fetch_all(
+            conn, "reservations.load_sweets", f"SELECT id, name, price FROM sweets WHERE id IN ({placeholders})", sweet_ids
+        )
+    }
+
+    lines = []
+    for reservation_id in reservation_ids:
+        reservation = taken[reservation_id]
+        sweet = sweets.get(reservation["sweet_id"])
+        if sweet is None:
+            raise HTTPException(status_code=404, detail="Sweet not found")
+        lines.append({
+            "reservation_id": reservation_id,
+            "sweet_id": reservation["sweet_id"],
             "sweet_name": sweet["name"],
-            "quantity_added": restock.quantity,
-            "new_stock": new_quantity
-        }
+            "quantity_purchased": reservation["quantity"],
+            "total_price": sweet["price"] * reservation["quantity"]
+        })
+    execute_many(
+        conn,
+        "reservations.insert_purchases",
+        """INSERT INTO purchases (user_id, sweet_id, quantity, total_price) 
+           VALUES (?, ?, ?, ?)""",
+        [(current_user["id"], line["sweet_id"], line["quantity_purchased"], line["total_price"]) for line in lines]
+    )
+
+    return {
+        "message": "Order successful",
+        "total_price": sum(line["total_price"] for line in lines),
+        "items": lines
+    }
+
+@app.post("/api/reservations", status_code=status.HTTP_201_CREATED)
+def create_reservation(request: ReservationRequest, current_user: dict = Depends(get_current_user)):
+    """Hold stock for the cart until checkout or expiry"""
+    reservation_book.ensure_loaded()
+    result = write_queue.run(apply_reservation, current_user, request)
+    reservation_book.add(result["id"], result["sweet_id"], result["quantity"], result["expires_at"])
+    logger.info("Reserved %sx sweet %s for %s", request.quantity, request.sweet_id, current_user["username"])
+    return {**reservation_view(result), "remaining_stock": result["remaining_stock"]}
+
+@app.get("/api/reservations")
+def list_reservations(
+    current_user: dict = Depends(get_current_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """The current user's live reservations, soonest expiry first"""
+    rows = fetch_all(
+        conn,
+        "reservations.by_user",
+        "SELECT id, sweet_id, quantity, expires_at FROM reservations WHERE user_id = ? AND expires_at > ? ORDER BY expires_at",
+        (current_user["id"], time.time())
+    )
+    return [reservation_view(row) for row in rows]
+
+@app.post("/api/reservations/commit")
+def commit_reservations(commit: ReservationCommit, current_user: dict = Depends(get_current_user)):
+    """Check out held reservations as purchases in one commit"""
+    reservation_book.ensure_loaded()
+    # Stock left the catalog when the reservations were made; checkout only records purchases
+    result = write_queue.run(apply_reservation_commit, current_user, commit, catalog=False)
+    reservation_book.remove([line["reservation_id"] for line in result["items"]], "committed")
+    logger.info("Reservations committed: %s items for %s by %s", len(result["items"]), result["total_price"], current_user["username"])
+    return result
+
+@app.post("/api/reservations/{reservation_id}/extend")
+def extend_reservation(
+    reservation_id: int,
+    extend: ReservationExtend,
+    current_user: dict = Depends(get_current_user)
+):
+    """Keep a reservation for another ``ttl_seconds`` from now"""
+    reservation_book.ensure_loaded()
+    result = write_queue.run(
+        apply_extension, current_user, reservation_id, extend.ttl_seconds or RESERVATION_TTL, catalog=False
+    )
+    reservation_book.extend(reservation_id, result["expires_at"])
+    return reservation_view(result)
+
+@app.delete("/api/reservations/{reservation_id}", status_code=status.HTTP_204_NO_CONTENT)
+def release_reservation(reservation_id: int, current_user: dict = Depends(get_current_user)):
+    """Give up a reservation and return its stock"""
+    reservation_book.ensure_loaded()
+    write_queue.run(apply_release, current_user, reservation_id)
+    reservation_book.remove([reservation_id], "released")
+
+@app.get("/api/sweets/{sweet_id}/availability")
+def get_availability(sweet_id: int, conn: sqlite3.Connection = Depends(get_connection)):
+    """Stock that can still be bought or reserved, and how much is held in carts"""
+    reservation_book.ensure_loaded(conn)
+    sweet = fetch_sweet(conn, sweet_id)
+    return {"sweet_id": sweet_id, "available": sweet["quantity"], "reserved": reservation_book.held(sweet_id)}
 
 # ==================== REPORTING ENDPOINTS ====================
 
+PURCHASE_HISTORY_ORDER = ("p.purchase_date", "p.id")
+RESTOCK_HISTORY_ORDER = ("r.restock_date", "r.id")
+
+def build_purchase_history_query(user_id, after=None, limit=None):
+    """Build the purchase history query for one user, newest first"""
+    query = """
+        SELECT p.*, s.name as sweet_name, s.category, s.img 
+        FROM purchases p
+        JOIN sweets s ON p.sweet_id = s.id
+        WHERE p.user_id = ?
+    """
+    return keyset_query(query, [user_id], PURCHASE_HISTORY_ORDER, after, limit)
+
+def build_all_purchases_query(after=None, limit=None):
+    """Build the purchase report across all users, newest first"""
+    query = """
+        SELECT p.*, s.name as sweet_name, s.category, u.username
+        FROM purchases p
+        JOIN sweets s ON p.sweet_id = s.id
+        JOIN users u ON p.user_id = u.id
+        WHERE 1=1
+    """
+    return keyset_query(query, [], PURCHASE_HISTORY_ORDER, after, limit)
+
+def build_restock_history_query(after=None, limit=None):
+    """Build the restock history query, newest first"""
+    query = """
+        SELECT r.*, s.name as sweet_name, u.username as admin_name
+        FROM restock_history r
+        JOIN sweets s ON r.sweet_id = s.id
+        JOIN users u ON r.admin_id = u.id
+        WHERE 1=1
+    """
+    return keyset_query(query, [], RESTOCK_HISTORY_ORDER, after, limit)
+
 @app.get("/api/purchases/history")
-def get_purchase_history(current_user: dict = Depends(get_current_user)):
+def get_purchase_history(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
     """Get purchase history for current user"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT p.*, s.name as sweet_name, s.category, s.img 
-            FROM purchases p
-            JOIN sweets s ON p.sweet_id = s.id
-            WHERE p.user_id = ?
-            ORDER BY p.purchase_date DESC
-        """, (current_user["id"],))
-        purchases = cursor.fetchall()
-        return [dict(purchase) for purchase in purchases]
+    limit, after = page_params(limit, cursor, len(PURCHASE_HISTORY_ORDER))
+    query, params = build_purchase_history_query(current_user["id"], after, limit)
+    purchases = fetch_all(conn, "purchases.history", query, params)
+    purchases = paginate(purchases, limit, lambda p: (p["purchase_date"], p["id"]), response.headers)
+    return [dict(purchase) for purchase in purchases]
+
+@app.get("/api/admin/purchases")
+def get_all_purchases(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Get purchases of all users; streams NDJSON on request (Admin only)"""
+    if wants_stream(request, stream):
+        _, after = page_params(None, cursor, len(PURCHASE_HISTORY_ORDER))
+        return ndjson_response(conn, "purchases.export", *build_all_purchases_query(after))
+
+    limit, after = page_params(limit, cursor, len(PURCHASE_HISTORY_ORDER))
+    query, params = build_all_purchases_query(after, limit)
+    purchases = fetch_all(conn, "purchases.all", query, params)
+    purchases = paginate(purchases, limit, lambda p: (p["purchase_date"], p["id"]), response.headers)
+    return [dict(purchase) for purchase in purchases]
 
 @app.get("/api/admin/restock-history")
-def get_restock_history(admin: dict = Depends(get_admin_user)):
-    """Get restock history (Admin only)"""
+def get_restock_history(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Get restock history; streams NDJSON on request (Admin only)"""
+    if wants_stream(request, stream):
+        _, after = page_params(None, cursor, len(RESTOCK_HISTORY_ORDER))
+        return ndjson_response(conn, "restocks.export", *build_restock_history_query(after))
+
+    limit, after = page_params(limit, cursor, len(RESTOCK_HISTORY_ORDER))
+    query, params = build_restock_history_query(after, limit)
+    restocks = fetch_all(conn, "restocks.history", query, params)
+    restocks = paginate(restocks, limit, lambda r: (r["restock_date"], r["id"]), response.headers)
+    return [dict(restock) for restock in restocks]
+
+# ==================== ANALYTICS ENDPOINTS ====================
+# Answered from the daily aggregate tables, so the cost grows with the number
+# of days in the range rather than the number of purchases.
+
+def check_day_range(start: Optional[date], end: Optional[date]):
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+def day_range(start: Optional[date], end: Optional[date], column="day"):
+    """WHERE clause and params for an inclusive range of days"""
+    check_day_range(start, end)
+    clauses, params = [], []
+    if start:
+        clauses.append(f"{column} >= ?")
+        params.append(start.isoformat())
+    if end:
+        clauses.append(f"{column} <= ?")
+        params.append(end.isoformat())
+    return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+@app.get("/api/admin/analytics/daily")
+def get_daily_sales(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Units, revenue and purchases per day, oldest first (Admin only)"""
+    where, params = day_range(start, end)
+    rows = fetch_all(conn, "analytics.daily", f"""
+        SELECT day, SUM(units) AS units, SUM(revenue) AS revenue, SUM(purchases) AS purchases
+        FROM sales_by_category
+        {where}
+        GROUP BY day
+        ORDER BY day
+    """, params)
+    return [dict(row) for row in rows]
+
+@app.get("/api/admin/analytics/top-sellers")
+def get_top_sellers(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    by: str = Query("revenue", pattern="^(units|revenue)$"),
+    limit: int = Query(10, ge=1, le=100),
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Best-selling sweets by revenue or units (Admin only)"""
+    where, params = day_range(start, end, "d.day")
+    rows = fetch_all(conn, "analytics.top_sellers", f"""
+        SELECT d.sweet_id, s.name AS sweet_name, s.category,
+               SUM(d.units) AS units, SUM(d.revenue) AS revenue, SUM(d.purchases) AS purchases
+        FROM sales_daily d
+        LEFT JOIN sweets s ON s.id = d.sweet_id
+        {where}
+        GROUP BY d.sweet_id
+        ORDER BY {by} DESC, d.sweet_id
+        LIMIT ?
+    """, [*params, limit])
+    return [dict(row) for row in rows]
+
+@app.get("/api/admin/analytics/categories")
+def get_category_sales(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Units, revenue and purchases per category, highest revenue first (Admin only)"""
+    where, params = day_range(start, end)
+    rows = fetch_all(conn, "analytics.categories", f"""
+        SELECT category, SUM(units) AS units, SUM(revenue) AS revenue, SUM(purchases) AS purchases
+        FROM sales_by_category
+        {where}
+        GROUP BY category
+        ORDER BY revenue DESC, category
+    """, params)
+    return [dict(row) for row in rows]
+
+# Ad-hoc reports over every purchase run on NumPy columns cached in memory;
+# each request first appends the purchases made since the previous one.
+purchase_columns = analytics.PurchaseColumns()
+
+def load_purchase_columns(conn):
+    return purchase_columns.refresh(
+        conn, lambda sql, params: execute(conn, "analytics.purchase_columns", sql, params)
+    )
+
+def optional_day(value: Optional[date]):
+    return analytics.to_day(value) if value else None
+
+def rounded(values, digits=2):
+    return [round(value, digits) for value in values.tolist()]
+
+@app.get("/api/admin/analytics/trend")
+def get_sales_trend(
+    days: int = Query(90, ge=1, le=3660),
+    window: int = Query(7, ge=1, le=365),
+    sweet_id: Optional[int] = None,
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Daily sales for the last ``days`` days with trailing moving averages (Admin only)"""
+    columns = load_purchase_columns(conn)
+    if sweet_id is not None:
+        mask = columns["sweet_id"] == sweet_id
+        columns = {name: column[mask] for name, column in columns.items()}
+    end_day = analytics.to_day(datetime.utcnow().date())
+    # Start window - 1 days early so the first day shown already has a full window
+    series = analytics.daily_series(columns, end_day - days - window + 2, end_day)
+    shown = slice(window - 1, None)
+    return [
+        {"day": day, "units": int(units), "revenue": revenue, "purchases": purchases,
+         "units_avg": units_avg, "revenue_avg": revenue_avg}
+        for day, units, revenue, purchases, units_avg, revenue_avg in zip(
+            analytics.day_labels(series["day"][shown]),
+            series["units"][shown].tolist(),
+            rounded(series["revenue"][shown]),
+            series["purchases"][shown].tolist(),
+            rounded(analytics.moving_average(series["units"], window)[shown]),
+            rounded(analytics.moving_average(series["revenue"], window)[shown]),
+        )
+    ]
+
+@app.get("/api/admin/analytics/customers")
+def get_customer_analytics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(10, ge=1, le=100),
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Top customers by spend and the distribution of spend per customer (Admin only)"""
+    check_day_range(start, end)
+    columns = analytics.select_days(load_purchase_columns(conn), optional_day(start), optional_day(end))
+    totals = analytics.group_totals(columns, "user_id")
+    top_ids = totals["key"][:limit].tolist()
+    names = {}
+    if top_ids:
+        placeholders = ", ".join("?" * len(top_ids))
+        rows = fetch_all(conn, "users.by_ids", f"SELECT id, username FROM users WHERE id IN ({placeholders})", top_ids)
+        names = {row["id"]: row["username"] for row in rows}
+    return {
+        "customers": len(totals["key"]),
+        "spend": analytics.percentiles(totals["revenue"]),
+        "top": [
+            {"user_id": user_id, "username": names.get(user_id), "units": int(units), "revenue": revenue,
+             "purchases": purchases}
+            for user_id, units, revenue, purchases in zip(
+                top_ids,
+                totals["units"][:limit].tolist(),
+                rounded(totals["revenue"][:limit]),
+                totals["purchases"][:limit].tolist(),
+            )
+        ],
+    }
+
+@app.get("/api/admin/analytics/purchase-values")
+def get_purchase_values(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Percentiles of purchase value and quantity (Admin only)"""
+    check_day_range(start, end)
+    columns = analytics.select_days(load_purchase_columns(conn), optional_day(start), optional_day(end))
+    count = len(columns["id"])
+    return {
+        "purchases": count,
+        "revenue": round(float(columns["total_price"].sum()), 2),
+        "mean_value": round(float(columns["total_price"].mean()), 2) if count else None,
+        "value": analytics.percentiles(columns["total_price"]),
+        "quantity": analytics.percentiles(columns["quantity"]),
+    }
+
+# ==================== STOCK FORECAST ====================
+
+last_forecast = {}
+
+def forecast_sweet(quantity, recent_units, window_units, today):
+    """Daily rate, days to stockout, stockout date and suggested restock for one sweet"""
+    rate = max(recent_units / FORECAST_RECENT_DAYS, window_units / FORECAST_WINDOW_DAYS)
+    if quantity <= 0:
+        days = 0.0
+    elif rate > 0:
+        days = quantity / rate
+    else:
+        days = None  # not selling; never runs out at the current rate
+    stockout = (today + timedelta(days=days)).isoformat() if days is not None and days < 3650 else None
+    suggested = max(0, math.ceil(rate * RESTOCK_COVER_DAYS) - quantity)
+    return round(rate, 4), None if days is None else round(days, 2), stockout, suggested
+
+def refresh_stock_forecast():
+    """Recompute stock_forecast from the sales_daily aggregates.
+
+    Reads FORECAST_WINDOW_DAYS of daily totals per sweet rather than the
+    purchases themselves, so a refresh costs the same however long the
+    purchase history grows.
+    """
+    start = time.perf_counter()
+    today = datetime.utcnow().date()
+    now = datetime.utcnow().isoformat(sep=" ", timespec="seconds")
     with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT r.*, s.name as sweet_name, u.username as admin_name
-            FROM restock_history r
-            JOIN sweets s ON r.sweet_id = s.id
-            JOIN users u ON r.admin_id = u.id
-            ORDER BY r.restock_date DESC
-        """)
-        restocks = cursor.fetchall()
-        return [dict(restock) for restock in restocks]
+        sales = fetch_all(conn, "forecast.sales", """
+            SELECT s.id, s.quantity, COALESCE(w.recent_units, 0) AS recent_units, COALESCE(w.window_units, 0) AS window_units
+            FROM sweets s
+            LEFT JOIN (
+                SELECT sweet_id,
+                       SUM(CASE WHEN day >= ? THEN units ELSE 0 END) AS recent_units,
+                       SUM(units) AS window_units
+                FROM sales_daily
+                WHERE day >= ?
+                GROUP BY sweet_id
+            ) w ON w.sweet_id = s.id
+        """, (
+            (today - timedelta(days=FORECAST_RECENT_DAYS - 1)).isoformat(),
+            (today - timedelta(days=FORECAST_WINDOW_DAYS - 1)).isoformat(),
+        ))
+        rows = [
+            (sweet["id"], sweet["quantity"],
+             *forecast_sweet(sweet["quantity"], sweet["recent_units"], sweet["window_units"], today), now)
+            for sweet in sales
+        ]
+        with write_transaction(conn):
+            execute(conn, "forecast.clear", "DELETE FROM stock_forecast")
+            execute_many(conn, "forecast.insert", """
+                INSERT INTO stock_forecast
+                    (sweet_id, quantity, daily_rate, days_to_stockout, stockout_date, suggested_restock, refreshed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+
+    low_stock = sum(1 for row in rows if row[3] is not None and row[3] <= LOW_STOCK_DAYS)
+    last_forecast.update({
+        "at": now,
+        "sweets": len(rows),
+        "low_stock": low_stock,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    })
+    logger.info("Stock forecast refreshed: %s sweets, %s low on stock", len(rows), low_stock)
+    return last_forecast
+
+forecast_task = PeriodicTask("stock-forecast", FORECAST_INTERVAL, refresh_stock_forecast)
+
+@app.get("/api/admin/low-stock")
+def get_low_stock(
+    days: float = Query(LOW_STOCK_DAYS, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    admin: dict = Depends(get_admin_user),
+    conn: sqlite3.Connection = Depends(get_connection)
+):
+    """Sweets forecast to run out within ``days`` days, soonest first (Admin only)"""
+    rows = fetch_all(conn, "forecast.low_stock", """
+        SELECT f.sweet_id, s.name AS sweet_name, s.category, f.quantity, f.daily_rate,
+               f.days_to_stockout, f.stockout_date, f.suggested_restock, f.refreshed_at
+        FROM stock_forecast f
+        JOIN sweets s ON s.id = f.sweet_id
+        WHERE f.days_to_stockout <= ?
+        ORDER BY f.days_to_stockout, f.sweet_id
+        LIMIT ?
+    """, (days, limit))
+    return [dict(row) for row in rows]
+
+@app.post("/api/admin/low-stock/refresh")
+def refresh_low_stock(admin: dict = Depends(get_admin_user)):
+    """Recompute the forecast now instead of waiting for the next scheduled run (Admin only)"""
+    return refresh_stock_forecast()
+
+class ProfilingSettings(BaseModel):
+    sample_rate: float = Field(..., ge=0, le=1)
+
+@app.get("/api/admin/profiles")
+def list_profiles(admin: dict = Depends(get_admin_user)):
+    """Recently captured request profiles, newest first (Admin only)"""
+    return profile_store.list()
+
+@app.get("/api/admin/profiles/{profile_id}", response_class=PlainTextResponse)
+def get_profile(
+    profile_id: int,
+    sort: str = Query("cumulative", pattern="^(cumulative|tottime|calls|ncalls)$"),
+    limit: int = Query(50, ge=1, le=1000),
+    admin: dict = Depends(get_admin_user)
+):
+    """One request profile as a pstats report (Admin only)"""
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.report(sort, limit)
+
+@app.delete("/api/admin/profiles", status_code=status.HTTP_204_NO_CONTENT)
+def clear_profiles(admin: dict = Depends(get_admin_user)):
+    """Drop every stored profile (Admin only)"""
+    profile_store.clear()
+
+@app.get("/api/admin/profiling", response_model=ProfilingSettings)
+def get_profiling(admin: dict = Depends(get_admin_user)):
+    """Current profiling sample rate (Admin only)"""
+    return ProfilingSettings(sample_rate=profile_store.sample_rate)
+
+@app.put("/api/admin/profiling", response_model=ProfilingSettings)
+def set_profiling(settings: ProfilingSettings, admin: dict = Depends(get_admin_user)):
+    """Profile a share of all requests without redeploying; 0 turns sampling off (Admin only)"""
+    profile_store.sample_rate = settings.sample_rate
+    logger.info("Profiling sample rate set to %s by admin %s", settings.sample_rate, admin["username"])
+    return settings
+
+class SlowQuerySettings(BaseModel):
+    threshold_ms: float = Field(..., ge=0)
+
+@app.get("/api/admin/slow-queries")
+def list_slow_queries(
+    limit: int = Query(50, ge=1, le=SLOW_QUERY_KEEP),
+    admin: dict = Depends(get_admin_user)
+):
+    """Most recent slow queries with their parameter types and query plans, newest first (Admin only)"""
+    return slow_query_log.entries(limit)
+
+@app.delete("/api/admin/slow-queries", status_code=status.HTTP_204_NO_CONTENT)
+def clear_slow_queries(admin: dict = Depends(get_admin_user)):
+    """Forget the stored slow queries; the log file is kept (Admin only)"""
+    slow_query_log.clear()
+
+@app.get("/api/admin/slow-queries/settings", response_model=SlowQuerySettings)
+def get_slow_query_settings(admin: dict = Depends(get_admin_user)):
+    """Current slow-query threshold (Admin only)"""
+    return SlowQuerySettings(threshold_ms=slow_query_log.threshold_ms)
+
+@app.put("/api/admin/slow-queries/settings", response_model=SlowQuerySettings)
+def set_slow_query_settings(settings: SlowQuerySettings, admin: dict = Depends(get_admin_user)):
+    """Change the slow-query threshold at runtime (Admin only)"""
+    slow_query_log.threshold_ms = settings.threshold_ms
+    logger.info("Slow query threshold set to %sms by admin %s", settings.threshold_ms, admin["username"])
+    return settings
+
+@app.get("/api/admin/stats")
+def get_stats(admin: dict = Depends(get_admin_user)):
+    """Runtime statistics used to tune the server (Admin only)"""
+    return {
+        "db_pool": get_pool().stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "auth_cache": auth_cache.stats(),
+        "storage": {"profile": DB_STORAGE_PROFILE, "last_checkpoint": last_checkpoint or None},
+        "stock_forecast": last_forecast or None,
+        "reservations": reservation_book.stats(),
+        "idempotency": idempotency_store.stats(),
+        "write_queue": write_queue.stats(),
+        "profiling": profile_store.stats(),
+        "slow_queries": slow_query_log.stats(),
+        "purchase_columns": purchase_columns.stats(),
+        "logging": {
+            "format": LOG_FORMAT,
+            "queued": log_queue.qsize(),
+            "dropped": log_handler.dropped,
+            "access_sampled_out": access_sampler.sampled_out,
+        },
+    }
+
+# ==================== METRICS ENDPOINT ====================
+
+def pool_connections():
+    stats = get_pool().stats()
+    return {("in_use",): stats["in_use"], ("idle",): stats["idle"]}
+
+def cache_requests(cache):
+    def collect():
+        stats = cache.stats()
+        return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+    return collect
+
+metrics.callback("sweetshop_db_pool_connections", "Pooled SQLite connections by state", pool_connections, ("state",))
+metrics.callback("sweetshop_write_queue_pending", "Write jobs waiting for the writer", lambda: write_queue.stats()["pending"])
+metrics.callback("sweetshop_password_jobs_pending", "bcrypt jobs queued or running", lambda: password_hasher.stats()["pending"])
+metrics.callback(
+    "sweetshop_password_jobs_rejected_total", "bcrypt jobs turned away with a 503",
+    lambda: password_hasher.stats()["rejected"], type="counter"
+)
+metrics.callback("sweetshop_log_queue_pending", "Log records waiting for the writer thread", log_queue.qsize)
+metrics.callback(
+    "sweetshop_log_records_dropped_total", "Log records dropped because the queue was full",
+    lambda: log_handler.dropped, type="counter"
+)
+metrics.callback(
+    "sweetshop_catalog_cache_requests_total", "Catalog cache lookups by result",
+    cache_requests(catalog_cache), ("result",), type="counter"
+)
+metrics.callback(
+    "sweetshop_auth_cache_requests_total", "Auth cache lookups by result",
+    cache_requests(auth_cache), ("result",), type="counter"
+)
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=metrics.render(), media_type=METRICS_MEDIA_TYPE)
 
 # ==================== STARTUP EVENT ====================
 
+def reset_state():
+    """Stop the workers bound to the current database and drop what was cached from it.
+
+    Needed before the file underneath is replaced (tests, benchmarks) and on
+    shutdown. The connection pool is left to close_pool().
+    """
+    reservation_book.stop()
+    write_queue.stop()
+    idempotency_store.clear()
+
 @app.on_event("startup")
 def startup_event():
     init_db()
+    checkpoint_task.start()
+    refresh_stock_forecast()
+    forecast_task.start()
+    reservation_book.ensure_loaded()
+    idempotency_purge_task.start()
     logger.info("Sweet Shop Management System started successfully")
 
+@app.on_event("shutdown")
+def shutdown_event():
+    password_hasher.shutdown()
+    db_executor.shutdown()
+    idempotency_purge_task.stop()
+    checkpoint_task.stop()
+    forecast_task.stop()
+    reset_state()
+    checkpoint_wal()
+    close_pool()
+    slow_query_log.close()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
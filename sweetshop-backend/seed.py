@@ -0,0 +1,263 @@
+# seed.py - Bulk-load a large, realistic Sweet Shop database
+#
+#   cd sweetshop-backend
+#   python -m seed --sweets 50000 --users 200000 --purchases 5000000
+#   python -m seed --database /tmp/big.db --purchases 1000000 --seed 42
+#
+# The schema comes from init_db(), so the result is exactly what the server
+# expects. Rows are generated lazily and written with executemany in large
+# transactions while durability pragmas are relaxed. Secondary indexes and
+# triggers on the history tables are dropped for the load; the indexes are
+# rebuilt once at the end and the sales aggregates recomputed in one pass.
+import argparse
+import itertools
+import random
+import sqlite3
+import time
+
+import main
+
+# Every generated user logs in with this password (bcrypt runs once, not per user)
+DEFAULT_PASSWORD = "password123"
+
+CATEGORIES = ["Barfi", "Laddoo", "Halwa", "Farsan", "Peda", "Chikki", "Rasgulla", "Namkeen"]
+FLAVOURS = ["Kesar", "Badam", "Pista", "Kaju", "Coconut", "Chocolate", "Rose", "Mango", "Gur", "Malai"]
+BASES = ["Barfi", "Laddu", "Halwa", "Peda", "Katli", "Jalebi", "Chikki", "Sandesh", "Ghevar", "Mysorepak"]
+IMAGES = [
+    "assets/Images/soan_papdi.jpg", "assets/Images/motichur_laddu.jpg", "assets/Images/mysore_pak.jpg",
+    "assets/Images/gulab_jamun.jpg", "assets/Images/kaju_katli.jpg", "assets/Images/peda.jpg",
+    "assets/Images/jalebi.jpg", "assets/Images/Ghevar.jpg",
+]
+
+# Applied to the loading connection only. The database stays in WAL, where
+# synchronous=OFF already skips every fsync; a crash mid-load means reseeding.
+LOAD_PRAGMAS = {
+    "synchronous": "OFF",
+    "cache_size": -256 * 1024,  # 256 MiB
+    "temp_store": "MEMORY",
+}
+
+# Tables whose secondary indexes and triggers are restored after the load instead of run per row
+BULK_TABLES = ("purchases", "restock_history")
+
+def user_email(n):
+    return f"user{n}@example.com"
+
+def timestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+def insert_batches(conn, sql, rows, batch_size):
+    """executemany ``rows`` in transactions of ``batch_size``; returns the row count"""
+    total = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return total
+        with conn:
+            conn.executemany(sql, batch)
+        total += len(batch)
+
+def seed_database(
+    database,
+    sweets=10_000,
+    users=1_000,
+    purchases=1_000_000,
+    restocks=None,
+    days=365,
+    password=DEFAULT_PASSWORD,
+    batch_size=50_000,
+    seed=None,
+    log=print
+):
+    """Append generated users, sweets, purchases and restocks to ``database``"""
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    restocks = sweets if restocks is None else restocks
+    now = time.time()
+    since = now - days * 24 * 3600
+
+    # Real schema, migrations, admin and default sweets; then release every server connection
+    previous_database = main.DATABASE
+    main.DATABASE = database
+    try:
+        main.init_db()
+    finally:
+        main.close_pool()
+        main.DATABASE = previous_database
+
+    conn = sqlite3.connect(database)
+    try:
+        for pragma, value in LOAD_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+
+        def schema_objects(kind):
+            placeholders = ", ".join("?" * len(BULK_TABLES))
+            return conn.execute(
+                f"SELECT name, sql FROM sqlite_master WHERE type = ? AND sql IS NOT NULL AND tbl_name IN ({placeholders})",
+                (kind, *BULK_TABLES)
+            ).fetchall()
+
+        def step(label, count, began):
+            log(f"{label}: {count} in {time.perf_counter() - began:.1f}s")
+
+        def restore(objects):
+            # Only what is actually missing, so a failure halfway through the drops is handled too
+            existing = {name for (name,) in conn.execute("SELECT name FROM sqlite_master")}
+            for name, sql in objects:
+                if name not in existing:
+                    conn.execute(sql)
+
+        indexes = schema_objects("index")
+        triggers = schema_objects("trigger")
+        try:
+            for name, _ in indexes:
+                conn.execute(f"DROP INDEX {name}")
+            for name, _ in triggers:
+                conn.execute(f"DROP TRIGGER {name}")
+            load_rows(conn, rng, since, now, users, sweets, purchases, restocks, password, batch_size, step)
+        finally:
+            # Put everything back even if the load failed; init_db() would not, as the schema version is current
+            began = time.perf_counter()
+            restore(indexes)
+            conn.execute("ANALYZE")
+            step("indexes", len(indexes), began)
+
+            # The aggregate triggers were off during the load; recompute what they maintain
+            began = time.perf_counter()
+            restore(triggers)
+            main.rebuild_sales_aggregates(conn)
+            step("sales aggregates", conn.execute("SELECT COUNT(*) FROM sales_daily").fetchone()[0], began)
+    finally:
+        conn.close()
+
+    # Any cached catalog or token belongs to the database before the load
+    main.catalog_cache.invalidate()
+    main.auth_cache.clear()
+
+    log(f"Seeded {database} in {time.perf_counter() - started:.1f}s")
+    return {"users": users, "sweets": sweets, "purchases": purchases, "restocks": restocks}
+
+def load_rows(conn, rng, since, now, users, sweets, purchases, restocks, password, batch_size, step):
+    """Insert the generated users, sweets, purchases and restocks in batches"""
+    # Users
+    began = time.perf_counter()
+    hashed = main.pwd_context.hash(password)
+    # Number generated users after any earlier ones so repeated runs can append
+    first_user = conn.execute("SELECT COUNT(*) FROM users WHERE role = 'user'").fetchone()[0]
+    count = insert_batches(
+        conn,
+        "INSERT INTO users (username, email, password, mobile, address, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            (
+                f"user{n}",
+                user_email(n),
+                hashed,
+                f"9{rng.randrange(10 ** 9):09d}",
+                f"{rng.randint(1, 999)} {rng.choice(FLAVOURS)} Street",
+                timestamp(since + (now - since) * i / max(users, 1))
+            )
+            for i, n in enumerate(range(first_user, first_user + users))
+        ),
+        batch_size
+    )
+    step("users", count, began)
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE role = 'user'")]
+    if purchases and not user_ids:
+        raise ValueError("purchases need at least one user; pass users >= 1")
+
+    # Sweets, oldest first so the catalog's created_at ordering looks lived-in
+    began = time.perf_counter()
+    count = insert_batches(
+        conn,
+        """INSERT INTO sweets (name, category, price, quantity, description, img, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            (
+                f"{rng.choice(FLAVOURS)} {rng.choice(BASES)} {i}",
+                rng.choice(CATEGORIES),
+                rng.randint(20, 500),
+                0 if rng.random() < 0.02 else rng.randint(100, 1_000_000),
+                f"{rng.choice(FLAVOURS)} flavoured {rng.choice(BASES).lower()} made fresh daily",
+                rng.choice(IMAGES),
+                timestamp(since + (now - since) * i / max(sweets, 1)),
+                timestamp(now)
+            )
+            for i in range(sweets)
+        ),
+        batch_size
+    )
+    step("sweets", count, began)
+    prices = dict(conn.execute("SELECT id, price FROM sweets"))
+    sweet_ids = list(prices)
+    if (purchases or restocks) and not sweet_ids:
+        raise ValueError("purchases and restocks need at least one sweet; pass sweets >= 1")
+
+    # Purchases in time order; a few best sellers take most of the orders
+    began = time.perf_counter()
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(sweet_ids))))
+
+    def purchase_rows():
+        spacing = (now - since) / max(purchases, 1)
+        for i in range(purchases):
+            sweet_id = rng.choices(sweet_ids, cum_weights=cum_weights)[0]
+            quantity = rng.randint(1, 5)
+            yield (
+                rng.choice(user_ids),
+                sweet_id,
+                quantity,
+                prices[sweet_id] * quantity,
+                timestamp(since + spacing * (i + rng.random()))
+            )
+
+    count = insert_batches(
+        conn,
+        "INSERT INTO purchases (user_id, sweet_id, quantity, total_price, purchase_date) VALUES (?, ?, ?, ?, ?)",
+        purchase_rows(),
+        batch_size
+    )
+    step("purchases", count, began)
+
+    # Restocks
+    began = time.perf_counter()
+    admin_id = conn.execute("SELECT id FROM users WHERE role = 'admin' ORDER BY id LIMIT 1").fetchone()[0]
+    count = insert_batches(
+        conn,
+        "INSERT INTO restock_history (sweet_id, admin_id, quantity_added, restock_date) VALUES (?, ?, ?, ?)",
+        (
+            (rng.choice(sweet_ids), admin_id, rng.randint(10, 500), timestamp(since + (now - since) * i / max(restocks, 1)))
+            for i in range(restocks)
+        ),
+        batch_size
+    )
+    step("restock_history", count, began)
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load synthetic data into a Sweet Shop database")
+    parser.add_argument("--database", default=main.DATABASE, help="SQLite file to seed (default: %(default)s)")
+    parser.add_argument("--sweets", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--purchases", type=int, default=1_000_000)
+    parser.add_argument("--restocks", type=int, help="restock rows (default: one per sweet)")
+    parser.add_argument("--days", type=int, default=365, help="history spread over this many days")
+    parser.add_argument("--password", default=DEFAULT_PASSWORD, help="password for every generated user")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="rows per transaction")
+    parser.add_argument("--seed", type=int, help="random seed for a reproducible dataset")
+    args = parser.parse_args(argv)
+
+    try:
+        seed_database(
+            args.database,
+            sweets=args.sweets,
+            users=args.users,
+            purchases=args.purchases,
+            restocks=args.restocks,
+            days=args.days,
+            password=args.password,
+            batch_size=args.batch_size,
+            seed=args.seed
+        )
+    except ValueError as exc:
+        parser.error(str(exc))
+
+if __name__ == "__main__":
+    main_cli()
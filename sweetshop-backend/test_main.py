@@ -2,8 +2,14 @@
 import pytest
 from fastapi.testclient import TestClient
 from main import app, get_db, init_db
+import json
+import logging
+import queue
 import sqlite3
+import sys
 import os
+import time
+from datetime import datetime, timedelta
 
 # Test client
 client = TestClient(app)
@@ -24,6 +30,8 @@ def setup_test_db():
     yield
     
     # Cleanup
+    main.reset_state()
+    main.close_pool()
     if os.path.exists(TEST_DATABASE):
         os.remove(TEST_DATABASE)
 
@@ -151,6 +159,74 @@ class TestAuthentication:
         })
         assert response.status_code == 401
     
+    def test_login_overload_returns_503(self):
+        """Test that logins are shed once the bcrypt queue is full"""
+        import main
+        limit = main.password_hasher.queue_limit
+        main.password_hasher.queue_limit = 0
+        try:
+            response = client.post("/api/auth/login", json={
+                "email": "admin@sweetshop.com",
+                "password": "admin123"
+            })
+        finally:
+            main.password_hasher.queue_limit = limit
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+    
+    def test_password_hashing_runs_in_worker_process(self):
+        """Test that bcrypt work is done outside the server process"""
+        import asyncio
+        import main
+        hashed = asyncio.run(main.get_password_hash_async("secret123"))
+        assert main.verify_password("secret123", hashed)
+        assert asyncio.run(main.verify_password_async("secret123", hashed))
+        assert main.password_hasher.stats()["completed"] >= 2
+    
+    def test_register_race_uses_one_connection(self):
+        """Test that losing a registration race reports the clash without a second checkout"""
+        import main
+        from fastapi import HTTPException
+        client.post("/api/auth/register", json={
+            "username": "racer",
+            "email": "racer@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        user = main.UserRegister(
+            username="racer2", email="racer@example.com", password="password123",
+            mobile="1234567890", address="123 Test Street"
+        )
+        main.get_pool().close()
+        main._pool = main.ConnectionPool(TEST_DATABASE, size=1, timeout=0.5)
+        with pytest.raises(HTTPException) as exc_info:
+            main.insert_user(user, "not-a-real-hash")
+        assert exc_info.value.status_code == 400
+        assert exc_info.value.detail == "Email already registered"
+        assert main.get_pool().stats()["timeouts"] == 0
+    
+    def test_password_pool_recovers_from_dead_worker(self):
+        """Test that a worker dying takes down one pool, not every later login"""
+        import asyncio
+        import main
+        asyncio.run(main.get_password_hash_async("secret123"))
+        before = main.password_hasher.stats()
+        executor = main.password_hasher._get_executor()
+        for process in list(executor._processes.values()):
+            process.kill()
+            process.join()
+        
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        assert response.status_code == 200
+        stats = main.password_hasher.stats()
+        assert stats["respawns"] == before["respawns"] + 1
+        assert stats["completed"] == before["completed"] + 1
+        assert stats["failed"] == before["failed"]
+    
     def test_get_current_user(self):
         """Test getting current user information"""
         # Register and login
@@ -181,6 +257,73 @@ class TestAuthentication:
         response = client.get("/api/auth/me")
         assert response.status_code == 403  # Forbidden
 
+# ==================== AUTH CACHE TESTS ====================
+
+class TestAuthCache:
+    """Test suite for the verified-token cache"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def test_repeat_requests_skip_token_verification(self):
+        """Test that a cached token is not decoded or looked up again"""
+        import main
+        token = self.get_admin_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        assert client.get("/api/auth/me", headers=headers).status_code == 200
+        
+        original = main.decode_token
+        main.decode_token = lambda token: pytest.fail("token decoded again")
+        try:
+            response = client.get("/api/auth/me", headers=headers)
+        finally:
+            main.decode_token = original
+        assert response.status_code == 200
+        assert response.json()["email"] == "admin@sweetshop.com"
+    
+    def test_forged_payload_with_cached_signature(self):
+        """Test that reusing a cached signature on another payload is rejected"""
+        import base64
+        import json
+        token = self.get_admin_token()
+        client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+        
+        header, _, signature = token.split(".")
+        payload = base64.urlsafe_b64encode(json.dumps({"sub": "2"}).encode()).decode().rstrip("=")
+        forged = f"{header}.{payload}.{signature}"
+        response = client.get("/api/auth/me", headers={"Authorization": f"Bearer {forged}"})
+        assert response.status_code == 401
+    
+    def test_entries_expire_and_evict(self):
+        """Test TTL expiry and LRU eviction"""
+        import main
+        cache = main.AuthCache(size=2, ttl=60)
+        cache.put("a.b.one", {"id": 1})
+        cache.put("a.b.two", {"id": 2}, token_expires_at=0)
+        assert cache.get("a.b.two") is None
+        cache.put("a.b.three", {"id": 3})
+        cache.get("a.b.one")
+        cache.put("a.b.four", {"id": 4})
+        assert cache.get("a.b.one") == {"id": 1}
+        assert cache.get("a.b.three") is None
+    
+    def test_invalidate_user(self):
+        """Test dropping every cached token of a user"""
+        import main
+        cache = main.AuthCache()
+        cache.put("a.b.one", {"id": 1})
+        cache.put("a.b.two", {"id": 1})
+        cache.put("a.b.three", {"id": 2})
+        cache.invalidate_user(1)
+        assert cache.get("a.b.one") is None
+        assert cache.get("a.b.two") is None
+        assert cache.get("a.b.three") == {"id": 2}
+
 # ==================== SWEETS CRUD TESTS ====================
 
 class TestSweets:
@@ -317,6 +460,138 @@ class TestSweets:
             headers={"Authorization": f"Bearer {token}"})
         assert response.status_code == 403
 
+# ==================== CATALOG CACHE TESTS ====================
+
+class TestCatalogCache:
+    """Test suite for the cached catalog listing"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def test_repeat_reads_hit_cache(self):
+        """Test that the second catalog read is served from memory"""
+        import main
+        first = client.get("/api/sweets")
+        hits = main.catalog_cache.stats()["hits"]
+        second = client.get("/api/sweets")
+        assert second.json() == first.json()
+        assert main.catalog_cache.stats()["hits"] == hits + 1
+    
+    def test_purchase_invalidates_cache(self):
+        """Test that stock changes are visible on the next read"""
+        token = self.get_admin_token()
+        before = {s["id"]: s["quantity"] for s in client.get("/api/sweets").json()}
+        client.post("/api/sweets/1/purchase",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"quantity": 1})
+        after = {s["id"]: s["quantity"] for s in client.get("/api/sweets").json()}
+        assert after[1] == before[1] - 1
+    
+    def test_create_and_delete_invalidate_cache(self):
+        """Test that catalog edits are visible on the next read"""
+        token = self.get_admin_token()
+        client.get("/api/sweets")
+        created = client.post("/api/sweets",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"name": "Cached Sweet", "category": "Barfi", "price": 10, "quantity": 1, "img": "x.jpg"}).json()
+        assert any(s["id"] == created["id"] for s in client.get("/api/sweets").json())
+        client.delete(f"/api/sweets/{created['id']}",
+            headers={"Authorization": f"Bearer {token}"})
+        assert not any(s["id"] == created["id"] for s in client.get("/api/sweets").json())
+    
+    def test_stale_body_is_not_stored(self):
+        """Test that a body built before a write is discarded"""
+        import main
+        cache = main.CatalogCache()
+        _, version, _ = cache.lookup()
+        cache.invalidate()
+        cache.store(b"[]", version)
+        assert cache.lookup()[0] is None
+
+# ==================== CONDITIONAL REQUEST TESTS ====================
+
+class TestConditionalRequests:
+    """Test suite for ETag and Last-Modified handling on catalog reads"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def test_catalog_if_none_match(self):
+        """Test that a matching ETag returns 304 with no body"""
+        response = client.get("/api/sweets")
+        etag = response.headers["etag"]
+        
+        response = client.get("/api/sweets", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+    
+    def test_etag_changes_after_write(self):
+        """Test that a catalog write invalidates outstanding ETags"""
+        token = self.get_admin_token()
+        etag = client.get("/api/sweets").headers["etag"]
+        client.post("/api/sweets/1/restock",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"quantity": 1})
+        
+        response = client.get("/api/sweets", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+    
+    def test_sweet_and_search_if_none_match(self):
+        """Test conditional requests on a single sweet and on search"""
+        for url in ["/api/sweets/1", "/api/sweets/search?category=Barfi"]:
+            etag = client.get(url).headers["etag"]
+            response = client.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+    
+    def test_if_modified_since_uses_given_headers(self):
+        """Test that If-Modified-Since is judged by the Last-Modified in the response headers"""
+        import main
+        from starlette.requests import Request
+        headers = main.catalog_headers(1, time.time() - 100)
+        request = Request({
+            "type": "http",
+            "headers": [(b"if-modified-since", headers["Last-Modified"].encode())]
+        })
+        main.catalog_cache.invalidate()  # the cache moves on after the headers were built
+        assert main.is_not_modified(request, headers)
+    
+    def test_missing_sweet_ignores_validators(self):
+        """Test that an unknown sweet is a 404 even with a matching catalog ETag"""
+        etag = client.get("/api/sweets").headers["etag"]
+        response = client.get("/api/sweets/99999", headers={"If-None-Match": etag})
+        assert response.status_code == 404
+        response = build_async_client().get("/api/sweets/99999", headers={"If-None-Match": etag})
+        assert response.status_code == 404
+    
+    def test_if_modified_since(self):
+        """Test Last-Modified once the last write is more than a second old"""
+        import main
+        main.catalog_cache.last_modified -= 10
+        response = client.get("/api/sweets")
+        last_modified = response.headers["last-modified"]
+        
+        response = client.get("/api/sweets", headers={"If-Modified-Since": last_modified})
+        assert response.status_code == 304
+    
+    def test_fresh_write_has_no_last_modified(self):
+        """Test that Last-Modified is withheld during the second of a write"""
+        import main
+        main.catalog_cache.invalidate()
+        response = client.get("/api/sweets")
+        assert "last-modified" not in response.headers
+
 # ==================== SEARCH TESTS ====================
 
 class TestSearch:
@@ -359,6 +634,130 @@ class TestSearch:
         assert response.status_code == 200
         data = response.json()
         assert len(data) == 0
+    
+    def test_search_name_without_words(self):
+        """Test that a name with nothing searchable in it matches no sweets"""
+        for url in ["/api/sweets/search?name=!!!", "/api/sweets/search?name=!!!&limit=5", "/api/sweets/search?name=%25&category=Barfi"]:
+            response = client.get(url)
+            assert response.status_code == 200
+            assert response.json() == []
+    
+    def test_search_by_prefix(self):
+        """Test that partial words match as prefixes"""
+        response = client.get("/api/sweets/search?name=jam")
+        names = [sweet["name"] for sweet in response.json()]
+        assert names == ["Gulab Jamun"]
+    
+    def test_search_matches_description(self):
+        """Test that search covers the description"""
+        response = client.get("/api/sweets/search?name=cashew")
+        names = [sweet["name"] for sweet in response.json()]
+        assert names == ["Kaju Barfi"]
+    
+    def test_search_ranks_name_matches_first(self):
+        """Test that a name hit outranks description hits"""
+        login = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        token = login.json()["access_token"]
+        client.post("/api/sweets",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"name": "Syrup Roll", "category": "Halwa", "price": 20, "quantity": 3, "img": "x.jpg"})
+        
+        response = client.get("/api/sweets/search?name=syrup")
+        names = [sweet["name"] for sweet in response.json()]
+        assert names[0] == "Syrup Roll"
+        assert len(names) == 4
+    
+    def test_search_index_follows_updates(self):
+        """Test that renamed and deleted sweets are reflected in search"""
+        login = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        client.put("/api/sweets/1", headers=headers, json={"name": "Patisa"})
+        assert client.get("/api/sweets/search?name=patisa").json()[0]["id"] == 1
+        assert client.get("/api/sweets/search?name=soan").json() == []
+        
+        client.delete("/api/sweets/1", headers=headers)
+        assert client.get("/api/sweets/search?name=patisa").json() == []
+
+# ==================== PAGINATION TESTS ====================
+
+class TestPagination:
+    """Test suite for cursor pagination on list endpoints"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def collect_pages(self, url, limit, headers=None, filters=None):
+        """Helper following next cursors until the last page"""
+        items, cursor = [], None
+        while True:
+            params = {"limit": limit, **(filters or {})}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get(url, params=params, headers=headers or {})
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page) <= limit
+            items.extend(page)
+            cursor = response.headers.get("x-next-cursor")
+            if not cursor:
+                return items
+    
+    def test_catalog_pages_cover_every_sweet(self):
+        """Test that pages partition the catalog even when timestamps tie"""
+        pages = self.collect_pages("/api/sweets", 3)
+        full = client.get("/api/sweets").json()
+        assert [s["id"] for s in pages] == [s["id"] for s in full]
+    
+    def test_search_pages(self):
+        """Test paginating a filtered search"""
+        items = self.collect_pages("/api/sweets/search", 2, filters={"category": "Laddoo"})
+        assert len(items) == 4
+        assert len({s["id"] for s in items}) == 4
+    
+    def test_insert_between_pages_is_not_repeated(self):
+        """Test that rows created after the first page do not shift later pages"""
+        token = self.get_admin_token()
+        first = client.get("/api/sweets", params={"limit": 4})
+        client.post("/api/sweets",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"name": "Late Sweet", "category": "Barfi", "price": 10, "quantity": 1, "img": "x.jpg"})
+        rest = client.get("/api/sweets", params={"limit": 100, "cursor": first.headers["x-next-cursor"]})
+        ids = [s["id"] for s in first.json()] + [s["id"] for s in rest.json()]
+        assert len(ids) == 10
+        assert len(set(ids)) == 10
+    
+    def test_history_pages(self):
+        """Test paginating purchase and restock history"""
+        token = self.get_admin_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        for _ in range(5):
+            client.post("/api/sweets/2/purchase", headers=headers, json={"quantity": 1})
+            client.post("/api/sweets/2/restock", headers=headers, json={"quantity": 1})
+        
+        purchases = self.collect_pages("/api/purchases/history", 2, headers)
+        restocks = self.collect_pages("/api/admin/restock-history", 2, headers)
+        assert len({p["id"] for p in purchases}) == 5
+        assert len({r["id"] for r in restocks}) == 5
+    
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        response = client.get("/api/sweets", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+    
+    def test_limit_bounds(self):
+        """Test that page sizes are validated"""
+        assert client.get("/api/sweets", params={"limit": 0}).status_code == 422
 
 # ==================== INVENTORY TESTS ====================
 
@@ -414,6 +813,38 @@ class TestInventory:
         assert response.status_code == 400
         assert "insufficient stock" in response.json()["detail"].lower()
     
+    def test_purchase_nonexistent_sweet(self):
+        """Test purchasing a sweet that does not exist"""
+        token = self.get_user_token()
+        response = client.post("/api/sweets/9999/purchase",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"quantity": 1})
+        assert response.status_code == 404
+    
+    def test_concurrent_purchases_never_oversell(self):
+        """Test that hundreds of parallel buyers cannot drive stock below zero"""
+        from concurrent.futures import ThreadPoolExecutor
+        token = self.get_user_token()
+        admin_token = self.get_admin_token()
+        client.put("/api/sweets/1",
+            headers={"Authorization": f"Bearer {admin_token}"},
+            json={"quantity": 50})
+        
+        def buy(_):
+            return client.post("/api/sweets/1/purchase",
+                headers={"Authorization": f"Bearer {token}"},
+                json={"quantity": 1}).status_code
+        
+        with ThreadPoolExecutor(max_workers=50) as executor:
+            statuses = list(executor.map(buy, range(300)))
+        
+        assert statuses.count(200) == 50
+        assert statuses.count(400) == 250
+        assert client.get("/api/sweets/1").json()["quantity"] == 0
+        with get_db() as conn:
+            sold = conn.execute("SELECT SUM(quantity) FROM purchases WHERE sweet_id = 1").fetchone()[0]
+        assert sold == 50
+    
     def test_purchase_zero_quantity(self):
         """Test purchasing zero quantity"""
         token = self.get_user_token()
@@ -461,6 +892,84 @@ class TestInventory:
             json={"quantity": 10})
         assert response.status_code == 404
 
+# ==================== ORDER TESTS ====================
+
+class TestOrders:
+    """Test suite for whole-cart checkout"""
+    
+    def get_user_token(self):
+        """Helper to get user token"""
+        client.post("/api/auth/register", json={
+            "username": "orderuser",
+            "email": "order@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": "order@example.com",
+            "password": "password123"
+        })
+        return response.json()["access_token"]
+    
+    def test_place_order_success(self):
+        """Test buying several sweets in one order"""
+        token = self.get_user_token()
+        stock_1 = client.get("/api/sweets/1").json()["quantity"]
+        stock_2 = client.get("/api/sweets/2").json()["quantity"]
+        
+        response = client.post("/api/orders",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"items": [
+                {"sweet_id": 1, "quantity": 2},
+                {"sweet_id": 2, "quantity": 3},
+                {"sweet_id": 1, "quantity": 1}
+            ]})
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["items"]) == 3
+        assert data["items"][0]["remaining_stock"] == stock_1 - 3
+        assert data["items"][1]["remaining_stock"] == stock_2 - 3
+        assert data["total_price"] == sum(line["total_price"] for line in data["items"])
+        assert client.get("/api/sweets/1").json()["quantity"] == stock_1 - 3
+        
+        history = client.get("/api/purchases/history",
+            headers={"Authorization": f"Bearer {token}"}).json()
+        assert len(history) == 3
+    
+    def test_place_order_is_all_or_nothing(self):
+        """Test that one failing line leaves every sweet untouched"""
+        token = self.get_user_token()
+        stock_1 = client.get("/api/sweets/1").json()["quantity"]
+        
+        response = client.post("/api/orders",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"items": [
+                {"sweet_id": 1, "quantity": 1},
+                {"sweet_id": 2, "quantity": 1000},
+                {"sweet_id": 9999, "quantity": 1}
+            ]})
+        assert response.status_code == 400
+        errors = {line["sweet_id"]: line["detail"] for line in response.json()["detail"]["items"]}
+        assert "insufficient stock" in errors[2].lower()
+        assert errors[9999] == "Sweet not found"
+        assert 1 not in errors
+        assert client.get("/api/sweets/1").json()["quantity"] == stock_1
+    
+    def test_place_empty_order(self):
+        """Test that an empty cart is rejected"""
+        token = self.get_user_token()
+        response = client.post("/api/orders",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"items": []})
+        assert response.status_code == 422
+    
+    def test_place_order_without_auth(self):
+        """Test placing an order without authentication"""
+        response = client.post("/api/orders",
+            json={"items": [{"sweet_id": 1, "quantity": 1}]})
+        assert response.status_code == 403
+
 # ==================== REPORTING TESTS ====================
 
 class TestReporting:
@@ -522,6 +1031,66 @@ class TestReporting:
         data = response.json()
         assert len(data) > 0
     
+    def test_stream_restock_history(self):
+        """Test exporting restock history as NDJSON"""
+        import json
+        import main
+        token = self.get_admin_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        for sweet_id in (1, 2, 3):
+            client.post(f"/api/sweets/{sweet_id}/restock", headers=headers, json={"quantity": 5})
+        
+        main.STREAM_BATCH_SIZE = 2
+        try:
+            by_param = client.get("/api/admin/restock-history?stream=1", headers=headers)
+            by_accept = client.get("/api/admin/restock-history",
+                headers={**headers, "Accept": "application/x-ndjson"})
+        finally:
+            main.STREAM_BATCH_SIZE = 500
+        
+        for response in (by_param, by_accept):
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("application/x-ndjson")
+            rows = [json.loads(line) for line in response.text.splitlines()]
+            assert [row["sweet_id"] for row in rows] == [3, 2, 1]
+            assert rows[0]["admin_name"] == "Admin"
+    
+    def test_get_all_purchases_as_admin(self):
+        """Test the admin purchase report as a list and as a stream"""
+        import json
+        user_token = self.get_user_token()
+        client.post("/api/sweets/1/purchase",
+            headers={"Authorization": f"Bearer {user_token}"},
+            json={"quantity": 2})
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        
+        listed = client.get("/api/admin/purchases", headers=headers).json()
+        streamed = client.get("/api/admin/purchases?stream=1", headers=headers)
+        rows = [json.loads(line) for line in streamed.text.splitlines()]
+        assert rows == listed
+        assert rows[0]["username"] == "historyuser"
+    
+    def test_stream_with_single_connection_pool(self):
+        """Test that an export streams on the request's connection instead of checking out another"""
+        import json
+        import main
+        main.get_pool().close()
+        main._pool = main.ConnectionPool(TEST_DATABASE, size=1, timeout=1)
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        client.post("/api/sweets/1/restock", headers=headers, json={"quantity": 5})
+        
+        response = client.get("/api/admin/restock-history?stream=1", headers=headers)
+        assert response.status_code == 200
+        assert [json.loads(line)["sweet_id"] for line in response.text.splitlines()] == [1]
+        assert main.get_pool().stats()["in_use"] == 0
+    
+    def test_get_all_purchases_as_user(self):
+        """Test the admin purchase report as user (should fail)"""
+        token = self.get_user_token()
+        response = client.get("/api/admin/purchases?stream=1",
+            headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 403
+    
     def test_get_restock_history_as_user(self):
         """Test retrieving restock history as user (should fail)"""
         token = self.get_user_token()
@@ -529,4 +1098,1353 @@ class TestReporting:
             headers={"Authorization": f"Bearer {token}"})
         assert response.status_code == 403
 
-# Run tests with: pytest test_main.py -v --cov=main --cov-report=html
\ No newline at end of file
+# ==================== QUERY PLAN TESTS ====================
+
+class TestQueryPlans:
+    """Test suite checking that hot queries are served by indexes"""
+    
+    def query_plan(self, query, params=()):
+        """Helper returning the EXPLAIN QUERY PLAN detail lines"""
+        with get_db() as conn:
+            return [row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+    
+    def assert_uses_indexes(self, plan):
+        """Helper asserting that no table in the plan is read by a full scan"""
+        for detail in plan:
+            if detail.startswith(("SCAN", "SEARCH")):
+                assert "USING" in detail, plan
+    
+    def test_migrations_recorded(self):
+        """Test that init_db records the applied schema version"""
+        import main
+        with get_db() as conn:
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == len(main.MIGRATIONS)
+    
+    def test_catalog_listing_uses_index(self):
+        """Test that the catalog is read in created_at order from an index"""
+        import main
+        plan = self.query_plan(*main.build_sweets_query())
+        self.assert_uses_indexes(plan)
+        assert not any("TEMP B-TREE" in detail for detail in plan)
+    
+    def test_search_uses_index(self):
+        """Test category and price filters"""
+        import main
+        for filters in [{"category": "Barfi"}, {"min_price": 10, "max_price": 60},
+                        {"category": "Barfi", "min_price": 10}]:
+            query, params = main.build_search_query(**filters)
+            plan = self.query_plan(query, params)
+            self.assert_uses_indexes(plan)
+            assert any("idx_sweets_" in detail for detail in plan)
+    
+    def test_purchase_history_uses_index(self):
+        """Test that a user's purchases are found and ordered by index"""
+        import main
+        plan = self.query_plan(*main.build_purchase_history_query(1))
+        self.assert_uses_indexes(plan)
+        assert any("idx_purchases_user_date" in detail for detail in plan)
+        assert not any("TEMP B-TREE" in detail for detail in plan)
+    
+    def test_restock_history_uses_index(self):
+        """Test that restock history is read in date order from an index"""
+        import main
+        plan = self.query_plan(*main.build_restock_history_query())
+        self.assert_uses_indexes(plan)
+        assert any("idx_restock_history_date" in detail for detail in plan)
+    
+    def test_pages_use_indexes(self):
+        """Test that keyset pages seek into the index instead of scanning"""
+        import main
+        for query, params in [main.build_sweets_query(["2024-01-01", 5], 10),
+                              main.build_all_purchases_query(["2024-01-01", 5], 10),
+                              main.build_purchase_history_query(1, ["2024-01-01", 5], 10),
+                              main.build_restock_history_query(["2024-01-01", 5], 10)]:
+            plan = self.query_plan(query, params)
+            self.assert_uses_indexes(plan)
+            assert not any("TEMP B-TREE" in detail for detail in plan)
+    
+    def test_name_search_uses_fts(self):
+        """Test that name search goes through the full-text index"""
+        import main
+        query, params = main.build_search_query(name="laddu", category="Laddoo")
+        plan = self.query_plan(query, params)
+        assert any("sweets_fts VIRTUAL TABLE" in detail for detail in plan)
+        assert any("INTEGER PRIMARY KEY" in detail for detail in plan)
+
+# ==================== CONNECTION POOL TESTS ====================
+
+class TestConnectionPool:
+    """Test suite for the pooled database connections"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def test_connections_are_reused(self):
+        """Test that a released connection is handed out again"""
+        with get_db() as first:
+            pass
+        with get_db() as second:
+            assert second is first
+            assert second.row_factory is sqlite3.Row
+    
+    def test_request_shares_one_connection(self):
+        """Test that a request checks out at most one connection"""
+        token = self.get_admin_token()
+        import main
+        before = main.get_pool().stats()["checkouts"]
+        response = client.post("/api/sweets/1/purchase",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"quantity": 1})
+        assert response.status_code == 200
+        assert main.get_pool().stats()["checkouts"] == before + 1
+    
+    def test_write_waits_without_a_connection(self, monkeypatch):
+        """Test that a write route holds no pooled connection while the writer runs its job"""
+        token = self.get_admin_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        import main
+        client.get("/api/purchases/history", headers=headers)  # token is now in the auth cache
+        in_use = []
+        apply_purchase = main.apply_purchase
+        
+        def recording_purchase(conn, *args):
+            in_use.append(main.get_pool().stats()["in_use"])
+            return apply_purchase(conn, *args)
+        
+        monkeypatch.setattr(main, "apply_purchase", recording_purchase)
+        before = main.get_pool().stats()["checkouts"]
+        response = client.post("/api/sweets/1/purchase", headers=headers, json={"quantity": 1})
+        assert response.status_code == 200
+        assert in_use == [0]
+        assert main.get_pool().stats()["checkouts"] == before
+    
+    def test_pool_exhaustion_times_out(self):
+        """Test that waiting for a connection gives up with a 503"""
+        import main
+        from fastapi import HTTPException
+        pool = main.ConnectionPool(TEST_DATABASE, size=1, timeout=0.01)
+        conn = pool.acquire()
+        with pytest.raises(HTTPException) as exc_info:
+            pool.acquire()
+        assert exc_info.value.status_code == 503
+        pool.release(conn)
+        assert pool.stats()["timeouts"] == 1
+        pool.close()
+    
+    def test_pool_stats_as_admin(self):
+        """Test that pool metrics are exposed to admins"""
+        token = self.get_admin_token()
+        response = client.get("/api/admin/stats",
+            headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        stats = response.json()["db_pool"]
+        assert stats["size"] >= 1
+        assert stats["checkouts"] > 0
+
+# ==================== STORAGE PROFILE TESTS ====================
+
+class TestStorageProfile:
+    """Test suite for the SQLite storage profile"""
+    
+    def test_database_uses_wal(self):
+        """Test that init_db switches the database to WAL"""
+        with get_db() as conn:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode.lower() == "wal"
+    
+    def test_pragmas_applied_to_connections(self):
+        """Test that every pooled connection carries the profile pragmas"""
+        with get_db() as conn:
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+            assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+            assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    
+    def test_checkpoint_wal(self):
+        """Test a passive WAL checkpoint"""
+        import main
+        result = main.checkpoint_wal()
+        assert result["busy"] is False
+        assert result["checkpointed_pages"] <= result["wal_pages"]
+    
+    def test_periodic_task_runs(self):
+        """Test that periodic tasks fire and can be stopped"""
+        import main
+        import threading
+        fired = threading.Event()
+        task = main.PeriodicTask("test-task", 0.01, fired.set)
+        task.start()
+        assert fired.wait(timeout=2)
+        task.stop()
+
+# ==================== WRITE QUEUE TESTS ====================
+
+class TestWriteQueue:
+    """Test suite for the group-committing single writer"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def test_jobs_share_one_commit(self):
+        """Test that jobs queued inside the window are committed as one batch"""
+        import main
+        writer = main.WriteQueue(window=0.5)
+        admin = {"id": 1, "username": "admin"}
+        sweet = client.get("/api/sweets/1").json()
+        try:
+            futures = [
+                writer.submit(main.apply_purchase, admin, 1, main.PurchaseRequest(quantity=1))
+                for _ in range(5)
+            ]
+            results = [future.result(timeout=5) for future in futures]
+        finally:
+            writer.stop()
+        
+        assert sorted(result["remaining_stock"] for result in results) == list(
+            range(sweet["quantity"] - 5, sweet["quantity"])
+        )
+        stats = writer.stats()
+        assert stats["batches"] == 1
+        assert stats["committed"] == 5
+        assert client.get("/api/sweets/1").json()["quantity"] == sweet["quantity"] - 5
+    
+    def test_failed_job_rolls_back_alone(self):
+        """Test that one failing job does not undo the rest of its batch"""
+        import main
+        from fastapi import HTTPException
+        writer = main.WriteQueue(window=0.5)
+        admin = {"id": 1, "username": "admin"}
+        sweet = client.get("/api/sweets/1").json()
+        try:
+            ok = writer.submit(main.apply_purchase, admin, 1, main.PurchaseRequest(quantity=1))
+            too_many = writer.submit(main.apply_purchase, admin, 1, main.PurchaseRequest(quantity=sweet["quantity"] + 1))
+            missing = writer.submit(main.apply_restock, admin, 99999, main.RestockRequest(quantity=5))
+            restock = writer.submit(main.apply_restock, admin, 1, main.RestockRequest(quantity=10))
+            
+            assert ok.result(timeout=5)["remaining_stock"] == sweet["quantity"] - 1
+            with pytest.raises(HTTPException) as error:
+                too_many.result(timeout=5)
+            assert error.value.status_code == 400
+            with pytest.raises(HTTPException) as error:
+                missing.result(timeout=5)
+            assert error.value.status_code == 404
+            assert restock.result(timeout=5)["new_stock"] == sweet["quantity"] + 9
+        finally:
+            writer.stop()
+        
+        assert writer.stats()["batches"] == 1
+        assert writer.stats()["failed"] == 2
+        assert client.get("/api/sweets/1").json()["quantity"] == sweet["quantity"] + 9
+        with get_db() as conn:
+            purchases = conn.execute("SELECT COUNT(*) FROM purchases WHERE sweet_id = 1").fetchone()[0]
+        assert purchases == 1
+    
+    def test_write_queue_stats(self):
+        """Test that the admin stats report the writer"""
+        token = self.get_admin_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        client.post("/api/sweets/1/restock", json={"quantity": 5}, headers=headers)
+        
+        response = client.get("/api/admin/stats", headers=headers)
+        assert response.status_code == 200
+        stats = response.json()["write_queue"]
+        assert stats["committed"] >= 1
+        assert stats["batches"] >= 1
+    
+    def test_only_catalog_jobs_invalidate_the_cache(self):
+        """Test that jobs queued with catalog=False leave the catalog ETag alone"""
+        import main
+        etag = client.get("/api/sweets").headers["etag"]
+        main.write_queue.run(lambda conn: conn.execute("SELECT 1"), catalog=False)
+        main.purge_idempotency()
+        assert client.get("/api/sweets").headers["etag"] == etag
+        
+        main.write_queue.run(lambda conn: conn.execute("UPDATE sweets SET price = price + 1 WHERE id = 1"))
+        assert client.get("/api/sweets").headers["etag"] != etag
+
+# ==================== SEED TESTS ====================
+
+class TestSeed:
+    """Test suite for the synthetic data generator"""
+    
+    def test_seed_database(self):
+        """Test that seeding appends realistic rows and keeps the schema intact"""
+        import seed
+        with get_db() as conn:
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        
+        seed.seed_database(TEST_DATABASE, sweets=50, users=20, purchases=500, restocks=30, seed=1, log=lambda message: None)
+        
+        with get_db() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM sweets").fetchone()[0] == 60
+            assert conn.execute("SELECT COUNT(*) FROM users WHERE role = 'user'").fetchone()[0] == 20
+            assert conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0] == 500
+            assert conn.execute("SELECT COUNT(*) FROM restock_history").fetchone()[0] == 30
+            assert conn.execute(
+                "SELECT COUNT(*) FROM purchases p JOIN sweets s ON s.id = p.sweet_id WHERE p.total_price = s.price * p.quantity"
+            ).fetchone()[0] == 500
+            assert {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")} == indexes
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == version
+            assert conn.execute("SELECT SUM(purchases) FROM sales_daily").fetchone()[0] == 500
+            assert conn.execute("SELECT SUM(units) FROM sales_by_category").fetchone()[0] == (
+                conn.execute("SELECT SUM(quantity) FROM purchases").fetchone()[0]
+            )
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+        
+        # Seeded sweets are searchable and seeded users can log in
+        response = client.get("/api/sweets/search?name=kesar")
+        assert response.status_code == 200
+        assert len(response.json()) > 0
+        response = client.post("/api/auth/login", json={
+            "email": seed.user_email(0),
+            "password": seed.DEFAULT_PASSWORD
+        })
+        assert response.status_code == 200
+    
+    def test_seed_appends(self):
+        """Test that a second run numbers its users after the first"""
+        import seed
+        seed.seed_database(TEST_DATABASE, sweets=5, users=3, purchases=10, seed=1, log=lambda message: None)
+        seed.seed_database(TEST_DATABASE, sweets=5, users=3, purchases=10, seed=2, log=lambda message: None)
+        with get_db() as conn:
+            emails = [row[0] for row in conn.execute("SELECT email FROM users WHERE role = 'user' ORDER BY id")]
+        assert emails == [seed.user_email(n) for n in range(6)]
+    
+    def test_failed_seed_keeps_indexes_and_triggers(self):
+        """Test that a rejected load still restores everything it dropped"""
+        import seed
+        schema = "SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name"
+        with get_db() as conn:
+            before = conn.execute(schema).fetchall()
+        
+        with pytest.raises(ValueError):
+            seed.seed_database(TEST_DATABASE, sweets=5, users=0, purchases=10, seed=1, log=lambda message: None)
+        
+        with get_db() as conn:
+            assert conn.execute(schema).fetchall() == before
+            assert any(row[1] == "sales_aggregate_insert" for row in before)
+
+# ==================== METRICS TESTS ====================
+
+class TestMetrics:
+    """Test suite for the Prometheus metrics endpoint"""
+    
+    def get_user_token(self):
+        """Helper to get user token"""
+        client.post("/api/auth/register", json={
+            "username": "metricsuser",
+            "email": "metrics@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": "metrics@example.com",
+            "password": "password123"
+        })
+        return response.json()["access_token"]
+    
+    def test_metrics_endpoint(self):
+        """Test that /metrics serves the Prometheus text format"""
+        client.get("/api/sweets")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        assert "# TYPE sweetshop_http_request_duration_seconds histogram" in body
+        assert 'sweetshop_http_requests_total{method="GET",route="/api/sweets",status="200"}' in body
+        assert 'sweetshop_catalog_cache_requests_total{result="hit"}' in body
+        assert 'sweetshop_db_pool_connections{state="in_use"}' in body
+    
+    def test_purchase_is_broken_down(self):
+        """Test that a purchase records route, query, commit, batch and bcrypt timings"""
+        import main
+        token = self.get_user_token()
+        route = "/api/sweets/{sweet_id}/purchase"
+        requests_before = main.HTTP_REQUESTS.value("POST", route, "200")
+        queries_before = main.DB_QUERY_LATENCY.count("purchase.decrement_stock")
+        inserts_before = main.DB_QUERY_LATENCY.count("purchase.insert")
+        commits_before = main.DB_COMMIT_LATENCY.count()
+        
+        response = client.post("/api/sweets/1/purchase", json={"quantity": 1}, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        
+        assert main.HTTP_REQUESTS.value("POST", route, "200") == requests_before + 1
+        assert main.HTTP_LATENCY.count("POST", route) >= 1
+        assert main.DB_QUERY_LATENCY.count("purchase.decrement_stock") == queries_before + 1
+        assert main.DB_QUERY_LATENCY.count("purchase.insert") == inserts_before + 1
+        assert main.DB_COMMIT_LATENCY.count() > commits_before
+        assert main.WRITE_BATCH_SIZE.count() >= 1
+        assert main.PASSWORD_LATENCY.count("verify") >= 1
+        assert main.PASSWORD_LATENCY.count("hash") >= 1
+    
+    def test_unmatched_routes_share_a_label(self):
+        """Test that unknown paths do not create a series per URL"""
+        import main
+        before = main.HTTP_REQUESTS.value("GET", "unmatched", "404")
+        client.get("/no/such/path/1")
+        client.get("/no/such/path/2")
+        assert main.HTTP_REQUESTS.value("GET", "unmatched", "404") == before + 2
+    
+    def test_histogram_rendering(self):
+        """Test cumulative buckets, sum, count and label escaping"""
+        import main
+        histogram = main.Histogram("test_seconds", "Test histogram", ("name",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'a"b')
+        histogram.observe(0.5, 'a"b')
+        histogram.observe(5, 'a"b')
+        lines = histogram.render()
+        assert 'test_seconds_bucket{name="a\\"b",le="0.1"} 1' in lines
+        assert 'test_seconds_bucket{name="a\\"b",le="1.0"} 2' in lines
+        assert 'test_seconds_bucket{name="a\\"b",le="+Inf"} 3' in lines
+        assert 'test_seconds_sum{name="a\\"b"} 5.55' in lines
+        assert 'test_seconds_count{name="a\\"b"} 3' in lines
+
+# ==================== ASYNC MODE TESTS ====================
+
+def build_async_client():
+    """TestClient for an app serving the async variants of the hot endpoints"""
+    import main
+    from fastapi import FastAPI
+    async_app = FastAPI()
+    async_app.add_api_route("/api/sweets", main.get_sweets_async, methods=["GET"])
+    async_app.add_api_route("/api/sweets/search", main.search_sweets_async, methods=["GET"])
+    async_app.add_api_route("/api/sweets/{sweet_id}", main.get_sweet_async, methods=["GET"])
+    async_app.add_api_route("/api/sweets/{sweet_id}/purchase", main.purchase_sweet_async, methods=["POST"])
+    return TestClient(async_app)
+
+class TestAsyncMode:
+    """Test suite for the async request path (SWEETSHOP_ASYNC_DB=1)"""
+    
+    def get_user_token(self):
+        client.post("/api/auth/register", json={
+            "username": "asyncuser",
+            "email": "async@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": "async@example.com",
+            "password": "password123"
+        })
+        return response.json()["access_token"]
+    
+    def test_async_catalog_matches_sync(self):
+        """Test that both request paths serve the same catalog"""
+        async_client = build_async_client()
+        sync_response = client.get("/api/sweets")
+        async_response = async_client.get("/api/sweets")
+        assert async_response.status_code == 200
+        assert async_response.json() == sync_response.json()
+        assert async_response.headers["etag"] == sync_response.headers["etag"]
+        
+        response = async_client.get("/api/sweets", headers={"If-None-Match": async_response.headers["etag"]})
+        assert response.status_code == 304
+    
+    def test_async_pagination(self):
+        """Test keyset pages on the async catalog"""
+        async_client = build_async_client()
+        response = async_client.get("/api/sweets?limit=3")
+        assert response.status_code == 200
+        assert len(response.json()) == 3
+        assert "x-next-cursor" in response.headers
+    
+    def test_async_search_and_get(self):
+        """Test search and single-sweet lookups on the async path"""
+        async_client = build_async_client()
+        response = async_client.get("/api/sweets/search?name=Laddu")
+        assert response.status_code == 200
+        sweets = response.json()
+        assert len(sweets) > 0
+        
+        response = async_client.get(f"/api/sweets/{sweets[0]['id']}")
+        assert response.status_code == 200
+        assert response.json()["name"] == sweets[0]["name"]
+        
+        response = async_client.get("/api/sweets/99999")
+        assert response.status_code == 404
+    
+    def test_async_purchase(self):
+        """Test purchases, stock errors and auth on the async path"""
+        async_client = build_async_client()
+        token = self.get_user_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        sweet = client.get("/api/sweets").json()[0]
+        
+        response = async_client.post(f"/api/sweets/{sweet['id']}/purchase", json={"quantity": 1}, headers=headers)
+        assert response.status_code == 200
+        assert response.json()["remaining_stock"] == sweet["quantity"] - 1
+        
+        response = async_client.post(
+            f"/api/sweets/{sweet['id']}/purchase",
+            json={"quantity": sweet["quantity"] + 1},
+            headers=headers
+        )
+        assert response.status_code == 400
+        
+        response = async_client.post("/api/sweets/99999/purchase", json={"quantity": 1}, headers=headers)
+        assert response.status_code == 404
+        
+        response = async_client.post(
+            f"/api/sweets/{sweet['id']}/purchase",
+            json={"quantity": 1},
+            headers={"Authorization": "Bearer invalid"}
+        )
+        assert response.status_code == 401
+    
+    def test_async_purchase_idempotency_key(self):
+        """Test that a retried async purchase is replayed instead of bought twice"""
+        async_client = build_async_client()
+        headers = {"Authorization": f"Bearer {self.get_user_token()}", "Idempotency-Key": "async-retry"}
+        sweet = client.get("/api/sweets").json()[0]
+        
+        first = async_client.post(f"/api/sweets/{sweet['id']}/purchase", json={"quantity": 1}, headers=headers)
+        retry = async_client.post(f"/api/sweets/{sweet['id']}/purchase", json={"quantity": 1}, headers=headers)
+        assert retry.status_code == 200
+        assert retry.headers["idempotent-replayed"] == "true"
+        assert retry.json() == first.json()
+        assert client.get(f"/api/sweets/{sweet['id']}").json()["quantity"] == sweet["quantity"] - 1
+
+    def test_async_app_survives_restart(self, tmp_path):
+        """Test the real app imported with SWEETSHOP_ASYNC_DB=1 across two startup/shutdown cycles"""
+        import subprocess
+        script = """
+from fastapi.testclient import TestClient
+import main
+assert main.ASYNC_DB
+for _ in range(2):
+    with TestClient(main.app) as client:
+        assert client.get("/api/sweets/1").status_code == 200
+        assert client.get("/api/sweets/search?name=Laddu").status_code == 200
+        assert client.get("/api/sweets/99999").status_code == 404
+"""
+        env = {**os.environ, "SWEETSHOP_ASYNC_DB": "1", "SWEETSHOP_DATABASE": str(tmp_path / "async.db")}
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=60
+        )
+        assert result.returncode == 0, result.stderr
+
+# ==================== PROFILING TESTS ====================
+
+class TestProfiling:
+    """Test suite for per-request profiling"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def test_admin_header_profiles_request(self):
+        """Test that an admin's X-Profile header captures a readable profile"""
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        response = client.get("/api/sweets/search?name=Laddu", headers={**headers, "X-Profile": "1"})
+        assert response.status_code == 200
+        profile_id = response.headers["x-profile-id"]
+        
+        profiles = client.get("/api/admin/profiles", headers=headers).json()
+        summary = next(profile for profile in profiles if str(profile["id"]) == profile_id)
+        assert summary["route"] == "/api/sweets/search"
+        assert summary["status"] == 200
+        assert summary["trigger"] == "header"
+        assert summary["duration_ms"] > 0
+        
+        response = client.get(f"/api/admin/profiles/{profile_id}?sort=cumulative&limit=500", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "search_sweets" in response.text
+        assert "function calls" in response.text
+    
+    def test_header_ignored_for_non_admins(self):
+        """Test that anonymous and regular users cannot trigger a profile"""
+        response = client.get("/api/sweets", headers={"X-Profile": "1"})
+        assert response.status_code == 200
+        assert "x-profile-id" not in response.headers
+        
+        response = client.get("/api/sweets", headers={"X-Profile": "1", "Authorization": "Bearer invalid"})
+        assert "x-profile-id" not in response.headers
+    
+    def test_sample_rate(self):
+        """Test that the admin endpoint turns sampling on and off"""
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        try:
+            response = client.put("/api/admin/profiling", json={"sample_rate": 1}, headers=headers)
+            assert response.status_code == 200
+            assert client.get("/api/admin/profiling", headers=headers).json()["sample_rate"] == 1
+            
+            response = client.get("/api/sweets/1")
+            assert "x-profile-id" in response.headers
+            profile = client.get("/api/admin/profiles", headers=headers).json()[0]
+            assert profile["trigger"] == "sampled"
+        finally:
+            client.put("/api/admin/profiling", json={"sample_rate": 0}, headers=headers)
+        
+        response = client.get("/api/sweets/1")
+        assert "x-profile-id" not in response.headers
+        
+        response = client.put("/api/admin/profiling", json={"sample_rate": 2}, headers=headers)
+        assert response.status_code == 422
+    
+    def test_profiles_admin_only(self):
+        """Test profile listing, clearing and 404s"""
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        assert client.get("/api/admin/profiles").status_code in (401, 403)
+        
+        client.get("/api/sweets", headers={**headers, "X-Profile": "1"})
+        response = client.delete("/api/admin/profiles", headers=headers)
+        assert response.status_code == 204
+        assert client.get("/api/admin/profiles", headers=headers).json() == []
+        assert client.get("/api/admin/profiles/99999", headers=headers).status_code == 404
+
+# ==================== SLOW QUERY LOG TESTS ====================
+
+class TestSlowQueryLog:
+    """Test suite for the slow-query log"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def test_slow_queries_recorded(self, tmp_path):
+        """Test that queries over the threshold are kept and written with their plans"""
+        import main
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        previous_path = main.slow_query_log.path
+        main.slow_query_log.path = str(tmp_path / "slow.log")
+        try:
+            response = client.put("/api/admin/slow-queries/settings", json={"threshold_ms": 0}, headers=headers)
+            assert response.status_code == 200
+            client.get("/api/sweets/search?category=Barfi&min_price=10")
+        finally:
+            client.put("/api/admin/slow-queries/settings", json={"threshold_ms": main.SLOW_QUERY_MS}, headers=headers)
+            main.slow_query_log.path = previous_path
+        
+        response = client.get("/api/admin/slow-queries", headers=headers)
+        assert response.status_code == 200
+        entry = next(entry for entry in response.json() if entry["query"] == "sweets.search")
+        assert entry["params"] == ["str", "float"]
+        assert any("idx_sweets_" in detail for detail in entry["plan"])
+        assert entry["full_scans"] == []
+        assert "Barfi" not in json.dumps(entry)
+        
+        with open(tmp_path / "slow.log") as f:
+            logged = [json.loads(line) for line in f]
+        assert "sweets.search" in {entry["query"] for entry in logged}
+        
+        client.delete("/api/admin/slow-queries", headers=headers)
+        assert client.get("/api/admin/slow-queries", headers=headers).json() == []
+    
+    def test_full_scans_flagged(self, tmp_path):
+        """Test that table scans and unexplainable statements are reported"""
+        import main
+        slow_log = main.SlowQueryLog(threshold_ms=0, path=str(tmp_path / "slow.log"))
+        with get_db() as conn:
+            entry = slow_log.record(conn, "test.scan", "SELECT * FROM sweets WHERE description LIKE ?", ("%ghee%",), 0.5)
+            assert entry["full_scans"] == ["SCAN sweets"]
+            
+            entry = slow_log.record(conn, "test.broken", "SELECT * FROM missing_table", (), 0.5)
+            assert entry["plan"] is None
+            assert "missing_table" in entry["explain_error"]
+        assert slow_log.stats()["recorded"] == 2
+        slow_log.close()
+    
+    def test_settings_admin_only(self):
+        """Test validation and access control on the slow-query endpoints"""
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        assert client.get("/api/admin/slow-queries").status_code in (401, 403)
+        response = client.put("/api/admin/slow-queries/settings", json={"threshold_ms": -1}, headers=headers)
+        assert response.status_code == 422
+
+# ==================== LOGGING TESTS ====================
+
+class RecordingHandler(logging.Handler):
+    """Handler keeping the records it receives"""
+    
+    def __init__(self):
+        super().__init__()
+        self.records = []
+    
+    def emit(self, record):
+        self.records.append(record)
+
+class TestLogging:
+    """Test suite for the queued JSON logging pipeline"""
+    
+    def test_queue_handler_installed(self):
+        """Test that the queue handler is on the root logger even when logging was configured first"""
+        import main
+        root = logging.getLogger()
+        assert main.log_handler in root.handlers
+        assert root.level == logging.getLevelName(main.LOG_LEVEL)
+    
+    def test_json_formatter(self):
+        """Test that records render as JSON with extra fields and tracebacks"""
+        import main
+        record = logging.makeLogRecord({
+            "name": "main", "levelname": "INFO", "msg": "Purchase made: %sx %s", "args": (2, "Peda"), "route": "/x"
+        })
+        entry = json.loads(main.JsonFormatter().format(record))
+        assert entry["message"] == "Purchase made: 2x Peda"
+        assert entry["route"] == "/x"
+        assert entry["level"] == "INFO"
+        
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.makeLogRecord({"msg": "failed", "exc_info": sys.exc_info()})
+        handler = main.LazyQueueHandler(queue.Queue())
+        entry = json.loads(main.JsonFormatter().format(handler.prepare(record)))
+        assert "ValueError: boom" in entry["exc"]
+    
+    def test_queue_handler_is_lazy_and_bounded(self):
+        """Test that messages are queued unformatted and dropped when the queue is full"""
+        import main
+        handler = main.LazyQueueHandler(queue.Queue(1))
+        test_logger = logging.getLogger("test.lazy")
+        test_logger.propagate = False
+        test_logger.addHandler(handler)
+        try:
+            test_logger.warning("first %s", "arg")
+            test_logger.warning("second %s", "arg")
+        finally:
+            test_logger.removeHandler(handler)
+        record = handler.queue.get_nowait()
+        assert record.msg == "first %s"
+        assert record.args == ("arg",)
+        assert handler.dropped == 1
+    
+    def test_catalog_reads_sampled(self):
+        """Test that successful catalog reads are sampled while other requests are always logged"""
+        import main
+        recorder = RecordingHandler()
+        main.access_logger.addHandler(recorder)
+        main.access_logger.setLevel(logging.INFO)
+        rates = main.access_sampler.rates
+        main.access_sampler.rates = {key: 0 for key in rates}
+        try:
+            client.get("/api/sweets")
+            client.get("/api/sweets/1")
+            client.get("/api/sweets/99999")
+            client.post("/api/auth/login", json={"email": "nobody@example.com", "password": "wrong"})
+        finally:
+            main.access_sampler.rates = rates
+            main.access_logger.setLevel(logging.NOTSET)
+            main.access_logger.removeHandler(recorder)
+        
+        logged = [(record.method, record.route, record.status) for record in recorder.records]
+        assert logged == [("GET", "/api/sweets/{sweet_id}", 404), ("POST", "/api/auth/login", 401)]
+        assert main.access_sampler.sampled_out >= 2
+
+# ==================== ANALYTICS TESTS ====================
+
+class TestAnalytics:
+    """Test suite for the materialized sales aggregates"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def get_user_token(self):
+        """Helper to get user token"""
+        client.post("/api/auth/register", json={
+            "username": "analyticsuser",
+            "email": "analytics@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": "analytics@example.com",
+            "password": "password123"
+        })
+        return response.json()["access_token"]
+    
+    def make_sales(self):
+        """Helper buying two sweets through a purchase and an order"""
+        headers = {"Authorization": f"Bearer {self.get_user_token()}"}
+        sweets = client.get("/api/sweets").json()
+        first, second = sweets[0], sweets[1]
+        client.post(f"/api/sweets/{first['id']}/purchase", json={"quantity": 3}, headers=headers)
+        client.post("/api/orders", json={"items": [
+            {"sweet_id": first["id"], "quantity": 1},
+            {"sweet_id": second["id"], "quantity": 2}
+        ]}, headers=headers)
+        return first, second
+    
+    def test_sales_are_aggregated(self):
+        """Test that purchases and orders land in the daily, top-seller and category views"""
+        first, second = self.make_sales()
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        
+        response = client.get("/api/admin/analytics/daily", headers=headers)
+        assert response.status_code == 200
+        days = response.json()
+        assert len(days) == 1
+        assert days[0]["units"] == 6
+        assert days[0]["purchases"] == 3
+        assert days[0]["revenue"] == pytest.approx(first["price"] * 4 + second["price"] * 2)
+        
+        response = client.get("/api/admin/analytics/top-sellers?by=units", headers=headers)
+        top = response.json()
+        assert [(row["sweet_id"], row["units"]) for row in top] == [(first["id"], 4), (second["id"], 2)]
+        assert top[0]["sweet_name"] == first["name"]
+        
+        response = client.get("/api/admin/analytics/categories", headers=headers)
+        categories = {row["category"]: row["units"] for row in response.json()}
+        expected = {}
+        for sweet, units in ((first, 4), (second, 2)):
+            expected[sweet["category"]] = expected.get(sweet["category"], 0) + units
+        assert categories == expected
+    
+    def test_aggregates_match_rebuild(self):
+        """Test that the trigger-maintained tables equal a full recompute"""
+        import main
+        self.make_sales()
+        with get_db() as conn:
+            daily = conn.execute("SELECT * FROM sales_daily ORDER BY day, sweet_id").fetchall()
+            by_category = conn.execute("SELECT * FROM sales_by_category ORDER BY day, category").fetchall()
+            main.rebuild_sales_aggregates(conn)
+            assert conn.execute("SELECT * FROM sales_daily ORDER BY day, sweet_id").fetchall() == daily
+            assert conn.execute("SELECT * FROM sales_by_category ORDER BY day, category").fetchall() == by_category
+    
+    def test_date_ranges(self):
+        """Test inclusive day filters and their validation"""
+        self.make_sales()
+        headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        today = datetime.utcnow().date()
+        yesterday = today - timedelta(days=1)
+        
+        response = client.get(f"/api/admin/analytics/daily?start={today}&end={today}", headers=headers)
+        assert len(response.json()) == 1
+        response = client.get(f"/api/admin/analytics/top-sellers?end={yesterday}", headers=headers)
+        assert response.json() == []
+        response = client.get(f"/api/admin/analytics/categories?start={today}&end={yesterday}", headers=headers)
+        assert response.status_code == 400
+    
+    def test_analytics_admin_only(self):
+        """Test that regular users cannot read the analytics"""
+        headers = {"Authorization": f"Bearer {self.get_user_token()}"}
+        for path in ["daily", "top-sellers", "categories"]:
+            assert client.get(f"/api/admin/analytics/{path}", headers=headers).status_code == 403
+
+# ==================== COLUMNAR ANALYTICS TESTS ====================
+
+class TestColumnarAnalytics:
+    """Test suite for the NumPy purchase analytics"""
+    
+    def get_admin_token(self):
+        """Helper to get admin token"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return response.json()["access_token"]
+    
+    def get_user_headers(self, name):
+        """Helper registering a user and returning its auth headers"""
+        client.post("/api/auth/register", json={
+            "username": name,
+            "email": f"{name}@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": f"{name}@example.com",
+            "password": "password123"
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    def buy(self, headers, sweet_id, quantity):
+        response = client.post(f"/api/sweets/{sweet_id}/purchase", json={"quantity": quantity}, headers=headers)
+        assert response.status_code == 200
+    
+    def test_incremental_refresh(self):
+        """Test that refreshes append only new purchases and reload when the table is replaced"""
+        import analytics
+        headers = self.get_user_headers("columnsuser")
+        sweet_id = max(client.get("/api/sweets").json(), key=lambda sweet: sweet["quantity"])["id"]
+        for quantity in (1, 2, 3):
+            self.buy(headers, sweet_id, quantity)
+        
+        columns = analytics.PurchaseColumns(chunk_size=2)
+        with get_db() as conn:
+            snapshot = columns.refresh(conn)
+            assert snapshot["quantity"].tolist() == [1, 2, 3]
+            
+            self.buy(headers, sweet_id, 4)
+            snapshot = columns.refresh(conn)
+            assert snapshot["quantity"].tolist() == [1, 2, 3, 4]
+            assert snapshot["id"].tolist() == [row[0] for row in conn.execute("SELECT id FROM purchases ORDER BY id")]
+            assert columns.stats()["reloads"] == 0
+            
+            conn.execute("DELETE FROM purchases")
+            conn.execute("INSERT INTO purchases (user_id, sweet_id, quantity, total_price) VALUES (1, ?, 9, 90)", (sweet_id,))
+            conn.commit()
+            snapshot = columns.refresh(conn)
+            assert snapshot["quantity"].tolist() == [9]
+            assert columns.stats()["reloads"] == 1
+    
+    def test_vectorized_helpers(self):
+        """Test moving averages, group-bys and percentiles"""
+        import analytics
+        import numpy as np
+        averages = analytics.moving_average([1, 2, 3, 4], 2)
+        assert np.isnan(averages[0])
+        assert averages[1:].tolist() == [1.5, 2.5, 3.5]
+        
+        columns = {
+            "user_id": np.array([7, 5, 7]),
+            "quantity": np.array([1, 2, 3]),
+            "total_price": np.array([10.0, 50.0, 30.0]),
+        }
+        totals = analytics.group_totals(columns, "user_id")
+        assert totals["key"].tolist() == [5, 7]
+        assert totals["revenue"].tolist() == [50.0, 40.0]
+        assert totals["units"].tolist() == [2, 4]
+        assert totals["purchases"].tolist() == [1, 2]
+        
+        assert analytics.percentiles(np.array([1.0, 2.0, 3.0]), (50,)) == {"p50": 2.0}
+        assert analytics.percentiles(np.array([]), (50,)) == {"p50": None}
+    
+    def test_report_endpoints(self):
+        """Test the trend, customer and purchase-value reports"""
+        admin_headers = {"Authorization": f"Bearer {self.get_admin_token()}"}
+        big, small = self.get_user_headers("bigspender"), self.get_user_headers("smallspender")
+        sweet = max(client.get("/api/sweets").json(), key=lambda sweet: sweet["quantity"])
+        self.buy(big, sweet["id"], 5)
+        self.buy(big, sweet["id"], 1)
+        self.buy(small, sweet["id"], 2)
+        
+        response = client.get("/api/admin/analytics/trend?days=7&window=3", headers=admin_headers)
+        assert response.status_code == 200
+        trend = response.json()
+        assert len(trend) == 7
+        assert trend[-1]["day"] == datetime.utcnow().date().isoformat()
+        assert trend[-1]["units"] == 8
+        assert trend[-1]["units_avg"] == pytest.approx(8 / 3, abs=0.01)
+        assert sum(day["purchases"] for day in trend[:-1]) == 0
+        
+        response = client.get(f"/api/admin/analytics/trend?days=7&sweet_id={sweet['id'] + 1}", headers=admin_headers)
+        assert response.json()[-1]["units"] == 0
+        
+        response = client.get("/api/admin/analytics/customers?limit=1", headers=admin_headers)
+        customers = response.json()
+        assert customers["customers"] == 2
+        assert customers["top"][0]["username"] == "bigspender"
+        assert customers["top"][0]["units"] == 6
+        assert customers["spend"]["p50"] == pytest.approx(sweet["price"] * 4)
+        
+        response = client.get("/api/admin/analytics/purchase-values", headers=admin_headers)
+        values = response.json()
+        assert values["purchases"] == 3
+        assert values["revenue"] == pytest.approx(sweet["price"] * 8)
+        assert values["quantity"]["p50"] == 2
+        
+        yesterday = (datetime.utcnow() - timedelta(days=1)).date()
+        response = client.get(f"/api/admin/analytics/purchase-values?end={yesterday}", headers=admin_headers)
+        assert response.json()["purchases"] == 0
+        assert response.json()["mean_value"] is None
+
+# ==================== STOCK FORECAST TESTS ====================
+
+class TestStockForecast:
+    """Test suite for low-stock alerting and the restock forecast"""
+    
+    def get_admin_headers(self):
+        """Helper to get admin auth headers"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    def get_user_headers(self):
+        """Helper to get user auth headers"""
+        client.post("/api/auth/register", json={
+            "username": "forecastuser",
+            "email": "forecast@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": "forecast@example.com",
+            "password": "password123"
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    def create_sweet(self, headers, name, quantity):
+        response = client.post("/api/sweets", headers=headers, json={
+            "name": name,
+            "category": "Barfi",
+            "price": 100,
+            "quantity": quantity,
+            "description": "Forecast test sweet",
+            "img": "assets/Images/new_sweet.jpg"
+        })
+        return response.json()["id"]
+    
+    def test_low_stock_forecast(self):
+        """Test that fast sellers and sold-out sweets are flagged with a suggested restock"""
+        admin_headers = self.get_admin_headers()
+        fast = self.create_sweet(admin_headers, "Fast Seller", 10)
+        sold_out = self.create_sweet(admin_headers, "Sold Out", 0)
+        client.post(f"/api/sweets/{fast}/purchase", json={"quantity": 6}, headers=self.get_user_headers())
+        
+        response = client.post("/api/admin/low-stock/refresh", headers=admin_headers)
+        assert response.status_code == 200
+        assert response.json()["low_stock"] == 2
+        
+        response = client.get("/api/admin/low-stock", headers=admin_headers)
+        assert response.status_code == 200
+        forecast = response.json()
+        assert [row["sweet_id"] for row in forecast] == [sold_out, fast]
+        assert forecast[0]["days_to_stockout"] == 0
+        
+        row = forecast[1]
+        assert row["sweet_name"] == "Fast Seller"
+        assert row["quantity"] == 4
+        assert row["daily_rate"] == pytest.approx(6 / 7, abs=0.001)
+        assert row["days_to_stockout"] == pytest.approx(4 * 7 / 6, abs=0.01)
+        assert row["suggested_restock"] == 8
+        
+        response = client.get("/api/admin/low-stock?days=1", headers=admin_headers)
+        assert [row["sweet_id"] for row in response.json()] == [sold_out]
+    
+    def test_forecast_rates(self):
+        """Test that the faster of the weekly and window rates drives the forecast"""
+        import main
+        today = datetime.utcnow().date()
+        rate, days, stockout, suggested = main.forecast_sweet(100, 70, 70, today)
+        assert rate == 10
+        assert days == 10
+        assert stockout == (today + timedelta(days=10)).isoformat()
+        assert suggested == 40
+        
+        rate, _, _, _ = main.forecast_sweet(100, 0, main.FORECAST_WINDOW_DAYS * 2, today)
+        assert rate == 2
+        
+        assert main.forecast_sweet(100, 0, 0, today) == (0, None, None, 0)
+    
+    def test_low_stock_admin_only(self):
+        """Test that regular users cannot read or refresh the forecast"""
+        headers = self.get_user_headers()
+        assert client.get("/api/admin/low-stock", headers=headers).status_code == 403
+        assert client.post("/api/admin/low-stock/refresh", headers=headers).status_code == 403
+
+# Run tests with: pytest test_main.py -v --cov=main --cov-report=html
+# ==================== RESERVATION TESTS ====================
+
+class TestReservations:
+    """Test suite for cart reservations with an expiry"""
+    
+    def get_user_headers(self, name="reserver"):
+        """Helper to get user auth headers"""
+        client.post("/api/auth/register", json={
+            "username": name,
+            "email": f"{name}@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": f"{name}@example.com",
+            "password": "password123"
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline, "timed out"
+            time.sleep(0.05)
+    
+    def test_reserve_and_release(self):
+        """Test that a reservation holds stock and releasing it gives the stock back"""
+        import main
+        headers = self.get_user_headers()
+        stock = client.get("/api/sweets/1").json()["quantity"]
+        
+        response = client.post("/api/reservations", headers=headers, json={"sweet_id": 1, "quantity": 3})
+        assert response.status_code == 201
+        reservation = response.json()
+        assert reservation["remaining_stock"] == stock - 3
+        assert 0 < reservation["expires_in"] <= main.RESERVATION_TTL
+        
+        assert client.get("/api/sweets/1").json()["quantity"] == stock - 3
+        assert client.get("/api/sweets/1/availability").json() == {"sweet_id": 1, "available": stock - 3, "reserved": 3}
+        assert [r["id"] for r in client.get("/api/reservations", headers=headers).json()] == [reservation["id"]]
+        
+        response = client.post(f"/api/reservations/{reservation['id']}/extend", headers=headers, json={"ttl_seconds": 1800})
+        assert response.status_code == 200
+        assert response.json()["expires_in"] > main.RESERVATION_TTL
+        
+        response = client.delete(f"/api/reservations/{reservation['id']}", headers=headers)
+        assert response.status_code == 204
+        assert client.get("/api/sweets/1").json()["quantity"] == stock
+        assert client.get("/api/sweets/1/availability").json()["reserved"] == 0
+        assert client.delete(f"/api/reservations/{reservation['id']}", headers=headers).status_code == 404
+    
+    def test_availability_with_single_connection_pool(self):
+        """Test that loading the reservation book reuses the request's connection"""
+        import main
+        main.reservation_book.stop()  # the next lookup has to load the book
+        main.get_pool().close()
+        main._pool = main.ConnectionPool(TEST_DATABASE, size=1, timeout=0.5)
+        response = client.get("/api/sweets/1/availability")
+        assert response.status_code == 200
+        assert response.json()["reserved"] == 0
+    
+    def test_deleting_sweet_releases_its_reservations(self):
+        """Test that deleting a sweet drops the reservations holding it"""
+        import main
+        headers = self.get_user_headers()
+        reservation = client.post("/api/reservations", headers=headers, json={"sweet_id": 1, "quantity": 2}).json()
+        assert main.reservation_book.held(1) == 2
+        released = main.reservation_book.stats()["released"]
+        
+        admin_token = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        }).json()["access_token"]
+        response = client.delete("/api/sweets/1", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 204
+        
+        assert main.reservation_book.held(1) == 0
+        assert main.reservation_book.stats()["released"] == released + 1
+        assert client.get("/api/reservations", headers=headers).json() == []
+        assert client.delete(f"/api/reservations/{reservation['id']}", headers=headers).status_code == 404
+    
+    def test_reservation_limited_by_stock(self):
+        """Test that reservations cannot take more than the stock left"""
+        headers = self.get_user_headers()
+        stock = client.get("/api/sweets/2").json()["quantity"]
+        
+        response = client.post("/api/reservations", headers=headers, json={"sweet_id": 2, "quantity": stock + 1})
+        assert response.status_code == 400
+        response = client.post("/api/reservations", headers=headers, json={"sweet_id": 9999, "quantity": 1})
+        assert response.status_code == 404
+        
+        assert client.post("/api/reservations", headers=headers, json={"sweet_id": 2, "quantity": stock}).status_code == 201
+        response = client.post("/api/sweets/2/purchase", headers=headers, json={"quantity": 1})
+        assert response.status_code == 400
+    
+    def test_expired_reservation_returns_stock(self):
+        """Test that an expired reservation is swept and can no longer be committed"""
+        import main
+        headers = self.get_user_headers()
+        stock = client.get("/api/sweets/1").json()["quantity"]
+        expired = main.reservation_book.stats()["expired"]
+        
+        response = client.post("/api/reservations", headers=headers, json={"sweet_id": 1, "quantity": 2, "ttl_seconds": 1})
+        reservation_id = response.json()["id"]
+        assert client.get("/api/sweets/1").json()["quantity"] == stock - 2
+        
+        self.wait_for(lambda: main.reservation_book.stats()["expired"] == expired + 1)
+        assert client.get("/api/sweets/1").json()["quantity"] == stock
+        assert client.get("/api/reservations", headers=headers).json() == []
+        
+        response = client.post("/api/reservations/commit", headers=headers, json={"reservation_ids": [reservation_id]})
+        assert response.status_code == 404
+        assert response.json()["detail"]["reservation_ids"] == [reservation_id]
+    
+    def test_commit_records_purchases(self):
+        """Test that committing reservations records purchases without taking stock twice"""
+        import main
+        headers = self.get_user_headers()
+        other_headers = self.get_user_headers("otherreserver")
+        stock_1 = client.get("/api/sweets/1").json()["quantity"]
+        stock_2 = client.get("/api/sweets/2").json()["quantity"]
+        price_1 = client.get("/api/sweets/1").json()["price"]
+        price_2 = client.get("/api/sweets/2").json()["price"]
+        committed = main.reservation_book.stats()["committed"]
+        
+        first = client.post("/api/reservations", headers=headers, json={"sweet_id": 1, "quantity": 2}).json()["id"]
+        second = client.post("/api/reservations", headers=headers, json={"sweet_id": 2, "quantity": 1}).json()["id"]
+        
+        # Another user's reservations are not theirs to commit, and a partial match commits nothing
+        response = client.post("/api/reservations/commit", headers=other_headers, json={"reservation_ids": [first, second]})
+        assert response.status_code == 404
+        assert len(client.get("/api/reservations", headers=headers).json()) == 2
+        
+        response = client.post("/api/reservations/commit", headers=headers, json={"reservation_ids": [first, second]})
+        assert response.status_code == 200
+        order = response.json()
+        assert order["total_price"] == price_1 * 2 + price_2
+        assert [item["reservation_id"] for item in order["items"]] == [first, second]
+        
+        assert client.get("/api/sweets/1").json()["quantity"] == stock_1 - 2
+        assert client.get("/api/sweets/2").json()["quantity"] == stock_2 - 1
+        assert client.get("/api/reservations", headers=headers).json() == []
+        history = client.get("/api/purchases/history", headers=headers).json()
+        assert sorted(purchase["sweet_id"] for purchase in history) == [1, 2]
+        
+        stats = main.reservation_book.stats()
+        assert stats["committed"] == committed + 2
+        assert stats["units_held"] == 0
+
+# ==================== IDEMPOTENCY TESTS ====================
+
+class TestIdempotency:
+    """Test suite for Idempotency-Key on purchase, restock and create"""
+    
+    def get_admin_headers(self):
+        """Helper to get admin auth headers"""
+        response = client.post("/api/auth/login", json={
+            "email": "admin@sweetshop.com",
+            "password": "admin123"
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    def get_user_headers(self, name="retryuser"):
+        """Helper to get user auth headers"""
+        client.post("/api/auth/register", json={
+            "username": name,
+            "email": f"{name}@example.com",
+            "password": "password123",
+            "mobile": "1234567890",
+            "address": "123 Test Street"
+        })
+        response = client.post("/api/auth/login", json={
+            "email": f"{name}@example.com",
+            "password": "password123"
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    def test_purchase_retry_is_replayed(self):
+        """Test that retrying a purchase with the same key buys once and returns the first response"""
+        import main
+        headers = {**self.get_user_headers(), "Idempotency-Key": "purchase-1"}
+        stock = client.get("/api/sweets/1").json()["quantity"]
+        
+        first = client.post("/api/sweets/1/purchase", json={"quantity": 2}, headers=headers)
+        assert first.status_code == 200
+        assert "idempotent-replayed" not in first.headers
+        
+        # Once from the in-memory cache, once from the table after the cache is dropped
+        retry = client.post("/api/sweets/1/purchase", json={"quantity": 2}, headers=headers)
+        main.idempotency_store.clear()
+        cold_retry = client.post("/api/sweets/1/purchase", json={"quantity": 2}, headers=headers)
+        for response in (retry, cold_retry):
+            assert response.status_code == 200
+            assert response.headers["idempotent-replayed"] == "true"
+            assert response.json() == first.json()
+        
+        assert client.get("/api/sweets/1").json()["quantity"] == stock - 2
+        assert len(client.get("/api/purchases/history", headers=headers).json()) == 1
+        
+        # A new key is a new purchase
+        headers["Idempotency-Key"] = "purchase-2"
+        assert client.post("/api/sweets/1/purchase", json={"quantity": 2}, headers=headers).json()["remaining_stock"] == stock - 4
+    
+    def test_key_reuse_with_different_request(self):
+        """Test that a key cannot be reused for another request, while other users have their own keys"""
+        headers = {**self.get_user_headers(), "Idempotency-Key": "shared"}
+        other_headers = {**self.get_user_headers("otherretry"), "Idempotency-Key": "shared"}
+        
+        assert client.post("/api/sweets/1/purchase", json={"quantity": 1}, headers=headers).status_code == 200
+        assert client.post("/api/sweets/1/purchase", json={"quantity": 3}, headers=headers).status_code == 422
+        assert client.post("/api/sweets/2/purchase", json={"quantity": 1}, headers=headers).status_code == 422
+        
+        response = client.post("/api/sweets/1/purchase", json={"quantity": 3}, headers=other_headers)
+        assert response.status_code == 200
+        assert "idempotent-replayed" not in response.headers
+        
+        headers["Idempotency-Key"] = "x" * 256
+        assert client.post("/api/sweets/1/purchase", json={"quantity": 1}, headers=headers).status_code == 400
+    
+    def test_failed_request_is_not_stored(self):
+        """Test that an error is not remembered, so the retry runs for real"""
+        admin_headers = self.get_admin_headers()
+        headers = {**self.get_user_headers(), "Idempotency-Key": "after-restock"}
+        stock = client.get("/api/sweets/2").json()["quantity"]
+        
+        response = client.post("/api/sweets/2/purchase", json={"quantity": stock + 5}, headers=headers)
+        assert response.status_code == 400
+        
+        client.post("/api/sweets/2/restock", json={"quantity": 5}, headers=admin_headers)
+        response = client.post("/api/sweets/2/purchase", json={"quantity": stock + 5}, headers=headers)
+        assert response.status_code == 200
+        assert response.json()["remaining_stock"] == 0
+    
+    def test_restock_and_create_retries(self):
+        """Test that retried restocks and sweet creations are applied once"""
+        headers = {**self.get_admin_headers(), "Idempotency-Key": "restock-1"}
+        stock = client.get("/api/sweets/1").json()["quantity"]
+        for _ in range(3):
+            response = client.post("/api/sweets/1/restock", json={"quantity": 10}, headers=headers)
+            assert response.status_code == 200
+            assert response.json()["new_stock"] == stock + 10
+        assert client.get("/api/sweets/1").json()["quantity"] == stock + 10
+        
+        headers["Idempotency-Key"] = "create-1"
+        sweet = {
+            "name": "Retry Barfi",
+            "category": "Barfi",
+            "price": 80,
+            "quantity": 5,
+            "description": "Created once",
+            "img": "assets/Images/new_sweet.jpg"
+        }
+        created = [client.post("/api/sweets", json=sweet, headers=headers) for _ in range(2)]
+        assert [response.status_code for response in created] == [201, 201]
+        assert created[0].json() == created[1].json()
+        assert created[1].headers["idempotent-replayed"] == "true"
+        names = [s["name"] for s in client.get("/api/sweets").json()]
+        assert names.count("Retry Barfi") == 1
+    
+    def test_order_retry_is_replayed(self):
+        """Test that a retried checkout places the order once"""
+        headers = {**self.get_user_headers(), "Idempotency-Key": "checkout-1"}
+        order = {"items": [{"sweet_id": 1, "quantity": 1}, {"sweet_id": 2, "quantity": 2}]}
+        
+        first = client.post("/api/orders", json=order, headers=headers)
+        retry = client.post("/api/orders", json=order, headers=headers)
+        assert retry.status_code == 200
+        assert retry.headers["idempotent-replayed"] == "true"
+        assert retry.json() == first.json()
+        assert len(client.get("/api/purchases/history", headers=headers).json()) == 2
+    
+    def test_expired_keys_are_purged(self):
+        """Test that the purge drops expired keys and that an expired key runs again"""
+        import main
+        headers = {**self.get_user_headers(), "Idempotency-Key": "old"}
+        stock = client.get("/api/sweets/1").json()["quantity"]
+        client.post("/api/sweets/1/purchase", json={"quantity": 1}, headers=headers)
+        
+        with get_db() as conn:
+            conn.execute("UPDATE idempotency_keys SET expires_at = 0")
+            conn.commit()
+        main.idempotency_store.clear()
+        assert main.purge_idempotency() == 1
+        
+        response = client.post("/api/sweets/1/purchase", json={"quantity": 1}, headers=headers)
+        assert "idempotent-replayed" not in response.headers
+        assert response.json()["remaining_stock"] == stock - 2
@@ -2,6 +2,17 @@ const API_BASE = "http://127.0.0.1:8000/api";
 let cartData = [];
 let selectedPaymentMethod = 'card';
 let selectedUpiApp = null;
+// One key per checkout: if the connection drops after the order went through,
+// paying again returns the same order instead of placing a second one
+let checkoutKey = null;
+
+// crypto.randomUUID only exists in secure contexts (HTTPS or localhost);
+// getRandomValues is available everywhere
+function newCheckoutKey() {
+  if (typeof crypto.randomUUID === 'function') return crypto.randomUUID();
+  const bytes = crypto.getRandomValues(new Uint8Array(16));
+  return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
 
 function loadCart() {
   cartData = JSON.parse(localStorage.getItem('cart') || '[]');
@@ -68,17 +79,29 @@ async function processPayment() {
   document.getElementById('loadingState').style.display = 'block';
 
   try {
+    if (!checkoutKey) checkoutKey = newCheckoutKey();
     const token = localStorage.getItem('token');
-    for (const item of cartData) {
-      const quantity = Math.ceil(item.weight / 100);
-      await fetch(`${API_BASE}/sweets/${item.sweetId}/purchase`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`
-        },
-        body: JSON.stringify({ quantity })
-      });
+    const items = cartData.map(item => ({
+      sweet_id: item.sweetId,
+      quantity: Math.ceil(item.weight / 100)
+    }));
+    const response = await fetch(`${API_BASE}/orders`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${token}`,
+        'Idempotency-Key': checkoutKey
+      },
+      body: JSON.stringify({ items })
+    });
+
+    if (!response.ok) {
+      const { detail } = await response.json();
+      // Validation errors (422) are a list of {loc, msg}; order errors list failing lines in detail.items
+      const lines = Array.isArray(detail)
+        ? detail.map(entry => entry.msg)
+        : detail?.items?.map(line => line.detail);
+      throw new Error(lines?.join('\n') || detail?.message || detail || 'Payment failed');
     }
 
     setTimeout(() => {
@@ -88,7 +111,7 @@ async function processPayment() {
     }, 2000);
 
   } catch (err) {
-    alert('Payment failed');
+    alert(`Payment failed: ${err.message}`);
     document.getElementById('loadingState').style.display = 'none';
     document.querySelector('.payment-wrapper').style.display = 'grid';
   }